@@ -18,6 +18,21 @@ logger.addHandler(NullLogHandler())
 # Default imports
 from jsonrpctcp.config import Config
 config = Config.instance()
+
+def log_message(label, message):
+    """
+    Logs a request / response message at the debug level. Nothing is
+    formatted unless debug logging is on (and config.log_messages is
+    set), and long messages are cut to config.log_truncate characters.
+    """
+    if not config.log_messages or not logger.isEnabledFor(logging.DEBUG):
+        return
+    suffix = ''
+    if config.log_truncate and len(message) > config.log_truncate:
+        suffix = '... (%d total)' % len(message)
+        message = message[:config.log_truncate]
+    logger.debug('%s: %s%s', label, message, suffix)
+
 from jsonrpctcp.history import History
 history = History.instance()
 from jsonrpctcp.client import connect
@@ -0,0 +1,340 @@
+"""
+An asyncio JSONRPCTCP client (Python 3.7+ only). It has the same
+attribute syntax, notifications and batches as the normal Client, but
+the calls are awaited, and any number of them can be in flight at once
+on one multiplexed connection:
+
+    from jsonrpctcp.asyncclient import connect
+
+    conn = connect('localhost', 8001)
+    result = await conn.tree.method(param1, param2)
+    await conn._notification.method(keyword=arg)
+    results = await asyncio.gather(*[conn.method(i) for i in range(100)])
+
+    batch = conn._batch()
+    batch.method(1)
+    batch.tree.method(2)
+    for result in await batch():
+        print(result)
+"""
+import asyncio
+import copy
+import functools
+import itertools
+from jsonrpctcp import config
+from jsonrpctcp import history
+from jsonrpctcp.client import Client
+from jsonrpctcp.errors import ProtocolError
+from jsonrpctcp.framing import FrameParser, frame_parts, TAG, split_tag
+from jsonrpctcp.framing import handshake, parse_handshake
+from jsonrpctcp import compression
+from jsonrpctcp import session
+from jsonrpctcp.tls import get_context
+from jsonrpctcp.hooks import CallInfo
+from jsonrpctcp.metrics import timer
+
+class AsyncClient(Client):
+    """
+    The asyncio version of the Client class. It shouldn't need to be
+    instantiated directly -- use the connect function in this module.
+    """
+
+    def __init__(self, addr, **kwargs):
+        if not kwargs.get('connection', None):
+            kwargs['connection'] = AsyncConnection(
+                addr, codec=kwargs.get('codec', None),
+                key=kwargs.get('key', None),
+                tls=get_context(kwargs.get('tls', None))
+            )
+        Client.__init__(self, addr, **kwargs)
+
+    async def _call_single(self, request):
+        """
+        Processes a single request, and returns the response -- from
+        the cache, if the method is cached. Identical cached calls made
+        while one is in flight await its result, rather than sending
+        their own requests. (Each caller gets a copy of a cached
+        result, so changing it doesn't change the others.)
+        """
+        cache, key = self._get_cache(request)
+        if cache is None:
+            return await self._call_remote(request)
+        found, result = cache.get(key)
+        if found:
+            return copy.deepcopy(result)
+        flight = self._flights.get(key)
+        if flight is None:
+            # The request is made in a task of its own, so cancelling
+            # the call that started it doesn't cancel the others.
+            flight = asyncio.ensure_future(
+                self._call_cached(request, cache, key)
+            )
+            flight.add_done_callback(retrieve_error)
+            self._flights[key] = flight
+        return copy.deepcopy(await asyncio.shield(flight))
+
+    async def _call_cached(self, request, cache, key):
+        """ Makes a cached call, for everyone awaiting its result. """
+        try:
+            result = await self._call_remote(request)
+            cache.set(key, result)
+            return result
+        finally:
+            self._flights.pop(key, None)
+
+    async def _call_remote(self, request):
+        """ Sends a single request, and returns the response. """
+        call = self._begin_call([request])
+        try:
+            started = timer()
+            message, notify = self._prepare_single(request)
+            call.encode = timer() - started
+            response_text = await self._send_and_receive(
+                message, notify=notify, call=call
+            )
+            started = timer()
+            result = self._finish_single(response_text)
+            call.decode += timer() - started
+        except Exception as error:
+            self._end_call(call, error)
+            raise
+        self._end_call(call)
+        return result
+
+    async def _call_stream(self, request):
+        """
+        Results aren't streamed on the (multiplexed) asyncio connection,
+        so this returns an iterator over the collected results.
+        """
+        return iter(await self._call_single(request) or [])
+
+    async def _call_batch(self, requests):
+        """
+        Processes a batch, and returns a generator to iterate over the
+        response results.
+        """
+        call = self._begin_call(requests, batch=True)
+        try:
+            started = timer()
+            message, ids, notify = self._prepare_batch(requests)
+            call.encode = timer() - started
+            response_text = await self._send_and_receive(
+                message, batch=True, notify=notify, call=call
+            )
+            started = timer()
+            result = self._finish_batch(response_text, ids)
+            call.decode += timer() - started
+        except Exception as error:
+            self._end_call(call, error)
+            raise
+        self._end_call(call)
+        return result
+
+    async def _send_and_receive(self, message, batch=False, notify=False,
+        call=None):
+        """
+        Sends the JSON request over the connection, and (if not a
+        notification) waits for the response and decodes it.
+        """
+        if call is None:
+            call = CallInfo()
+        started = timer()
+        trace = history.start('client', message)
+        message = self._encode_message(message)
+        call.encode += timer() - started
+        call.request_size = len(message)
+        response = await self._connection.request(message, notify, call)
+        call.response_size = len(response)
+        started = timer()
+        response = self._decode_message(response)
+        history.finish(trace, response)
+        call.decode += timer() - started
+        return response
+
+    async def _close(self):
+        """ Closes the connection. """
+        await self._connection.close()
+
+class AsyncConnection(object):
+    """
+    A multiplexed connection to a server, opened the first time it's
+    used. Every request is sent as soon as it's made, and a reader task
+    hands each response (matched by its frame tag) to the waiting call.
+    """
+
+    def __init__(self, addr, framing=None, codec=None, key=None, tls=None):
+        framing = framing or config.framing or 'length'
+        assert framing in ('length', 'netstring')
+        self.addr = addr
+        self.framing = framing
+        self.codec = codec
+        self.key = key
+        # The SSLContext, for TLS connections (asyncio doesn't resume
+        # TLS sessions).
+        self.tls = tls
+        self.compress = None
+        self.session = None
+        self.reader = None
+        self.writer = None
+        self.requests = 0
+        self.bytes_sent = 0
+        self._tags = itertools.count(1)
+        self._pending = {}
+        self._lock = None
+        self._task = None
+
+    async def open(self):
+        """ Connects, negotiates, and starts the reader task. """
+        host, port = self.addr
+        kwargs = {}
+        if self.tls is not None:
+            kwargs = {'ssl': self.tls, 'server_hostname': host}
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, **kwargs), config.timeout
+        )
+        parser = FrameParser(self.framing)
+        offer = {'framing': self.framing, 'multiplex': 1}
+        if self.codec:
+            offer['codec'] = self.codec
+        if compression.offered():
+            offer['compress'] = compression.offered()
+        if self.key and session.offered():
+            offer['cipher'] = session.offered()
+            offer['nonce'] = session.new_nonce()
+        writer.write(handshake(**offer))
+        line = await asyncio.wait_for(
+            self._read(reader, parser, parser.next_line), config.timeout
+        )
+        options = parse_handshake(line)
+        if options.get('framing') != self.framing or \
+            options.get('multiplex') != '1' or \
+            options.get('codec') != self.codec:
+            writer.close()
+            raise ProtocolError(
+                -32700, 'Server refused the connection options.'
+            )
+        parser.compress = self.compress = options.get('compress')
+        try:
+            parser.session = self.session = session.start(
+                self.key, offer, options, 'client'
+            )
+        except ProtocolError:
+            writer.close()
+            raise
+        self.reader = reader
+        self.writer = writer
+        self._task = asyncio.ensure_future(
+            self._read_responses(reader, writer, parser)
+        )
+
+    async def close(self):
+        """ Closes the connection (it reopens on the next request). """
+        writer, self.writer = self.writer, None
+        self.reader = None
+        if writer:
+            writer.close()
+        if self._task:
+            await asyncio.wait([self._task])
+            self._task = None
+
+    async def request(self, message, notify=False, call=None):
+        """
+        Sends a message (bytes) and waits for its response, unless it
+        is a notification, which doesn't get one.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        async with self._lock:
+            started = opened = timer()
+            if not self.writer:
+                await self.open()
+                opened = timer()
+                if call is not None:
+                    call.connect = opened - started
+            writer = self.writer
+            tag = next(self._tags) % 2 ** 32
+            if not notify:
+                self._pending[tag] = (future, writer)
+            make_parts = functools.partial(
+                frame_parts, [TAG.pack(tag), message], self.framing,
+                self.compress, self.session
+            )
+            if self.compress and len(message) > compression.CHUNK_SIZE:
+                # A large message is compressed off of the event loop.
+                parts = await loop.run_in_executor(None, make_parts)
+            else:
+                parts = make_parts()
+            writer.writelines(parts)
+            self.requests += 1
+            self.bytes_sent += sum([len(part) for part in parts])
+            try:
+                await writer.drain()
+            except (ConnectionError, OSError):
+                self._pending.pop(tag, None)
+                raise
+        sent = timer()
+        if call is not None:
+            call.send = sent - opened
+        if notify:
+            return b''
+        try:
+            response = await asyncio.wait_for(future, config.timeout)
+        finally:
+            self._pending.pop(tag, None)
+        if call is not None:
+            call.wait = timer() - sent
+        return response
+
+    async def _read(self, reader, parser, next_message):
+        """ Reads until the parser has a complete message (or EOF). """
+        while True:
+            message = next_message()
+            if message is not None:
+                return message
+            data = await reader.read(config.buffer)
+            if not data:
+                return None
+            parser.feed(data)
+
+    async def _read_responses(self, reader, writer, parser):
+        """ The reader task loop, matching responses to calls. """
+        try:
+            while True:
+                message = await self._read(reader, parser, parser.next_frame)
+                if message is None:
+                    break
+                tag, message = split_tag(message)
+                tag, = TAG.unpack(tag)
+                future, _ = self._pending.pop(tag, (None, None))
+                if future and not future.done():
+                    future.set_result(message)
+        except (ProtocolError, ConnectionError, OSError):
+            pass
+        # The connection is gone, so fail everything still waiting on it.
+        if self.writer is writer:
+            self.writer = None
+            self.reader = None
+            writer.close()
+        for tag, (future, owner) in list(self._pending.items()):
+            if owner is writer:
+                self._pending.pop(tag)
+                if not future.done():
+                    future.set_exception(
+                        ConnectionError('Connection closed by server.')
+                    )
+
+def connect(host, port, key=None, codec=None, hooks=None, tls=None):
+    """
+    This is a wrapper function for the AsyncClient class.
+    """
+    client = AsyncClient(
+        (host, port), key=key, codec=codec, hooks=hooks, tls=tls
+    )
+    return client
+
+def retrieve_error(future):
+    """ Marks a task's error as seen (if nobody was left to await it). """
+    if not future.cancelled():
+        future.exception()
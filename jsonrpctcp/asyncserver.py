@@ -0,0 +1,468 @@
+"""
+An asyncio-based JSONRPCTCP server (Python 3.7+ only). It uses the
+same JSONRequest handler registration and request parsing as the
+threaded Server, but serves every connection from one event loop, so
+idle and slow clients don't each tie up a thread.
+
+Coroutine handlers are awaited directly, and normal handlers are run
+in an executor so they don't block the event loop:
+
+    from jsonrpctcp.asyncserver import AsyncServer
+
+    async def fetch(key):
+        return await some_database.get(key)
+
+    server = AsyncServer(('localhost', 8001))
+    server.add_handler(fetch)
+    asyncio.run(server.serve())
+"""
+import asyncio
+import functools
+import inspect
+import itertools
+from jsonrpctcp import config
+from jsonrpctcp import logger, log_message
+from jsonrpctcp import history
+from jsonrpctcp.handler import Handler
+from jsonrpctcp.errors import ProtocolError, EncryptionMissing
+from jsonrpctcp.server import JSONRequest, ProcessRequest
+from jsonrpctcp.server import generate_chunk, generate_response, is_stream
+from jsonrpctcp.framing import FrameParser, frame_parts, handshake
+from jsonrpctcp.framing import is_handshake, parse_handshake, negotiate
+from jsonrpctcp.framing import split_tag, split_flag, MORE, FINAL
+from jsonrpctcp.codec import get_codec
+from jsonrpctcp.metrics import timer
+from jsonrpctcp import compression
+from jsonrpctcp import session
+from jsonrpctcp.tls import get_context
+
+class AsyncServer(object):
+    """
+    The asyncio counterpart of the Server class. It should be
+    instantiated with a (host, port) tuple (and an optional handler),
+    and the handlers attached with add_handler. An executor can be
+    passed in for running the normal (non-coroutine) handlers -- by
+    default the event loop's executor is used.
+    """
+
+    def __init__(self, addr, handler=None, executor=None, tls=None):
+        # Without config.crypt, only session encrypted (framed)
+        # connections can be used.
+        if config.secret and not config.crypt and not session.CIPHERS:
+            raise EncryptionMissing('No encrpytion library found.')
+        self.addr = addr
+        self.executor = executor
+        self.server = None
+        self.json_request = JSONRequest(self)
+        # 'tls' (or config.tls) serves TLS connections -- True for the
+        # configured certificate, or an ssl.SSLContext.
+        self.json_request.tls = get_context(tls, server=True)
+        if config.stats_method:
+            self.json_request.add_handler(self.stats, config.stats_method)
+        if handler:
+            assert hasattr(handler, '__call__') or \
+                issubclass(handler, Handler)
+            self.json_request.add_handler(handler)
+
+    def add_handler(self, method, name=None, cache=None):
+        """ Just a wrapper around JSONRequest.add_handler """
+        self.json_request.add_handler(method, name, cache)
+
+    def invalidate(self, method=None, params=None):
+        """ Just a wrapper around JSONRequest.invalidate """
+        self.json_request.invalidate(method, params)
+
+    async def start(self):
+        """ Binds the socket and starts accepting connections. """
+        host, port = self.addr
+        self.server = await asyncio.start_server(
+            self.process, host or None, port, backlog=config.max_queue,
+            ssl=self.json_request.tls
+        )
+        return self.server
+
+    async def serve(self):
+        """ Starts the server and serves until it is shut down. """
+        if not self.server:
+            await self.start()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def shutdown(self):
+        """ Stops accepting connections. """
+        if self.server:
+            self.server.close()
+
+    def stats(self):
+        """ Returns the bytes and messages sent, and the request metrics. """
+        stats = {
+            'bytes_sent': self.json_request.bytes_sent,
+            'messages_sent': self.json_request.messages_sent,
+        }
+        stats.update(self.json_request.metrics.stats())
+        stats['caches'] = self.json_request.cache_stats()
+        if self.json_request.tls:
+            stats['tls'] = self.json_request.tls_stats()
+        return stats
+
+    async def process(self, reader, writer):
+        """ Just a wrapper for AsyncProcessRequest. """
+        request = AsyncProcessRequest(self.json_request, self.executor)
+        self.json_request.metrics.opened()
+        try:
+            await request.process(reader, writer)
+        finally:
+            self.json_request.metrics.closed()
+
+class AsyncProcessRequest(ProcessRequest):
+    """
+    Handles a request from an asyncio stream, using the ProcessRequest
+    validation and response generation, but awaiting the handlers.
+    """
+
+    def __init__(self, json_request, executor=None):
+        ProcessRequest.__init__(self, json_request)
+        self.executor = executor
+
+    async def process(self, reader, writer):
+        """
+        Retrieves the data stream from the connection and responds.
+        """
+        self.client_address = writer.get_extra_info('peername')
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.json_request.count_tls(ssl_object)
+        request = bytearray()
+        try:
+            data = await self.get_data(reader, config.timeout)
+            if data and is_handshake(data):
+                await self.process_frames(reader, writer, data)
+                return
+            while data:
+                request += data
+                if len(data) < config.buffer:
+                    break
+                data = await self.get_data(reader, config.timeout)
+            response = await self.handle_message(request)
+            writer.write(response)
+            await writer.drain()
+            self.json_request.count_sent(len(response))
+        except (ConnectionError, OSError):
+            self.socket_error = True
+        finally:
+            writer.close()
+
+    async def process_frames(self, reader, writer, data):
+        """
+        Handles a framed (persistent) connection, responding to each
+        request frame until the client closes the connection.
+        """
+        parser = FrameParser(data=data)
+        try:
+            line = await self.read_frame(reader, parser, line=True)
+            if line is None:
+                return
+            offer = parse_handshake(line)
+        except ProtocolError as error:
+            logger.debug('SERVER | BAD PREAMBLE: %s', error.message)
+            writer.write(handshake(error='invalid'))
+            await writer.drain()
+            return
+        try:
+            options = negotiate(offer)
+        except ProtocolError as error:
+            logger.debug('SERVER | REFUSED: %s', error.message)
+            writer.write(handshake(error='unsupported'))
+            await writer.drain()
+            return
+        writer.write(handshake(**options))
+        parser.framing = options['framing']
+        parser.compress = options.get('compress')
+        parser.session = self.session = session.start(
+            config.secret, offer, options, 'server'
+        )
+        if 'codec' in options:
+            self.codec = get_codec(options['codec'])
+        if options.get('multiplex'):
+            await self.process_multiplexed(reader, writer, parser)
+            return
+        streams = options.get('stream')
+        while True:
+            try:
+                request = await self.read_frame(reader, parser)
+            except ProtocolError:
+                break
+            if request is None:
+                break
+            if streams:
+                more, request = split_flag(request)
+                response = await self.handle_message(request, more)
+                await self.send_stream(response, writer, parser)
+                continue
+            response = await self.handle_message(request)
+            await self.send_frame([response], writer, parser)
+
+    async def send_stream(self, response, writer, parser):
+        """
+        Sends a response on a streaming connection, where each message
+        is flagged with whether more of the response is coming.
+        """
+        if not hasattr(response, '__aiter__'):
+            await self.send_frame([FINAL, response], writer, parser)
+            return
+        previous = None
+        async for message in response:
+            if previous is not None:
+                await self.send_frame([MORE, previous], writer, parser)
+            previous = message
+        await self.send_frame([FINAL, previous], writer, parser)
+
+    async def send_frame(self, pieces, writer, parser):
+        """
+        Frames and sends a response message, given in pieces (the tag
+        or stream flag, and the message) so it isn't copied together.
+        """
+        make_parts = functools.partial(
+            frame_parts, pieces, parser.framing, parser.compress,
+            parser.session
+        )
+        if parser.compress and \
+            sum([len(piece) for piece in pieces]) > compression.CHUNK_SIZE:
+            # A large message is compressed off of the event loop (zlib
+            # lets go of the GIL), so other connections aren't held up.
+            loop = asyncio.get_running_loop()
+            parts = await loop.run_in_executor(self.executor, make_parts)
+        else:
+            parts = make_parts()
+        writer.writelines(parts)
+        self.json_request.count_sent(sum([len(part) for part in parts]))
+        await writer.drain()
+
+    async def process_multiplexed(self, reader, writer, parser):
+        """
+        Handles a multiplexed connection -- each request frame is run
+        in its own task (up to config.multiplex_workers at once), and
+        each response is sent (with its request's tag) when it's ready.
+        """
+        lock = asyncio.Lock()
+        slots = asyncio.Semaphore(config.multiplex_workers)
+        tasks = set()
+        async def respond(tag, request):
+            try:
+                response = await self.handle_message(request)
+                if response:
+                    async with lock:
+                        await self.send_frame([tag, response], writer, parser)
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                slots.release()
+        try:
+            while True:
+                try:
+                    request = await self.read_frame(reader, parser)
+                except ProtocolError:
+                    break
+                if request is None:
+                    break
+                await slots.acquire()
+                task = asyncio.ensure_future(
+                    respond(*split_tag(request))
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # Let the requests already read finish before closing.
+            if tasks:
+                await asyncio.wait(tasks)
+
+    async def read_frame(self, reader, parser, line=False):
+        """
+        Reads from the stream until the parser has a complete message
+        (or line), returning None if the connection is closed (or idle
+        for too long).
+        """
+        next_message = parser.next_line if line else parser.next_frame
+        while True:
+            message = next_message()
+            if message is not None:
+                return message
+            data = await self.get_data(reader, config.keepalive_timeout)
+            if not data:
+                return None
+            parser.feed(data)
+
+    async def get_data(self, reader, timeout):
+        """ Retrieves a data chunk from the stream. """
+        try:
+            return await asyncio.wait_for(reader.read(config.buffer), timeout)
+        except asyncio.TimeoutError:
+            # It may have finished sending without an error if
+            # len(message) % buffer == 0.
+            return None
+
+    async def handle_message(self, request, stream=False):
+        """
+        Decrypts a raw request message, runs it and returns the raw
+        (encrypted, if necessary) response message. If 'stream' is set
+        and the call returns an iterator, it returns an async iterator
+        over the response messages instead.
+        """
+        try:
+            request = self.decrypt(request)
+        except ProtocolError as error:
+            trace = history.start('server', request)
+            self.metrics.add_error(error.code)
+            self.metrics.add_request()
+            response = error.encode(self.codec)
+        else:
+            trace = history.start('server', request)
+            log_message('SERVER | REQUEST', request)
+            response = await self.parse_request(request, stream)
+        if hasattr(response, '__aiter__'):
+            return self.encrypt_stream(response, trace)
+        history.finish(trace, response)
+        log_message('SERVER | RESPONSE', response)
+        if not response:
+            return b''
+        return self.encrypt(response)
+
+    async def encrypt_stream(self, responses, trace=None):
+        """ Encrypts the messages of a streamed response as they come. """
+        async for response in responses:
+            history.finish(trace, response)
+            log_message('SERVER | RESPONSE', response)
+            yield self.encrypt(response)
+
+    async def parse_request(self, data, stream=False):
+        """
+        Attempts to load the request, validates it, and calls it. If
+        'stream' is set, and it's a single call that returns an
+        iterator, the encoded response is streamed (as an async
+        iterator).
+        """
+        started = timer()
+        try:
+            requests, batch = self.load_request(data)
+        except ProtocolError as error:
+            self.metrics.add_error(error.code)
+            self.metrics.add_request(decode=timer() - started)
+            return error.encode(self.codec)
+        decode = timer() - started
+        request_errors = [self.check_request(req) for req in requests]
+        calls = [
+            req for req, error in zip(requests, request_errors) if not error
+        ]
+        stream = stream and not batch and calls and 'id' in calls[0]
+        results = await self.parse_calls(calls, stream)
+        if stream and is_async_stream(results[0]):
+            self.metrics.add_request(calls[0]['method'], decode)
+            return self.stream_responses(results[0], calls[0])
+        return self.build_responses(
+            requests, request_errors, results, batch, decode
+        )
+
+    async def stream_responses(self, results, request):
+        """
+        Encodes an iterator (or async iterator) result a chunk
+        (config.stream_chunk items) at a time, and then the normal
+        response, with a null result (or the error, if the iterator
+        raised one).
+        """
+        request_id = request.get('id')
+        try:
+            async for chunk in self.chunks(results):
+                yield self.codec.dumps(generate_chunk(chunk, request_id))
+        except Exception:
+            error = self.handler_error(request['method'])
+            self.metrics.add_error(error.code)
+            yield error.encode(self.codec, request_id)
+            return
+        yield self.codec.dumps(generate_response(None, id=request_id))
+
+    async def chunks(self, results):
+        """
+        Splits an iterator result into lists of config.stream_chunk
+        items -- a normal iterator is run in the executor, like the
+        handler itself.
+        """
+        if hasattr(results, '__aiter__'):
+            chunk = []
+            async for item in results:
+                chunk.append(item)
+                if len(chunk) >= config.stream_chunk:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+            return
+        loop = asyncio.get_running_loop()
+        take = lambda: list(itertools.islice(results, config.stream_chunk))
+        while True:
+            chunk = await loop.run_in_executor(self.executor, take)
+            if not chunk:
+                break
+            yield chunk
+
+    async def collect(self, results):
+        """ Collects an iterator (or async iterator) result into a list. """
+        chunks = []
+        async for chunk in self.chunks(results):
+            chunks.extend(chunk)
+        return chunks
+
+    async def parse_calls(self, calls, stream=False):
+        """
+        Runs the calls of a request, and returns their results in
+        order. Batch entries run as concurrent coroutines if
+        config.batch_concurrency allows it.
+        """
+        if len(calls) < 2 or config.batch_concurrency <= 1:
+            return [await self.parse_call(call, stream) for call in calls]
+        slots = asyncio.Semaphore(config.batch_concurrency)
+        async def parse_call(call):
+            async with slots:
+                return await self.parse_call(call)
+        return await asyncio.gather(*[parse_call(call) for call in calls])
+
+    async def parse_call(self, obj, stream=False):
+        """
+        Parses a JSON request, awaiting coroutine handlers and running
+        the rest in the executor. An iterator result is collected into
+        a list, unless it's going to be streamed.
+        """
+        try:
+            handler, params, kwargs = self.get_call(obj)
+        except ProtocolError as error:
+            self.metrics.add_error(error.code)
+            return error
+        started = timer()
+        cache, key, found, response = self.get_cached(obj, params, kwargs)
+        if found:
+            self.metrics.add_call(obj['method'], timer() - started)
+            return response
+        try:
+            if asyncio.iscoroutinefunction(handler):
+                response = await handler(*params, **kwargs)
+            else:
+                loop = asyncio.get_running_loop()
+                response = await loop.run_in_executor(
+                    self.executor,
+                    functools.partial(handler, *params, **kwargs)
+                )
+                if inspect.isawaitable(response):
+                    response = await response
+            if not stream and is_async_stream(response):
+                response = await self.collect(response)
+        except Exception:
+            error = self.handler_error(obj['method'])
+            self.metrics.add_call(obj['method'], timer() - started, error.code)
+            return error
+        self.metrics.add_call(obj['method'], timer() - started)
+        return self.set_cached(cache, key, response)
+
+def is_async_stream(result):
+    """ Checks whether a result is an iterator or an async iterator. """
+    return hasattr(result, '__aiter__') or is_stream(result)
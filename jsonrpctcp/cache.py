@@ -0,0 +1,136 @@
+"""
+Server-side result caching, for handlers that are pure lookups. A
+cached method's results are kept (keyed by the method name and its
+parameters) for a while, and repeated calls are answered without
+running the handler:
+
+    @cached(ttl=60, size=1000)
+    def lookup(key):
+        return database.get(key)
+
+    server.add_handler(lookup)
+    server.add_handler(other_lookup, cache=True) # the config defaults
+
+Only successful results are cached -- errors aren't, and neither are
+streamed (iterator) results. server.invalidate() drops cached results.
+"""
+import threading
+import time
+from collections import OrderedDict
+from jsonrpctcp import config
+
+def cached(ttl=None, size=None):
+    """
+    Marks a handler's results as cacheable, for ttl seconds (default
+    config.cache_ttl), keeping at most 'size' of them (default
+    config.cache_size).
+    """
+    def decorate(method):
+        method.result_cache = (ttl, size)
+        return method
+    return decorate
+
+def cache_key(method, params, kwargs):
+    """
+    A hashable key for a call (the method name and its parameters), or
+    None if the parameters can't be made into one.
+    """
+    try:
+        key = (method, canonical(kwargs or params))
+        hash(key)
+    except TypeError:
+        # Unsortable or unhashable keys (from msgpack or CBOR maps)
+        return None
+    return key
+
+def canonical(obj):
+    """
+    Turns a decoded JSON value into a hashable one that only equals
+    the same value -- lists become tuples, dicts sorted tuples of
+    their items, and the type is kept with the scalars (so 1, 1.0
+    and true are different keys).
+    """
+    if isinstance(obj, dict):
+        return (dict, tuple(sorted(
+            [(key, canonical(value)) for key, value in obj.items()],
+            key=sort_key
+        )))
+    if isinstance(obj, (list, tuple)):
+        return (list, tuple([canonical(item) for item in obj]))
+    return (type(obj), obj)
+
+def sort_key(item):
+    """ Orders dict items by key, with the keys of each type together. """
+    return (type(item[0]).__name__, item[0])
+
+class ResultCache(object):
+    """
+    A thread-safe LRU cache of results, which expire 'ttl' seconds
+    after they were added.
+    """
+
+    def __init__(self, ttl=None, size=None):
+        if ttl is None:
+            ttl = config.cache_ttl
+        if size is None:
+            size = config.cache_size
+        self.ttl = ttl
+        self.size = size
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def get(self, key):
+        """ Returns (True, result) if it's cached, (False, None) if not. """
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            result, expires = entry
+            if expires < time.time():
+                self.expired += 1
+                self.misses += 1
+                return False, None
+            # Back on the (most recently used) end.
+            self._results[key] = entry
+            self.hits += 1
+            return True, result
+
+    def set(self, key, result):
+        """ Caches a result, dropping the least recently used if full. """
+        with self._lock:
+            self._results.pop(key, None)
+            self._results[key] = (result, time.time() + self.ttl)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+                self.evicted += 1
+
+    def invalidate(self, key=None):
+        """ Drops one cached result, or all of them if key is None. """
+        with self._lock:
+            if key is None:
+                self._results.clear()
+            else:
+                self._results.pop(key, None)
+
+    def invalidate_method(self, method):
+        """ Drops the cached results of one method (for shared caches). """
+        with self._lock:
+            for key in [key for key in self._results if key[0] == method]:
+                del self._results[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._results),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': lookups and float(self.hits) / lookups,
+                'evicted': self.evicted,
+                'expired': self.expired,
+            }
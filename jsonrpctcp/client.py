@@ -6,22 +6,36 @@ connect function:
 conn = connect('localhost', 8001)
 result = conn.method(param1, param2)
 result = conn.tree.method(keyword=arg)
+for result in conn._stream.method():
+    print(result)
+
+Hooks (see the hooks module) are told about each call, with its sizes
+and timings. The results of slow-changing lookups can be cached on the
+client, for a method or a whole namespace:
+
+conn._cache('tree', ttl=30, size=100)
 """
 from __future__ import print_function 
 
 import sys
+import copy
 import socket 
 import uuid
 import hashlib
+import threading
 from jsonrpctcp import config
 from jsonrpctcp import history
-from jsonrpctcp import logger
+from jsonrpctcp import logger, log_message
+from jsonrpctcp.connection import Connection, ConnectionPool
+from jsonrpctcp.connection import MultiplexConnection, Waiter
+from jsonrpctcp.framing import recv_chunk
 from jsonrpctcp.errors import ProtocolError, EncryptionMissing
-    
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from jsonrpctcp.codec import get_codec, BINARY_CODECS
+from jsonrpctcp.hooks import CallInfo
+from jsonrpctcp.metrics import timer
+from jsonrpctcp.cache import ResultCache, cache_key
+from jsonrpctcp import session
+from jsonrpctcp.tls import get_context
 
 class Client(object):
     """
@@ -38,15 +52,69 @@ class Client(object):
         self._requests = []
         self.__batch = kwargs.get('batch', None)
         self._key = kwargs.get('key', None)
-        if self._key and not config.crypt:
+        # The SSLContext for TLS connections (see the tls module), if
+        # 'tls' (or config.tls) is set.
+        self._tls = get_context(kwargs.get('tls', None))
+        # A binary codec (negotiated with the server) for the messages,
+        # instead of JSON.
+        self._codec = kwargs.get('codec', None)
+        if self._codec and self._codec not in BINARY_CODECS:
+            raise ValueError('Codec %s is not available.' % self._codec)
+        # A persistent Connection, if the client should reuse one
+        # socket for all of its calls.
+        self._connection = kwargs.get('connection', None)
+        if kwargs.get('multiplex', False) and not self._connection:
+            self._connection = MultiplexConnection(
+                addr, codec=self._codec, key=self._key, tls=self._tls
+            )
+        elif kwargs.get('persistent', False) and not self._connection:
+            self._connection = Connection(
+                addr, codec=self._codec, key=self._key, tls=self._tls
+            )
+        # A ConnectionPool to check connections out of for each call
+        # -- True uses the shared, default pool.
+        self._pool = kwargs.get('pool', None)
+        if self._pool is True:
+            self._pool = ConnectionPool.instance()
+        if self._key and not config.crypt and not self._session():
             raise EncryptionMissing('No encryption library found.')
+        if self._codec and self._key and not self._session():
+            raise ValueError('Encrypted messages cannot use a binary codec.')
+        framing = config.framing
+        if self._connection:
+            framing = self._connection.framing
+        elif self._pool or self._codec or self._tls:
+            framing = config.framing or 'length'
+        if self._key and framing == 'newline':
+            raise ValueError('Encrypted messages cannot be newline framed.')
+        if self._codec and framing == 'newline':
+            raise ValueError('Binary messages cannot be newline framed.')
+        # The CallHooks told about each call (shared with batches).
+        self._hooks = kwargs.get('hooks', None)
+        if self._hooks is None:
+            self._hooks = []
+        # The ResultCaches of the cached methods / namespaces, and the
+        # cached calls in flight (so identical ones share a request).
+        self._caches = {}
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        
+    def _session(self):
+        """
+        Whether the key encrypts the frames of the (framed) connections
+        with a session cipher, instead of each message with config.crypt.
+        """
+        framed = self._connection or self._pool or config.framing or \
+            config.compression or self._codec or self._tls
+        return bool(self._key and framed and session.offered())
         
     def __getattr__(self, key):
         if key.startswith('_'):
             raise AttributeError('Methods that start with _ are not allowed.')
         req_id = u'%s' % uuid.uuid4()
         request = ClientRequest(self, namespace=key, req_id=req_id)
-        self._requests.append(request)
+        if self._is_batch():
+            self._requests.append(request)
         return request
         
     @property
@@ -60,7 +128,21 @@ class Client(object):
             notify = True,
             req_id = None
         )
-        self._requests.append(request)
+        if self._is_batch():
+            self._requests.append(request)
+        return request
+        
+    @property
+    def _stream(self):
+        """
+        Returns a ClientRequest whose call returns an iterator over the
+        (list) result, which the server streams as it's produced if the
+        handler returns an iterator.
+        """
+        req_id = u'%s' % uuid.uuid4()
+        request = ClientRequest(self, req_id=req_id, stream=True)
+        if self._is_batch():
+            self._requests.append(request)
         return request
         
     def _batch(self):
@@ -69,7 +151,85 @@ class Client(object):
         a series of calls which will only be sent when the Client is
         __call__()ed.
         """
-        return Client(self._addr, batch=True)
+        return self.__class__(
+            self._addr, batch=True, key=self._key,
+            connection=self._connection, pool=self._pool, codec=self._codec,
+            hooks=self._hooks, tls=self._tls or False
+        )
+        
+    def _close(self):
+        """ Closes the persistent connection, if there is one. """
+        if self._connection:
+            self._connection.close()
+        
+    def _add_hook(self, hook):
+        """ Adds a CallHook, to be told about the following calls. """
+        self._hooks.append(hook)
+        
+    def _begin_call(self, requests, batch=False, stream=False):
+        """ Starts the CallInfo for a call, and runs the before hooks. """
+        methods = [request.get('method') for request in requests]
+        notify = len([req for req in requests if 'id' in req]) == 0
+        call = CallInfo(methods, batch, notify, stream)
+        self._run_hooks('before_call', call)
+        return call
+        
+    def _end_call(self, call, error=None):
+        """ Finishes the CallInfo for a call, and runs the after hooks. """
+        call.finish(error)
+        self._run_hooks('after_call', call)
+        
+    def _run_hooks(self, name, call):
+        for hook in self._hooks:
+            try:
+                getattr(hook, name)(call)
+            except Exception:
+                # A broken hook shouldn't break the calls.
+                logger.exception('Error in client %s hook.', name)
+        
+    def _cache(self, name, ttl=None, size=None):
+        """
+        Caches the results of a method, or of all of the methods in a
+        namespace, for ttl seconds (default config.cache_ttl), keeping
+        at most 'size' of them (default config.cache_size). Only single
+        calls are cached, not batches, notifications or streams.
+        """
+        self._caches[name] = ResultCache(ttl, size)
+        
+    def _invalidate(self, name=None):
+        """
+        Drops the cached results of a method or namespace (the name it
+        was cached with), or all of them.
+        """
+        if name is None:
+            caches = list(self._caches.values())
+        else:
+            caches = [self._caches[name]] if name in self._caches else []
+        for cache in caches:
+            cache.invalidate()
+            
+    def _cache_stats(self):
+        """ Returns the hits, misses, etc. of each cache. """
+        return dict([
+            (name, cache.stats()) for name, cache in self._caches.items()
+        ])
+        
+    def _get_cache(self, request):
+        """
+        Returns the ResultCache for a request (checking its namespaces
+        too) and the key for its result, or (None, None).
+        """
+        if not self._caches or 'id' not in request:
+            return None, None
+        name = request['method']
+        while name not in self._caches:
+            if '.' not in name:
+                return None, None
+            name = name.rsplit('.', 1)[0]
+        key = cache_key(request['method'], request.get('params', []), {})
+        if key is None:
+            return None, None
+        return self._caches[name], key
         
     def _is_batch(self):
         """ Checks whether the batch flag is set. """
@@ -90,14 +250,72 @@ class Client(object):
             
     def _call_single(self, request):
         """
-        Processes a single request, and returns the response.
+        Processes a single request, and returns the response -- from
+        the cache, if the method is cached. Identical cached calls made
+        while one is in flight wait for its result, rather than sending
+        their own requests. (Each caller gets a copy of a cached
+        result, so changing it doesn't change the others.)
         """
+        cache, key = self._get_cache(request)
+        if cache is None:
+            return self._call_remote(request)
+        found, result = cache.get(key)
+        if found:
+            return copy.deepcopy(result)
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Waiter()
+        if not leader:
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return copy.deepcopy(flight.response)
+        try:
+            result = self._call_remote(request)
+        except Exception as error:
+            flight.error = error
+            raise
+        else:
+            cache.set(key, result)
+            flight.response = result
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+            flight.event.set()
+        return copy.deepcopy(result)
+        
+    def _call_remote(self, request):
+        """ Sends a single request, and returns the response. """
+        call = self._begin_call([request])
+        try:
+            started = timer()
+            message, notify = self._prepare_single(request)
+            call.encode = timer() - started
+            response_text = self._send_and_receive(
+                message, notify=notify, call=call
+            )
+            started = timer()
+            result = self._finish_single(response_text)
+            call.decode += timer() - started
+        except Exception as error:
+            self._end_call(call, error)
+            raise
+        self._end_call(call)
+        return result
+        
+    def _prepare_single(self, request):
+        """ Encodes a single request, and checks if it's a notification. """
         self._request = request
-        message = json.dumps(request)
+        message = get_codec(self._codec).dumps(request)
         notify = False
         if not 'id' in request:
             notify = True
-        response_text = self._send_and_receive(message, notify=notify)
+        return message, notify
+        
+    def _finish_single(self, response_text):
+        """ Parses and validates a single response, returning the result. """
         response = self._parse_response(response_text)
         if not response:
             return response
@@ -105,89 +323,251 @@ class Client(object):
         validate_response(response)
         return response['result']
         
+    def _call_stream(self, request):
+        """
+        Processes a single request, and returns an iterator over the
+        results as they arrive.
+        """
+        call = self._begin_call([request], stream=True)
+        try:
+            started = timer()
+            message, notify = self._prepare_single(request)
+            trace = history.start('client', message)
+            message = self._encode_message(message)
+            call.encode = timer() - started
+            call.request_size = len(message)
+        except Exception as error:
+            self._end_call(call, error)
+            raise
+        return self._iter_stream(message, call, trace)
+        
+    def _iter_stream(self, message, call, trace=None):
+        """
+        Decodes the response messages of a stream. The call is over
+        when they've all been read (or the iterator is dropped).
+        """
+        error = None
+        try:
+            for response_text in self._send_and_stream(message, call):
+                call.response_size += len(response_text)
+                started = timer()
+                response_text = self._decode_message(response_text)
+                history.finish(trace, response_text)
+                response = self._parse_response(response_text)
+                if 'stream' in response:
+                    results = response['stream']
+                else:
+                    self._response = response
+                    validate_response(response)
+                    # Streams end with a null result, otherwise the
+                    # result wasn't streamed.
+                    results = response['result'] or []
+                call.decode += timer() - started
+                for result in results:
+                    yield result
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            self._end_call(call, error)
+        
+    def _send_and_stream(self, message, call=None):
+        """
+        Like _send_and_receive, but yields each of the (encoded)
+        response messages.
+        """
+        if isinstance(self._connection, MultiplexConnection):
+            for response in self._connection.stream(message, call):
+                yield response
+        elif self._pool:
+            connection = self._pool.checkout(
+                self._addr, self._key, self._codec, self._tls
+            )
+            try:
+                for response in connection.stream(message, call):
+                    yield response
+            finally:
+                self._pool.checkin(connection, self._key)
+        elif self._connection or config.framing or config.compression or \
+            self._codec or self._tls:
+            # A persistent connection would be busy (for other calls,
+            # even from the loop over the results) until the stream is
+            # over, so streams get a connection of their own.
+            framing = self._connection and self._connection.framing
+            connection = Connection(
+                self._addr, framing, codec=self._codec, key=self._key,
+                tls=self._tls
+            )
+            try:
+                for response in connection.stream(message, call):
+                    yield response
+            finally:
+                connection.close()
+        else:
+            yield self._send_message(message, call=call)
+        
     def _call_batch(self, requests):
         """
         Processes a batch, and returns a generator to iterate over the
         response results.
         """
+        call = self._begin_call(requests, batch=True)
+        try:
+            started = timer()
+            message, ids, notify = self._prepare_batch(requests)
+            call.encode = timer() - started
+            response_text = self._send_and_receive(
+                message, batch=True, notify=notify, call=call
+            )
+            started = timer()
+            result = self._finish_batch(response_text, ids)
+            call.decode += timer() - started
+        except Exception as error:
+            self._end_call(call, error)
+            raise
+        self._end_call(call)
+        return result
+        
+    def _prepare_batch(self, requests):
+        """
+        Encodes a batch, returning the ids of the requests that expect
+        a response, and whether it's all notifications.
+        """
         ids = []
         for request in requests:
-            if request.has_key('id'):
+            if 'id' in request:
                 ids.append(request['id'])
         self._request = requests
-        message = json.dumps(requests)
+        message = get_codec(self._codec).dumps(requests)
         notify = False
         if len(ids) == 0:
             notify = True
-        response_text = self._send_and_receive(
-            message, batch=True, notify=notify
-        )
+        return message, ids, notify
+        
+    def _finish_batch(self, response_text, ids):
+        """ Parses the batch responses. """
         responses = self._parse_response(response_text)
         if responses is None:
             responses = []
         assert type(responses) is list
         return BatchResponses(responses, ids)
     
-    def _send_and_receive(self, message, batch=False, notify=False):
+    def _send_and_receive(self, message, batch=False, notify=False,
+        call=None):
         """
         Handles the socket connection, sends the JSON request, and
         (if not a notification) retrieves the response and decodes the
-        JSON text.
+        JSON text. The sizes and timings are recorded on the CallInfo.
         """
-        # Starting with a clean history
-        history.request = message
-        logger.debug('CLIENT | REQUEST: %s' % message)
-        if self._key:
+        if call is None:
+            call = CallInfo()
+        started = timer()
+        trace = history.start('client', message)
+        message = self._encode_message(message)
+        call.encode += timer() - started
+        call.request_size = len(message)
+        if self._connection:
+            response = self._connection.request(message, notify, call)
+        elif self._pool:
+            connection = self._pool.checkout(
+                self._addr, self._key, self._codec, self._tls
+            )
+            try:
+                response = connection.request(message, call=call)
+            finally:
+                self._pool.checkin(connection, self._key)
+        elif config.framing or config.compression or self._codec or \
+            self._tls:
+            # A framed connection just for this call, so the end of
+            # the response doesn't have to be guessed.
+            connection = Connection(
+                self._addr, codec=self._codec, key=self._key, tls=self._tls
+            )
+            try:
+                response = connection.request(message, call=call)
+            finally:
+                connection.close()
+        else:
+            response = self._send_message(message, notify, call)
+        call.response_size = len(response)
+        started = timer()
+        response = self._decode_message(response)
+        history.finish(trace, response)
+        call.decode += timer() - started
+        return response
+        
+    def _encode_message(self, message):
+        """ Logs the request text, and encodes / encrypts it. """
+        log_message('CLIENT | REQUEST', message)
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8')
+        if self._key and not self._session():
             crypt = config.crypt.new(self._key)
             length = config.crypt_chunk_size
             pad_length = length - (len(message) % length)
-            message = crypt.encrypt('%s%s' % (message, ' '*pad_length))
+            message = crypt.encrypt(message + b' '*pad_length)
+        return message
+        
+    def _decode_message(self, response):
+        """ Decrypts / decodes the response, and logs the text. """
+        if self._key and response and not self._session():
+            crypt = config.crypt.new(self._key)
+            try:
+                response = crypt.decrypt(response)
+            except ValueError:
+                # What exactly is an intuitive response to a poorly- or
+                # not-encrypted response to an encrypted request?
+                raise ProtocolError(-32700, 'Response not encrypted properly.')
+            # Should we do a preliminary json.loads here to verify that the
+            # decryption succeeded?
+        if sys.version_info[0] == 2:
+            # Python 2's json module only reads strings.
+            response = bytes(response)
+        elif not self._codec:
+            response = response.decode('utf-8')
+        log_message('CLIENT | RESPONSE', response)
+        return response
+        
+    def _send_message(self, message, notify=False, call=None):
+        """
+        Sends the message over a new socket and reads the response
+        until the server closes the connection (or stops sending).
+        """
+        started = timer()
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(config.timeout)
         sock.connect(self._addr)
-        if sys.version_info[0] == 2:
-            sock.send(message)
-        else:
-            sock.send(message.encode('utf-8'))
+        connected = timer()
+        # (A single send could write only part of the message.)
+        sock.sendall(message)
+        sent = timer()
         
-        responselist = []
+        # The response is read straight onto the end of one buffer,
+        # instead of being joined together from chunks.
+        response = bytearray()
         if notify:
             # single notification, we don't need a response.
             sock.close()
         else:
             while True:
                 try:
-                    data = sock.recv(config.buffer)
+                    count = recv_chunk(sock, response, config.buffer)
                 except socket.timeout:
                     break
-                if not data: 
-                    break
-                responselist.append(data)
-                if len(data) < config.buffer:
+                if count < config.buffer:
                     break
             sock.close()
-        if sys.version_info[0] == 2:
-            response = ''.join(responselist)
-        else:
-            response = b''.join(responselist)
-        if self._key:
-            try:
-                response = crypt.decrypt(response)
-            except ValueError:
-                # What exactly is an intuitive response to a poorly- or
-                # not-encrypted response to an encrypted request?
-                raise ProtocolError(-32700, 'Response not encrypted properly.')
-            # Should we do a preliminary json.loads here to verify that the
-            # decryption succeeded?
-        logger.debug('CLIENT | RESPONSE: %s' % response)
-        history.response = response
+        if call is not None:
+            call.connect = connected - started
+            call.send = sent - connected
+            call.wait = timer() - sent
         return response
         
     def _parse_response(self, response):
-        if response == '':
+        if not response:
             return None
         try:
-            obj = json.loads(response)
+            obj = get_codec(self._codec).loads(response)
         except ValueError:
             raise ProtocolError(-32700)
         if obj == dict() and 'error' in obj:
@@ -240,11 +620,13 @@ class ClientRequest(object):
     the parent Client.
     """
 
-    def __init__(self, client, namespace='', notify=False, req_id=None):
+    def __init__(self, client, namespace='', notify=False, req_id=None,
+        stream=False):
         self._client = client
         self._namespace = namespace
         self._notification = notify
         self._req_id = req_id
+        self._stream = stream
         self._params = None
 
     def __getattr__(self, key):
@@ -273,7 +655,11 @@ class ClientRequest(object):
         """
         self._params = params
         if not self._client._is_batch():
-            return self._client()
+            # Single calls don't touch the client's request list, so
+            # one (non-batch) client can be shared between threads.
+            if self._stream:
+                return self._client._call_stream(self._request())
+            return self._client._call_single(self._request())
         # Add batch logic here
         
     def _request(self):
@@ -287,11 +673,24 @@ class ClientRequest(object):
             request['id'] = self._req_id
         return request
         
-def connect(host, port, key=None):
+def connect(host, port, key=None, persistent=False, pool=None,
+    multiplex=False, codec=None, hooks=None, tls=None):
     """
-    This is a wrapper function for the Client class.
+    This is a wrapper function for the Client class. If 'persistent'
+    is set, all of the calls share one (framed) connection. If 'pool'
+    is set (True for the shared, default ConnectionPool), each call
+    checks a connection out of the pool instead. If 'multiplex' is set,
+    calls from any number of threads share one connection without
+    waiting for each other's responses. 'codec' ('msgpack' or 'cbor')
+    sends binary messages instead of JSON, if the server agrees to it.
+    'hooks' is a list of CallHooks, told about each call. 'tls' (True,
+    or an ssl.SSLContext) connects over TLS -- by default, if config.tls
+    is set.
     """
-    client = Client((host, port), key=key)
+    client = Client(
+        (host, port), key=key, persistent=persistent, pool=pool,
+        multiplex=multiplex, codec=codec, hooks=hooks, tls=tls
+    )
     return client
     
 def validate_response(response):
@@ -0,0 +1,263 @@
+"""
+The JSON encoders / decoders. The standard library json module (or
+simplejson) is always available, and faster backends (orjson, msgspec,
+ujson) are used if they are installed. config.codec picks one by name,
+or 'auto' picks the fastest one available.
+
+All of them produce the same JSON-RPC messages on the wire -- they may
+differ in whitespace, key order or escaping, but that doesn't change
+what the other end decodes. Anything a fast backend can't encode (like
+non-string dict keys, or integers over 64 bits) falls back to the
+standard library.
+
+There are also binary codecs (MessagePack, with msgpack, and CBOR, with
+cbor2) for the same JSON-RPC envelope. They're smaller and quicker to
+decode for bulk numeric and bytes payloads, but both ends have to agree
+on them, so they're only used on framed connections that negotiated
+them (see the codec option of connect).
+
+A handler that returns the same large result over and over can wrap it
+in Encoded, which is encoded the first time it's sent (once for each
+kind of codec) and spliced into each response as it is:
+
+    CONFIG = Encoded(big_config_dict)
+    RAW = Encoded(json=b'{"already": "serialized"}')
+"""
+import struct
+from jsonrpctcp import config
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class JSONCodec(object):
+    """
+    The standard library codec, and the base for the others. dumps()
+    returns str or bytes, depending on the backend, and loads() takes
+    either, raising a ValueError for invalid JSON.
+    """
+    name = 'json'
+    binary = False
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def envelope(self, result, request_id, member='result'):
+        """
+        Returns the (bytes) response message for an already encoded
+        result (or 'error' object), without encoding it again.
+        """
+        return b''.join([
+            b'{"jsonrpc": "2.0", "', member.encode('ascii'), b'": ', result,
+            b', "id": ', to_bytes(self.dumps(request_id)), b'}'
+        ])
+
+    def join(self, messages):
+        """ Returns the (bytes) batch message for encoded responses. """
+        return b'[' + b', '.join([to_bytes(m) for m in messages]) + b']'
+
+class OrjsonCodec(JSONCodec):
+    """ orjson -- encodes straight to (UTF-8) bytes. """
+    name = 'orjson'
+
+    def dumps(self, obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return json.dumps(obj)
+
+    def loads(self, data):
+        # orjson.JSONDecodeError is a ValueError.
+        return orjson.loads(data)
+
+class MsgspecCodec(JSONCodec):
+    """ msgspec's JSON codec -- also encodes to bytes. """
+    name = 'msgspec'
+
+    def __init__(self):
+        self.encoder = msgspec.json.Encoder()
+        self.decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj):
+        try:
+            return self.encoder.encode(obj)
+        except (TypeError, OverflowError):
+            return json.dumps(obj)
+
+    def loads(self, data):
+        try:
+            return self.decoder.decode(data)
+        except msgspec.DecodeError as error:
+            raise ValueError(str(error))
+
+class UjsonCodec(JSONCodec):
+    """ ujson -- encodes to str, like the standard library. """
+    name = 'ujson'
+
+    def dumps(self, obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii=False)
+        except (TypeError, OverflowError):
+            return json.dumps(obj)
+
+    def loads(self, data):
+        if isinstance(data, bytearray):
+            data = bytes(data)
+        return ujson.loads(data)
+
+class MsgpackCodec(JSONCodec):
+    """ MessagePack, a binary codec. """
+    name = 'msgpack'
+    binary = True
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as error:
+            raise ValueError(str(error))
+
+    def envelope(self, result, request_id, member='result'):
+        # A map of three entries, in the same order as the JSON.
+        return b''.join([
+            b'\x83', self.dumps('jsonrpc'), self.dumps('2.0'),
+            self.dumps(member), result, self.dumps('id'),
+            self.dumps(request_id)
+        ])
+
+    def join(self, messages):
+        header = msgpack.Packer().pack_array_header(len(messages))
+        return header + b''.join(messages)
+
+class CBORCodec(JSONCodec):
+    """ CBOR, a binary codec. """
+    name = 'cbor'
+    binary = True
+
+    def dumps(self, obj):
+        return cbor2.dumps(obj)
+
+    def loads(self, data):
+        try:
+            return cbor2.loads(data)
+        except Exception as error:
+            raise ValueError(str(error))
+
+    def envelope(self, result, request_id, member='result'):
+        # A map of three entries, in the same order as the JSON.
+        return b''.join([
+            b'\xa3', self.dumps('jsonrpc'), self.dumps('2.0'),
+            self.dumps(member), result, self.dumps('id'),
+            self.dumps(request_id)
+        ])
+
+    def join(self, messages):
+        # The array header (major type 4) for the number of items
+        count = len(messages)
+        if count < 24:
+            header = struct.pack('!B', 0x80 + count)
+        elif count < 0x100:
+            header = struct.pack('!BB', 0x98, count)
+        elif count < 0x10000:
+            header = struct.pack('!BH', 0x99, count)
+        else:
+            header = struct.pack('!BI', 0x9a, count)
+        return header + b''.join(messages)
+
+# The codecs that can be used here -- the JSON ones fastest first.
+CODECS = {'json': JSONCodec}
+AUTO_CODECS = []
+for codec_class, module in (
+    (OrjsonCodec, orjson), (MsgspecCodec, msgspec), (UjsonCodec, ujson)
+):
+    if module is not None:
+        CODECS[codec_class.name] = codec_class
+        AUTO_CODECS.append(codec_class.name)
+AUTO_CODECS.append('json')
+BINARY_CODECS = []
+for codec_class, module in ((MsgpackCodec, msgpack), (CBORCodec, cbor2)):
+    if module is not None:
+        CODECS[codec_class.name] = codec_class
+        BINARY_CODECS.append(codec_class.name)
+
+_codecs = {}
+
+def get_codec(name=None):
+    """
+    Returns the codec with the given name (config.codec by default).
+    """
+    name = name or config.codec
+    if name == 'auto':
+        name = AUTO_CODECS[0]
+    codec = _codecs.get(name)
+    if codec is None:
+        if name not in CODECS:
+            raise ValueError('Codec %s is not available.' % name)
+        codec = _codecs[name] = CODECS[name]()
+    return codec
+
+def to_bytes(data):
+    """ Encodes text (from the codecs that return str) as UTF-8. """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+class Encoded(object):
+    """
+    A handler result that's only encoded once -- the encoded bytes are
+    kept (for the JSON codecs, which all produce the same JSON, and for
+    each binary codec) and spliced into the responses. It can also be
+    made from JSON that's already encoded (json=...).
+    """
+
+    def __init__(self, obj=None, json=None):
+        self._obj = obj
+        self._encoded = {}
+        if json is not None:
+            self._encoded['json'] = to_bytes(json)
+
+    @property
+    def obj(self):
+        """ The result object (decoded from the JSON if necessary). """
+        if self._obj is None and 'json' in self._encoded:
+            self._obj = json.loads(self._encoded['json'].decode('utf-8'))
+        return self._obj
+
+    def encode(self, codec):
+        """ Returns the result encoded (bytes) with the codec. """
+        name = codec.binary and codec.name or 'json'
+        encoded = self._encoded.get(name)
+        if encoded is None:
+            encoded = self._encoded[name] = to_bytes(codec.dumps(self.obj))
+        return encoded
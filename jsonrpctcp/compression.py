@@ -0,0 +1,260 @@
+"""
+Message compression for framed connections. zlib is always available,
+and zstd (with zstandard) and lz4 are used if they are installed. The
+client offers the ones it wants (config.compression) when it opens the
+connection, and the server picks the first one it has.
+
+Once a connection has negotiated compression, each framed message
+starts with a flag byte -- messages under config.compress_threshold
+bytes are sent as they are, since compressing them costs more time
+than it saves. Compressed messages are decompressed piece by piece as
+they come off of the socket, rather than after the whole frame has
+been read.
+"""
+import sys
+import zlib
+from jsonrpctcp import config
+from jsonrpctcp.errors import ProtocolError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+PLAIN = b'\x00'
+COMPRESSED = b'\x01'
+# How much of a message is compressed at a time.
+CHUNK_SIZE = 64 * 1024
+
+class ZlibCompression(object):
+    """ zlib (deflate), and the base for the others. """
+    name = 'zlib'
+
+    def compressor(self):
+        # The fastest level -- most of the gain on JSON, for a fraction
+        # of the time of the default.
+        return zlib.compressobj(1)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+    def decompress(self, decompressor, data, max_length):
+        """
+        Decompresses a chunk, returning at most max_length bytes (the
+        rest stays in the decompressor).
+        """
+        return decompressor.decompress(data, max_length)
+
+class ZstdCompression(ZlibCompression):
+    """ Zstandard -- better and faster than zlib. """
+    name = 'zstd'
+
+    def compressor(self):
+        return zstandard.ZstdCompressor().compressobj()
+
+    def decompressor(self):
+        return ZstdDecompressor()
+
+class LZ4Compression(ZlibCompression):
+    """ LZ4 frames -- the fastest, but compresses the least. """
+    name = 'lz4'
+
+    def compressor(self):
+        return LZ4Compressor()
+
+    def decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, decompressor, data, max_length):
+        return decompressor.decompress(data, max_length=max_length)
+
+class LZ4Compressor(object):
+    """ Gives the lz4 frame compressor the zlib compressobj interface. """
+
+    def __init__(self):
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        header, self.header = self.header, b''
+        return header + self.compressor.flush()
+
+class ZstdDecompressor(object):
+    """
+    Gives the zstandard decompressor a zlib decompress(data, max_length)
+    -- zstandard's decompressobj can't be limited, so this decompresses
+    through a stream_writer instead, which hands over the output a
+    piece at a time, and stops it as soon as it goes past the limit.
+    The stream_writer doesn't say where the frame ends, so that (eof)
+    comes from following the frame's block headers.
+    """
+
+    def __init__(self):
+        self.output = bytearray()
+        self.limit = 0
+        self.writer = zstandard.ZstdDecompressor().stream_writer(self)
+        self.eof = False
+        # The frame (header and blocks) left to skip over.
+        self.pending = bytearray()
+        self.skip = 0
+        self.checksum = None
+        self.last = False
+
+    def write(self, data):
+        self.output += data
+        if len(self.output) > self.limit:
+            raise ProtocolError(-32700, 'Frame too large.')
+        return len(data)
+
+    def decompress(self, data, max_length):
+        self.limit = max_length
+        self.writer.write(data)
+        self.follow(data)
+        output, self.output = self.output, bytearray()
+        return output
+
+    def follow(self, data):
+        """ Skips through the frame, to see whether it's finished. """
+        self.pending += data
+        while not self.eof:
+            if self.skip:
+                count = min(self.skip, len(self.pending))
+                del self.pending[:count]
+                self.skip -= count
+                if self.skip:
+                    return
+            elif self.checksum is None:
+                if len(self.pending) < 5:
+                    return
+                self.checksum = bool(self.pending[4] & 4)
+                self.skip = zstandard.frame_header_size(
+                    bytes(self.pending[:5])
+                )
+            elif self.last:
+                self.eof = True
+            else:
+                if len(self.pending) < 3:
+                    return
+                header = self.pending[0] | self.pending[1] << 8 | \
+                    self.pending[2] << 16
+                # An RLE block (type 1) is one byte, repeated.
+                size = 1 if (header >> 1) & 3 == 1 else header >> 3
+                self.skip = 3 + size
+                if header & 1:
+                    self.last = True
+                    self.skip += 4 if self.checksum else 0
+
+# The compression methods that can be used here, best first.
+COMPRESSIONS = {}
+AUTO_COMPRESSIONS = []
+for compression_class, module in (
+    (ZstdCompression, zstandard), (LZ4Compression, lz4),
+    (ZlibCompression, zlib)
+):
+    if module is not None:
+        COMPRESSIONS[compression_class.name] = compression_class()
+        AUTO_COMPRESSIONS.append(compression_class.name)
+
+def offered():
+    """ The compression methods a client offers (config.compression). """
+    if not config.compression:
+        return []
+    if config.compression == 'auto':
+        return list(AUTO_COMPRESSIONS)
+    return [
+        name for name in config.compression.split(',')
+        if name in COMPRESSIONS
+    ]
+
+def compress(message, name):
+    """
+    Returns the flagged message (bytes) for a connection using the
+    named compression -- only compressed if it is large enough.
+    """
+    return b''.join(compress_pieces([message], name))
+
+def compress_pieces(pieces, name):
+    """
+    Like compress, for a message in several pieces, returning the
+    flagged message in pieces too (so they don't have to be joined).
+    """
+    if sum([len(piece) for piece in pieces]) < config.compress_threshold:
+        return [PLAIN] + list(pieces)
+    compressor = COMPRESSIONS[name].compressor()
+    compressed = [COMPRESSED]
+    for piece in pieces:
+        view = piece
+        if sys.version_info[0] > 2:
+            # Compress the chunks without copying them out first.
+            view = memoryview(piece)
+        for start in range(0, len(piece), CHUNK_SIZE):
+            compressed.append(
+                compressor.compress(view[start:start+CHUNK_SIZE])
+            )
+    compressed.append(compressor.flush())
+    return compressed
+
+class Decoder(object):
+    """
+    Decodes a flagged message as it arrives -- feed() it the pieces,
+    then finish() returns the whole (decompressed) message. A message
+    can't expand past config.max_frame, since no more than that is
+    decompressed.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.compression = COMPRESSIONS[name]
+        self.decompressor = None
+        self.flag = None
+        self.message = bytearray()
+
+    def feed(self, data):
+        if not data:
+            return
+        if self.flag is None:
+            self.flag = data[:1]
+            data = data[1:]
+            if self.flag == COMPRESSED:
+                self.decompressor = self.compression.decompressor()
+            elif self.flag != PLAIN:
+                raise ProtocolError(-32700, 'Invalid compression flag.')
+        if self.decompressor:
+            if sys.version_info[0] == 2:
+                # Python 2's zlib only reads strings.
+                data = bytes(data)
+            # One byte over the limit is enough to know it's too large.
+            limit = config.max_frame - len(self.message) + 1
+            try:
+                data = self.compression.decompress(
+                    self.decompressor, data, limit
+                )
+            except ProtocolError:
+                raise
+            except Exception:
+                raise ProtocolError(-32700, 'Could not decompress message.')
+        self.message += data
+        if len(self.message) > config.max_frame:
+            raise ProtocolError(-32700, 'Frame too large.')
+
+    def finish(self):
+        if self.flag is None:
+            raise ProtocolError(-32700, 'Missing compression flag.')
+        if self.decompressor and not getattr(self.decompressor, 'eof', True):
+            raise ProtocolError(-32700, 'Truncated compressed message.')
+        return self.message
+
+def decompress(message, name):
+    """ Decodes a whole flagged message. """
+    decoder = Decoder(name)
+    decoder.feed(message)
+    return decoder.finish()
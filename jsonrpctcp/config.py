@@ -32,8 +32,84 @@ class Config(object):
         # 'crypt_chunk_size' is the size of the message chunk required 
         # by the cipher.
         self.crypt_chunk_size = 16
+        # The AEAD ciphers ('aesgcm' or 'chacha20', or both separated by
+        # commas) framed client connections with a key offer for session
+        # encryption (see the session module) -- 'auto' offers the ones
+        # installed, and None encrypts each message with 'crypt' instead.
+        self.session_cipher = 'auto'
+        # Whether servers and clients use TLS (see the tls module), the
+        # server's certificate chain and key files, the CA certificates
+        # clients check servers against (None for the system's), and
+        # whether clients check the server's host name.
+        self.tls = False
+        self.tls_certfile = None
+        self.tls_keyfile = None
+        self.tls_cafile = None
+        self.tls_check_hostname = True
+        # The JSON codec ('json', 'orjson', 'msgspec' or 'ujson') --
+        # 'auto' uses the fastest one installed.
+        self.codec = 'auto'
         # Maximum number of queued connections
         self.max_queue = 10
+        # Number of Server worker threads -- None starts a new thread
+        # for every connection instead of using a pool.
+        self.pool_size = None
+        # Maximum number of accepted connections waiting for a worker.
+        self.pool_queue = 100
+        # Framing used by client connections ('length', 'netstring' or
+        # 'newline'). If it's None, persistent connections use 'length'
+        # and other calls use the plain, unframed protocol.
+        self.framing = None
+        # Largest framed message accepted, in bytes.
+        self.max_frame = 64 * 1024 * 1024
+        # Compression offered by client connections ('zstd', 'lz4' or
+        # 'zlib', or several of them separated by commas) -- 'auto'
+        # offers all of the ones installed, and None turns it off.
+        self.compression = None
+        # Smallest framed message (in bytes) that gets compressed.
+        self.compress_threshold = 4096
+        # Items sent in each frame of a streamed (iterator) result.
+        self.stream_chunk = 100
+        # How long (in seconds) the server keeps an idle framed
+        # connection open waiting for the next request.
+        self.keepalive_timeout = 60
+        # Worker threads running the requests of all the multiplexed
+        # connections (or concurrent coroutines for each one, for the
+        # asyncio server).
+        self.multiplex_workers = 8
+        # Most entries of one batch request run at once -- with 1, they
+        # run one after another.
+        self.batch_concurrency = 1
+        # Threads shared by the (threaded) server's concurrent batches.
+        self.batch_workers = 16
+        # Whether the request / response messages are logged (at the
+        # debug level) -- False skips them entirely.
+        self.log_messages = True
+        # Longest message logged, in characters (None for no limit).
+        self.log_truncate = 1000
+        # Whether requests and responses are traced (see the history
+        # module) -- it's for debugging, so it's off by default.
+        self.trace = False
+        # The fraction of the traced requests kept in the ring buffer,
+        # and how many of them it holds.
+        self.trace_sample = 1.0
+        self.trace_size = 100
+        # How long (in seconds) cached handler results are kept, and
+        # how many of them, for each cached method (see the cache
+        # module).
+        self.cache_ttl = 60
+        self.cache_size = 1000
+        # Whether servers record request metrics (see server.stats()).
+        self.metrics = True
+        # The name of a built-in method that returns the server stats
+        # (like 'system.stats') -- None leaves it out. Anyone who can
+        # connect can call it, so it's off unless configured.
+        self.stats_method = None
+        # Most idle client connections pooled per (host, port, key).
+        self.connection_pool_size = 10
+        # How long (in seconds) a pooled client connection can sit
+        # idle -- it should be shorter than the server's keepalive.
+        self.connection_idle_timeout = 30
     
     @classmethod
     def instance(cls):
@@ -0,0 +1,467 @@
+"""
+The framed client connection. One socket carries any number of framed
+request / response exchanges, instead of the one-shot connect / send /
+receive-until-it-stops / close cycle of a normal Client. Connections
+can be shared between clients (and threads) through a ConnectionPool.
+"""
+import socket
+import select
+import threading
+import time
+import itertools
+from jsonrpctcp import config
+from jsonrpctcp import framing as framing_module
+from jsonrpctcp.framing import FrameReader, frame_parts, send_parts
+from jsonrpctcp.framing import handshake, parse_handshake, TAG
+from jsonrpctcp.framing import split_tag, split_flag, MORE, FINAL
+from jsonrpctcp import compression
+from jsonrpctcp import session
+from jsonrpctcp.tls import TLSSessions
+from jsonrpctcp.errors import ProtocolError
+from jsonrpctcp.metrics import timer
+
+class Connection(object):
+    """
+    A framed connection to a server. It connects lazily, and
+    reconnects (once) if a reused socket turns out to have been closed
+    by the server in the meantime.
+    """
+
+    def __init__(self, addr, framing=None, codec=None, key=None, tls=None):
+        framing = framing or config.framing or 'length'
+        assert framing in framing_module.FRAMINGS
+        self.addr = addr
+        self.framing = framing
+        # The binary codec to negotiate, if any
+        self.codec = codec
+        # The secret, for session encryption (if a cipher is installed)
+        self.key = key
+        # The SSLContext, for TLS connections
+        self.tls = tls
+        self.socket = None
+        self.reader = None
+        self.requests = 0
+        self.bytes_sent = 0
+        # Whether the server agreed to stream results.
+        self.streams = False
+        self._lock = threading.Lock()
+
+    def open(self):
+        """ Connects and negotiates the connection options. """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(config.timeout)
+        sock.connect(self.addr)
+        if self.tls is not None:
+            try:
+                sock = TLSSessions.instance().wrap(sock, self.addr, self.tls)
+            except socket.error:
+                sock.close()
+                raise
+        self.socket = sock
+        self.reader = FrameReader(sock, self.framing)
+        self.requests = 0
+        offer = self.options()
+        sock.sendall(handshake(**offer))
+        options = parse_handshake(self.reader.read_line())
+        if options.get('framing') != self.framing:
+            self.close()
+            raise ProtocolError(
+                -32700, 'Server refused %s framing.' % self.framing
+            )
+        if options.get('codec') != self.codec:
+            self.close()
+            raise ProtocolError(
+                -32700, 'Server refused the %s codec.' % self.codec
+            )
+        self.reader.compress = options.get('compress')
+        try:
+            self.reader.session = session.start(
+                self.key, offer, options, 'client'
+            )
+        except ProtocolError:
+            self.close()
+            raise
+        self.streams = options.get('stream') == '1'
+        return options
+
+    def options(self):
+        """ The connection options offered to the server. """
+        options = {'framing': self.framing}
+        if self.codec:
+            options['codec'] = self.codec
+        if compression.offered():
+            options['compress'] = compression.offered()
+        if self.key and session.offered():
+            options['cipher'] = session.offered()
+            options['nonce'] = session.new_nonce()
+        options['stream'] = 1
+        return options
+
+    def close(self):
+        """ Closes the socket (it will reconnect on the next request). """
+        if self.socket:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+        self.socket = None
+        self.reader = None
+
+    def request(self, message, notify=False, call=None):
+        """
+        Sends a message (bytes) and returns the response message. It is
+        empty if the message was a notification. The timings are
+        recorded on the (client's) CallInfo, if there is one.
+        """
+        with self._lock:
+            more, response = self._exchange(message, FINAL, call)
+            return response
+
+    def stream(self, message, call=None):
+        """
+        Sends a message (bytes), and yields the response messages as
+        they arrive -- several, if the server streams the result. The
+        connection is busy until they have all been read, so it should
+        be one that nothing else is using (a checked out one).
+        """
+        with self._lock:
+            more, response = self._exchange(message, MORE, call)
+            try:
+                yield response
+                while more:
+                    started = timer()
+                    more, response = self._read_response()
+                    if call is not None:
+                        call.wait += timer() - started
+                    yield response
+            finally:
+                if more:
+                    # Abandoned part way through, so the rest of the
+                    # response would be read by the next request.
+                    self.close()
+
+    def _exchange(self, message, flag, call=None):
+        """
+        Sends the message, and returns its (first) response. It is only
+        sent again (on a fresh connection) if the server had dropped
+        the idle one before it was sent -- once it has been, the server
+        may have run it, so a failure reading the response isn't
+        retried.
+        """
+        if self.socket is not None and not self.is_alive():
+            self.close()
+        reused = self.socket is not None
+        try:
+            sent = self._send_request(message, flag, call)
+        except (socket.timeout, ProtocolError):
+            self.close()
+            raise
+        except socket.error:
+            self.close()
+            if not reused:
+                raise
+            # The server probably dropped the idle connection, so
+            # try again on a fresh one.
+            try:
+                sent = self._send_request(message, flag, call)
+            except (socket.error, ProtocolError):
+                self.close()
+                raise
+        try:
+            response = self._read_response()
+        except (socket.error, ProtocolError):
+            # The connection is out of sync now, so it can't be reused.
+            self.close()
+            raise
+        if not self.requests:
+            self._save_session()
+        self.requests += 1
+        if call is not None:
+            call.wait = timer() - sent
+        return response
+
+    def _send_request(self, message, flag, call=None):
+        """ Sends the message (connecting first if necessary). """
+        started = opened = timer()
+        if not self.socket:
+            self.open()
+            opened = timer()
+            if call is not None:
+                call.connect = opened - started
+        pieces = [message]
+        if self.streams:
+            pieces = [flag, message]
+        self._send_parts(pieces)
+        sent = timer()
+        if call is not None:
+            call.send = sent - opened
+        return sent
+
+    def _save_session(self):
+        """ Keeps the TLS session (once there's a ticket) for resuming. """
+        if self.tls is not None:
+            TLSSessions.instance().save(self.socket, self.addr, self.tls)
+
+    def _send_parts(self, pieces):
+        """ Frames and sends a message, given in pieces. """
+        parts = frame_parts(
+            pieces, self.framing, self.reader.compress, self.reader.session
+        )
+        self.bytes_sent += send_parts(self.socket, parts)
+
+    def _read_response(self):
+        """ Reads a response, and whether there is more of it coming. """
+        response = self.reader.read_frame()
+        if response is None:
+            raise socket.error('Connection closed by server.')
+        if not self.streams:
+            return False, response
+        return split_flag(response)
+
+    def is_alive(self):
+        """
+        Checks that the (idle) socket is still open -- if it is
+        readable, the server has closed it (or sent something it
+        shouldn't have), so it can't be reused.
+        """
+        if not self.socket:
+            return False
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+        except (socket.error, ValueError):
+            return False
+        return not readable
+
+class MultiplexConnection(Connection):
+    """
+    A framed connection that doesn't wait for one response before
+    sending the next request -- any number of threads can have calls
+    in flight on it at once. Every frame starts with a tag, which the
+    server copies onto the response frame, and a reader thread hands
+    each response to the call waiting for that tag. (The JSON-RPC ids
+    can't be used for this, since the frames may be encrypted, and a
+    batch response has several ids or none.)
+    """
+
+    def __init__(self, addr, framing=None, codec=None, key=None, tls=None):
+        Connection.__init__(self, addr, framing, codec, key, tls)
+        assert self.framing != 'newline'
+        # A TLS socket can't be read by one thread while another writes.
+        if tls is not None:
+            raise ValueError('TLS connections cannot be multiplexed.')
+        self._tags = itertools.count(1)
+        self._pending = {}
+
+    def options(self):
+        """ The connection options offered to the server. """
+        options = Connection.options(self)
+        options['multiplex'] = 1
+        return options
+
+    def open(self):
+        """ Connects, and starts the thread reading the responses. """
+        options = Connection.open(self)
+        if options.get('multiplex') != '1':
+            self.close()
+            raise ProtocolError(-32700, 'Server refused multiplexing.')
+        # The reader thread waits for as long as the connection is
+        # open -- the calls have their own timeouts.
+        self.socket.settimeout(None)
+        thread = threading.Thread(
+            target=self._read_responses, args=(self.socket, self.reader)
+        )
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        """ Closes the socket, which also stops the reader thread. """
+        if self.socket:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        Connection.close(self)
+
+    def request(self, message, notify=False, call=None):
+        """
+        Sends a message (bytes) and waits for its response, unless it
+        is a notification, which doesn't get one.
+        """
+        waiter = Waiter()
+        with self._lock:
+            reused = self.socket is not None
+            tag = next(self._tags) % 2 ** 32
+            if not notify:
+                self._pending[tag] = waiter
+            try:
+                self._send(tag, message, waiter, call)
+            except socket.error:
+                self.close()
+                if not reused:
+                    self._pending.pop(tag, None)
+                    raise
+                # The server probably dropped the idle connection, so
+                # try again on a fresh one.
+                try:
+                    self._send(tag, message, waiter, call)
+                except socket.error:
+                    self._pending.pop(tag, None)
+                    self.close()
+                    raise
+        if notify:
+            return b''
+        sent = timer()
+        if not waiter.event.wait(config.timeout):
+            with self._lock:
+                self._pending.pop(tag, None)
+            raise socket.timeout('Timed out waiting for a response.')
+        if call is not None:
+            call.wait = timer() - sent
+        if waiter.error:
+            raise waiter.error
+        return waiter.response
+
+    def stream(self, message, call=None):
+        """ Results aren't streamed on multiplexed connections. """
+        yield self.request(message, call=call)
+
+    def _send(self, tag, message, waiter, call=None):
+        started = opened = timer()
+        if not self.socket:
+            self.open()
+            opened = timer()
+            if call is not None:
+                call.connect = opened - started
+        waiter.socket = self.socket
+        self._send_parts([TAG.pack(tag), message])
+        self.requests += 1
+        if call is not None:
+            call.send = timer() - opened
+
+    def _read_responses(self, sock, reader):
+        """ The reader thread loop, matching responses to calls. """
+        while True:
+            try:
+                message = reader.read_frame()
+            except (socket.error, ProtocolError):
+                message = None
+            if message is None:
+                break
+            tag, message = split_tag(message)
+            tag, = TAG.unpack(tag)
+            with self._lock:
+                waiter = self._pending.pop(tag, None)
+            if waiter:
+                waiter.response = message
+                waiter.event.set()
+        # The connection is gone, so fail everything still waiting on it.
+        with self._lock:
+            if self.socket is sock:
+                self.close()
+            waiters = []
+            for tag, waiter in list(self._pending.items()):
+                if waiter.socket is sock:
+                    waiters.append(self._pending.pop(tag))
+        for waiter in waiters:
+            waiter.error = socket.error('Connection closed by server.')
+            waiter.event.set()
+
+class Waiter(object):
+    """ A call waiting on a MultiplexConnection response. """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.socket = None
+        self.response = None
+        self.error = None
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of idle Connections, shared by any number of
+    Client instances. Connections are keyed by (host, port, key, codec),
+    and checked out for a single call at a time.
+    """
+    _instance = None
+
+    def __init__(self, max_size=None, idle_timeout=None):
+        if max_size is None:
+            max_size = config.connection_pool_size
+        if idle_timeout is None:
+            idle_timeout = config.connection_idle_timeout
+        # Most idle connections kept for each key
+        self.max_size = max_size
+        # Seconds before an idle connection is closed
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.evicted = 0
+
+    @classmethod
+    def instance(cls):
+        """ Retrieves the shared, default pool """
+        if not cls._instance:
+            cls._instance = cls()
+        return cls._instance
+
+    def checkout(self, addr, key=None, codec=None, tls=None):
+        """
+        Returns an idle connection to the address if there is a
+        healthy one, or a new one otherwise.
+        """
+        pool_key = (addr[0], addr[1], key, codec, tls)
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(pool_key, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used > self.idle_timeout or \
+                    not connection.is_alive():
+                    connection.close()
+                    self.evicted += 1
+                    continue
+                self.hits += 1
+                return connection
+            self.misses += 1
+            self.created += 1
+        return Connection(addr, codec=codec, key=key, tls=tls)
+
+    def checkin(self, connection, key=None):
+        """
+        Returns a connection to the pool. Closed connections, and any
+        over the size limit, are dropped.
+        """
+        if not connection.socket:
+            return
+        pool_key = (
+            connection.addr[0], connection.addr[1], key, connection.codec,
+            connection.tls
+        )
+        with self._lock:
+            idle = self._idle.setdefault(pool_key, [])
+            if len(idle) < self.max_size:
+                idle.append((connection, time.time()))
+                return
+            self.evicted += 1
+        connection.close()
+
+    def clear(self):
+        """ Closes all of the idle connections. """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, last_used in connections:
+                connection.close()
+
+    def stats(self):
+        """ Returns the pool counters. """
+        with self._lock:
+            return {
+                'idle': sum([len(idle) for idle in self._idle.values()]),
+                'hits': self.hits,
+                'misses': self.misses,
+                'created': self.created,
+                'evicted': self.evicted,
+            }
@@ -3,7 +3,8 @@ This is just a list of the Exception classes used, and the
 error codes used by them.
 """
 from jsonrpctcp import config
-import random
+from jsonrpctcp.codec import Encoded
+import os
 import string
 import sys
 JSONRPC_ERRORS = {
@@ -14,6 +15,12 @@ JSONRPC_ERRORS = {
     -32603: {'code':-32603, 'message':'Internal error.'},
 }
 
+# The standard error objects, encoded once for each codec and spliced
+# into the error responses.
+ENCODED_ERRORS = dict([
+    (code, Encoded(error)) for code, error in JSONRPC_ERRORS.items()
+])
+
 # The random characters are used for padding the server error messages 
 # so that it will hopefully be  harder to brute-force a secret key.
 if sys.version_info[0] == 2:
@@ -22,6 +29,26 @@ else:
     RANDOM_CHARACTERS = string.ascii_letters + string.digits
 RANDOM_STRING_LENGTH = 12
 
+def random_padding():
+    """
+    A random string of RANDOM_CHARACTERS, RANDOM_STRING_LENGTH long
+    (from one os.urandom call).
+    """
+    return ''.join([
+        RANDOM_CHARACTERS[byte % len(RANDOM_CHARACTERS)]
+        for byte in bytearray(os.urandom(RANDOM_STRING_LENGTH))
+    ])
+
+def encoded_error(error):
+    """
+    Returns the Encoded error object for a standard error (with its
+    default message), or None.
+    """
+    encoded = ENCODED_ERRORS.get(error.get('code'))
+    if encoded is not None and encoded.obj == error:
+        return encoded
+    return None
+
 class ProtocolError(Exception):
     """ Used for system errors and custom errors. """
     
@@ -38,22 +65,28 @@ class ProtocolError(Exception):
         This also pads a random string on the message to help
         counter brute-forcing "known" messages.
         """
-        message = self.message
         if config.secret:
-            random_string = ''.join([
-                random.choice(RANDOM_CHARACTERS)
-                for i in range(RANDOM_STRING_LENGTH)
-            ])
-            message = '%s (random: %s)' % (self.message, random_string)        
-        response = {
-            'jsonrpc':"2.0", 
-            'error': {
-                'message': message,
-                'code': self.code
-            },
-            'id':kwargs.get('id', None)
-        }
-        return response
+            message = '%s (random: %s)' % (self.message, random_padding())
+            error = {'message': message, 'code': self.code}
+        else:
+            error = self.error_object()
+        return {'jsonrpc': '2.0', 'error': error, 'id': kwargs.get('id')}
+        
+    def error_object(self):
+        """ The 'error' member of the response (without any padding). """
+        return {'message': self.message, 'code': self.code}
+        
+    def encode(self, codec, request_id=None):
+        """
+        Returns the encoded error response, splicing in the encoded
+        error object of a standard error (unless it's padded).
+        """
+        encoded = None
+        if not config.secret:
+            encoded = encoded_error(self.error_object())
+        if encoded is None:
+            return codec.dumps(self.generate_error(id=request_id))
+        return codec.envelope(encoded.encode(codec), request_id, 'error')
         
     def __repr__(self):
         return (
@@ -0,0 +1,460 @@
+"""
+Message framing for JSONRPCTCP connections. A framed connection starts
+with a short preamble line offering the connection options, which the
+server answers with the options it accepted (or an error):
+
+    client: \\x00JRPC framing=netstring,length\\n
+    server: \\x00JRPC framing=netstring\\n
+
+It then carries any number of framed request / response messages. The
+preamble can never be the start of a JSON request (which is how the
+server tells framed connections apart from the one-shot ones), and
+every request frame gets exactly one response frame back -- an empty
+one for notifications. On a multiplexed connection ('multiplex=1'),
+each message starts with a 4 byte tag instead, and the server may
+handle the requests concurrently, answering them in any order with
+the same tag (and not at all for notifications).
+
+A client can also ask for a binary codec ('codec=msgpack'), which the
+server uses for every message on that connection, and offer compression
+('compress=zstd,zlib'), which the server may accept one of (see the
+compression module), and ask for streamed results ('stream=1'), where
+the result of a call that returns an iterator comes back in several
+frames. A client connecting with a key can offer session encryption
+('cipher=aesgcm nonce=...', see the session module), which encrypts
+the whole body of every frame.
+
+With 'length' (a 4 byte, big-endian length header) and 'netstring'
+('<length>:<message>,') framing, the reader knows the message size up
+front and reads it straight into a buffer of that size. 'newline'
+framing is only suitable for plain JSON messages.
+"""
+import select
+import struct
+import socket
+import ssl
+import sys
+from jsonrpctcp import config
+from jsonrpctcp.errors import ProtocolError
+from jsonrpctcp.codec import BINARY_CODECS
+from jsonrpctcp import compression
+from jsonrpctcp import session
+
+MAGIC = b'\x00JRPC'
+FRAMINGS = ('length', 'netstring', 'newline')
+LENGTH_HEADER = struct.Struct('!I')
+# Multiplexed connections start every message with a request tag.
+TAG = struct.Struct('!I')
+# Streaming connections start every message with one of these flags --
+# MORE on a request allows a streamed response, and on a response
+# means more of it is coming.
+MORE = b'\x01'
+FINAL = b'\x00'
+# Enough digits for config.max_frame, plus the ':'
+NETSTRING_HEADER_SIZE = 11
+# Most buffers given to one sendmsg call (well under any IOV_MAX).
+MAX_PARTS = 64
+
+def handshake(**options):
+    """
+    Returns the preamble line for the given connection options. A
+    list or tuple value offers several choices, in order of preference.
+    """
+    items = []
+    for key, value in sorted(options.items()):
+        if isinstance(value, (list, tuple)):
+            value = ','.join(value)
+        items.append('%s=%s' % (key, value))
+    return MAGIC + b' ' + ' '.join(items).encode('ascii') + b'\n'
+
+def parse_handshake(line):
+    """
+    Returns the options from a preamble line (without the newline),
+    raising a ProtocolError if it is not valid.
+    """
+    if not line or not line.startswith(MAGIC):
+        raise ProtocolError(-32700, 'Invalid connection preamble.')
+    try:
+        items = line[len(MAGIC):].decode('ascii').split()
+    except (UnicodeDecodeError, ValueError):
+        raise ProtocolError(-32700, 'Invalid connection preamble.')
+    options = {}
+    for item in items:
+        key, _, value = item.partition('=')
+        options[key] = value
+    return options
+
+def negotiate(offer):
+    """
+    Picks the connection options the server will use from a client's
+    offer, raising a ProtocolError if it can't accept any of them.
+    """
+    options = {}
+    for framing in offer.get('framing', '').split(','):
+        if framing in FRAMINGS:
+            options['framing'] = framing
+            break
+    else:
+        raise ProtocolError(-32700, 'Unsupported framing.')
+    if offer.get('multiplex') == '1' and options['framing'] != 'newline':
+        options['multiplex'] = 1
+    # Session encryption needs the secret, and binary frames.
+    if config.secret and offer.get('nonce') and \
+        options['framing'] != 'newline':
+        for name in offer.get('cipher', '').split(','):
+            if name in session.CIPHERS:
+                options['cipher'] = name
+                options['nonce'] = session.new_nonce()
+                break
+    if 'codec' in offer:
+        # The per-message encryption padding would corrupt binary
+        # messages (session encryption doesn't pad).
+        secret = config.secret and 'cipher' not in options
+        if offer['codec'] not in BINARY_CODECS or secret or \
+            options['framing'] == 'newline':
+            raise ProtocolError(-32700, 'Unsupported codec.')
+        options['codec'] = offer['codec']
+    if offer.get('stream') == '1' and not options.get('multiplex') and \
+        options['framing'] != 'newline':
+        options['stream'] = 1
+    # Compression is optional, so it's just left off if the server
+    # can't use any of the offered ones. (Encrypted messages wouldn't
+    # compress anyway.)
+    if options['framing'] != 'newline' and not config.secret:
+        for name in offer.get('compress', '').split(','):
+            if name in compression.COMPRESSIONS:
+                options['compress'] = name
+                break
+    return options
+
+def is_handshake(data):
+    """
+    Checks whether the data starts (or could start, if there isn't
+    enough of it yet) with a framed connection preamble.
+    """
+    if len(data) < len(MAGIC):
+        return MAGIC.startswith(data)
+    return data.startswith(MAGIC)
+
+def split_tag(message):
+    """
+    Splits the tag off of the front of a multiplexed message -- the
+    message (a bytearray) is cut in place, rather than copied.
+    """
+    tag = bytes(message[:TAG.size])
+    del message[:TAG.size]
+    return tag, message
+
+def split_flag(message):
+    """
+    Splits the stream flag off of the front of a message (a bytearray,
+    cut in place), returning whether it was MORE.
+    """
+    more = message[:1] == MORE
+    del message[:1]
+    return more, message
+
+def encode_frame(message, framing, compress=None, session=None):
+    """
+    Wraps a message (bytes) in a frame, compressing it if the connection
+    negotiated compression (and encrypting it, with a session).
+    """
+    return b''.join(frame_parts([message], framing, compress, session))
+
+def frame_parts(pieces, framing, compress=None, session=None):
+    """
+    Returns the frame for a message made of several pieces (a tag or
+    flag, and the body, say) as a list of buffers -- the header, the
+    pieces and the trailer -- which send_parts sends without joining.
+    """
+    if compress:
+        pieces = compression.compress_pieces(pieces, compress)
+    if session:
+        pieces = session.encrypt(pieces)
+    length = sum([len(piece) for piece in pieces])
+    if framing == 'length':
+        return [LENGTH_HEADER.pack(length)] + list(pieces)
+    if framing == 'netstring':
+        return [b'%d:' % length] + list(pieces) + [b',']
+    for piece in pieces:
+        if b'\n' in piece:
+            raise ValueError(
+                'Newline framed messages cannot contain newlines.'
+            )
+    return list(pieces) + [b'\n']
+
+def send_parts(sock, parts):
+    """
+    Sends the buffers in order, and returns the number of bytes sent.
+    Where the platform has sendmsg, they go out in one scatter-gather
+    call (picking up where it left off after a partial write) instead
+    of being copied together first.
+    """
+    parts = [part for part in parts if len(part)]
+    total = sum([len(part) for part in parts])
+    # (TLS sockets can't sendmsg.)
+    if not hasattr(sock, 'sendmsg') or isinstance(sock, ssl.SSLSocket):
+        sock.sendall(b''.join(parts))
+        return total
+    views = [memoryview(part) for part in parts]
+    while views:
+        sent = sock.sendmsg(views[:MAX_PARTS])
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+    return total
+
+class FrameParser(object):
+    """
+    Splits buffered connection data into frames. It doesn't do any
+    I/O itself, so it's shared by the threaded and asyncio servers --
+    data is fed in as it arrives, and complete messages come out.
+    """
+
+    def __init__(self, framing=None, data=b''):
+        self.framing = framing
+        # Data is appended to the buffer as it arrives, and messages
+        # are cut off of the front, without copying the rest each time.
+        self.data = bytearray(data)
+        # The negotiated compression, if any
+        self.compress = None
+        # The session.Session decrypting the frames, if any
+        self.session = None
+        # The compression.Decoder of a compressed frame that's only
+        # partly here, and how much more of it is to come
+        self.decoder = None
+        self.remaining = 0
+
+    def feed(self, data):
+        """ Adds newly received data to the buffer. """
+        self.data += data
+        if len(self.data) > config.max_frame + NETSTRING_HEADER_SIZE + 1:
+            raise ProtocolError(-32700, 'Frame too large.')
+
+    def next_line(self):
+        """ Returns the next line (without the newline), or None. """
+        index = self.data.find(b'\n')
+        if index < 0:
+            return None
+        line = self.data[:index]
+        del self.data[:index+1]
+        return line
+
+    def header(self):
+        """
+        Parses the header of the next frame, and returns the header
+        size and the message length, or None if it isn't all here yet.
+        """
+        if self.framing == 'length':
+            if len(self.data) < LENGTH_HEADER.size:
+                return None
+            length, = LENGTH_HEADER.unpack_from(self.data)
+            size = LENGTH_HEADER.size
+        else:
+            index = self.data.find(b':', 0, NETSTRING_HEADER_SIZE)
+            if index < 0:
+                if len(self.data) >= NETSTRING_HEADER_SIZE:
+                    raise ProtocolError(-32700, 'Invalid frame header.')
+                return None
+            if not self.data[:index].isdigit():
+                raise ProtocolError(-32700, 'Invalid frame header.')
+            length = int(self.data[:index])
+            size = index + 1
+        if length > config.max_frame:
+            raise ProtocolError(-32700, 'Frame too large.')
+        return size, length
+
+    def trailer(self):
+        """ The size of the frame trailer (the netstring ','). """
+        if self.framing == 'netstring':
+            return 1
+        return 0
+
+    def check_trailer(self, trailer):
+        """ Verifies the frame trailer. """
+        if self.framing == 'netstring' and trailer != b',':
+            raise ProtocolError(-32700, 'Invalid frame trailer.')
+
+    def next_frame(self):
+        """ Returns the next complete message, or None. """
+        if self.framing == 'newline':
+            return self.next_line()
+        if self.compress and not self.session:
+            return self.next_compressed()
+        header = self.header()
+        if header is None:
+            return None
+        size, length = header
+        end = size + length
+        if len(self.data) < end + self.trailer():
+            return None
+        self.check_trailer(self.data[end:end+self.trailer()])
+        message = self.data[size:end]
+        del self.data[:end+self.trailer()]
+        if self.session:
+            message = self.session.decrypt(message)
+        if self.compress:
+            return compression.decompress(message, self.compress)
+        return message
+
+    def next_compressed(self):
+        """
+        Like next_frame, for a compressed (unencrypted) connection --
+        the message is decompressed as much as it can be with the data
+        that's here, so the rest of it is decoded as it arrives.
+        """
+        if self.decoder is None:
+            header = self.header()
+            if header is None:
+                return None
+            size, self.remaining = header
+            del self.data[:size]
+            self.decoder = compression.Decoder(self.compress)
+        if self.remaining:
+            received = min(len(self.data), self.remaining)
+            self.decoder.feed(self.data[:received])
+            del self.data[:received]
+            self.remaining -= received
+            if self.remaining:
+                return None
+        if len(self.data) < self.trailer():
+            return None
+        self.check_trailer(self.data[:self.trailer()])
+        del self.data[:self.trailer()]
+        decoder, self.decoder = self.decoder, None
+        return decoder.finish()
+
+class FrameReader(FrameParser):
+    """
+    Reads frames off of a socket. Any data already read from the
+    socket (the start of the preamble, for instance) can be passed in.
+    """
+
+    def __init__(self, sock, framing=None, data=b''):
+        FrameParser.__init__(self, framing, data)
+        self.socket = sock
+
+    def read_line(self):
+        """ Reads up to (and strips) the next newline. """
+        while True:
+            line = self.next_line()
+            if line is not None:
+                return line
+            if not self.fill():
+                return None
+
+    def read_frame(self):
+        """
+        Returns the next message, or None if the connection was closed
+        between frames.
+        """
+        if self.framing == 'newline':
+            return self.read_line()
+        if self.compress and not self.session:
+            return self.read_compressed()
+        header = self.header()
+        while header is None:
+            if not self.fill():
+                return None
+            header = self.header()
+        size, length = header
+        if len(self.data) >= size + length + self.trailer():
+            return self.next_frame()
+        message = self.read_message(size, length)
+        while len(self.data) < self.trailer():
+            if not self.fill():
+                raise socket.error('Connection closed mid-frame.')
+        self.check_trailer(self.data[:self.trailer()])
+        del self.data[:self.trailer()]
+        if self.session:
+            message = self.session.decrypt(message)
+            if self.compress:
+                message = compression.decompress(message, self.compress)
+        return message
+
+    def read_message(self, size, length):
+        """
+        The size is known, so reads the rest of the message straight
+        into a buffer of that size, rather than chunk by chunk.
+        """
+        message = bytearray(length)
+        view = memoryview(message)
+        received = min(len(self.data) - size, length)
+        view[:received] = self.data[size:size+received]
+        del self.data[:size+received]
+        while received < length:
+            count = self.socket.recv_into(view[received:])
+            if not count:
+                raise socket.error('Connection closed mid-frame.')
+            received += count
+        # The buffer is handed to the decoder as it is, not copied.
+        return message
+
+    def read_compressed(self):
+        """
+        Reads a compressed connection's message, decoding each chunk
+        as it arrives.
+        """
+        message = self.next_compressed()
+        while message is None:
+            if not self.fill():
+                if self.decoder is not None:
+                    raise socket.error('Connection closed mid-frame.')
+                return None
+            message = self.next_compressed()
+        return message
+
+    def fill(self):
+        """ Reads another chunk from the socket, False on EOF. """
+        if not recv_into(self.socket, self.data, config.buffer):
+            if self.data:
+                raise socket.error('Connection closed mid-frame.')
+            return False
+        if len(self.data) > config.max_frame + NETSTRING_HEADER_SIZE + 1:
+            raise ProtocolError(-32700, 'Frame too large.')
+        return True
+
+def recv_into(sock, buffer, size):
+    """
+    Receives up to 'size' bytes from the socket straight onto the end
+    of a bytearray, and returns how many there were.
+    """
+    if sys.version_info[0] == 2 and isinstance(sock, ssl.SSLSocket):
+        # Python 2's SSL sockets keep the view exported when a read
+        # raises, so the buffer couldn't be trimmed back.
+        data = sock.recv(size)
+        buffer.extend(data)
+        return len(data)
+    start = len(buffer)
+    buffer.extend(bytearray(size))
+    view = memoryview(buffer)[start:]
+    count = 0
+    try:
+        count = sock.recv_into(view)
+    finally:
+        # The buffer can't be resized while the view exists.
+        del view
+        del buffer[start+count:]
+    return count
+
+def recv_chunk(sock, buffer, size):
+    """
+    Receives a chunk of a plain (unframed) message, which ends at the
+    first short chunk -- so it reads again while the rest of the chunk
+    is already waiting, since one read often returns less than a large
+    buffer even when more is on the way.
+    """
+    count = recv_into(sock, buffer, size)
+    while count and count < size and is_readable(sock):
+        received = recv_into(sock, buffer, size - count)
+        if not received:
+            break
+        count += received
+    return count
+
+def is_readable(sock):
+    """ Checks whether a socket has data waiting, without blocking. """
+    if getattr(sock, 'pending', None) and sock.pending():
+        return True
+    return bool(select.select([sock], [], [], 0)[0])
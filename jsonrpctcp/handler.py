@@ -1,7 +1,13 @@
 """
 The Handler class, which can be nested. This should be attached to a
 Server instance.
+
+Attached handlers are compiled into Method entries, which check the
+parameters of a call against the handler's signature (worked out once,
+as it's attached) so bad calls get -32602 before the handler is run.
 """
+import inspect
+import sys
 
 class Handler(object):
     """
@@ -31,7 +37,7 @@ class Handler(object):
                 attr = getattr(self, key)
                 # Tree syntax
                 if issubclass(type(attr), Handler) and attr != self:
-                    for name, handler in attr._handlers.iteritems():
+                    for name, handler in attr._handlers.items():
                         name = '%s.%s' % (key, name)
                         handlers[name] = handler
                 # Normal syntax
@@ -39,3 +45,96 @@ class Handler(object):
                     handlers[key] = attr
             self.__handlers = handlers
         return self.__handlers
+
+class Method(object):
+    """
+    A compiled handler: the callable, and what its signature accepts.
+    Callables without an inspectable signature (some builtins) accept
+    anything, and fail when they're called instead.
+    """
+    
+    def __init__(self, function):
+        self.function = function
+        self.checked = False
+        # The positional parameters, and how many of them are required
+        self.max_args = 0
+        self.min_args = 0
+        self.varargs = False
+        # The parameters that can be passed by name, and the ones that
+        # have to be passed when they are.
+        self.keywords = set()
+        self.required = set()
+        self.varkw = False
+        # Keyword-only parameters without defaults (which can't be
+        # passed with positional params)
+        self.kwonly_required = False
+        try:
+            if sys.version_info[0] == 2:
+                self.inspect_py2(function)
+            else:
+                self.inspect(function)
+        except (TypeError, ValueError):
+            return
+        self.checked = True
+        
+    def inspect(self, function):
+        kinds = inspect.Parameter
+        for param in inspect.signature(function).parameters.values():
+            required = param.default is kinds.empty
+            if param.kind == kinds.VAR_POSITIONAL:
+                self.varargs = True
+            elif param.kind == kinds.VAR_KEYWORD:
+                self.varkw = True
+            elif param.kind == kinds.KEYWORD_ONLY:
+                self.keywords.add(param.name)
+                if required:
+                    self.required.add(param.name)
+                    self.kwonly_required = True
+            else:
+                self.max_args += 1
+                if required:
+                    self.min_args += 1
+                    self.required.add(param.name)
+                if param.kind == kinds.POSITIONAL_OR_KEYWORD:
+                    self.keywords.add(param.name)
+                    
+    def inspect_py2(self, function):
+        if not inspect.isfunction(function) and \
+                not inspect.ismethod(function):
+            function = getattr(function, '__call__', None)
+            if not inspect.ismethod(function):
+                raise TypeError('No signature')
+        args, varargs, varkw, defaults = inspect.getargspec(function)
+        if inspect.ismethod(function) and function.__self__ is not None:
+            args = args[1:]
+        required = args[:len(args) - len(defaults or ())]
+        self.max_args = len(args)
+        self.min_args = len(required)
+        self.varargs = bool(varargs)
+        self.varkw = bool(varkw)
+        self.keywords = set(args)
+        self.required = set(required)
+        
+    def accepts(self, params, kwargs):
+        """ Checks whether the handler can be called with the params. """
+        if not self.checked:
+            return True
+        if kwargs:
+            if not self.varkw:
+                for key in kwargs:
+                    if key not in self.keywords:
+                        return False
+            for key in self.required:
+                if key not in kwargs:
+                    return False
+            return True
+        count = len(params)
+        if count < self.min_args or self.kwonly_required:
+            return False
+        return self.varargs or count <= self.max_args
+        
+    def __call__(self, *args, **kwargs):
+        return self.function(*args, **kwargs)
+        
+    def __repr__(self):
+        return '<Method> %r' % (self.function,)
@@ -1,17 +1,96 @@
-from jsonrpctcp import logger
+"""
+Request tracing, for debugging. It's off unless config.trace is set --
+then each thread's last request and response (on either end) are kept
+as history.request and history.response, and a sample of the exchanges
+(config.trace_sample of them) goes into a ring buffer of the last
+config.trace_size, for history.traces().
+
+The messages are the text (or bytes) after any decryption, before any
+encryption.
+"""
+import random
+import threading
+import time
+from collections import deque
+from jsonrpctcp import config
+
+class Trace(object):
+    """ One traced request, and its response once it's done. """
+
+    def __init__(self, side, request):
+        # 'client' or 'server'
+        self.side = side
+        self.request = request
+        self.response = None
+        self.time = time.time()
+        self.thread = threading.current_thread().name
+
+    def __repr__(self):
+        return '<Trace> %s %s: %r -> %r' % (
+            self.side, self.thread, self.request, self.response
+        )
 
 class History(object):
     """
-    This holds the response and request objects for a session.
+    This holds the last request and response of each thread, and the
+    ring buffer of the sampled traces.
     """
     _instance = None
-    
+
     def __init__(self):
-        self.request = None
-        self.response = None
-    
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._traces = deque(maxlen=config.trace_size)
+
     @classmethod
     def instance(cls):
         if not cls._instance:
             cls._instance = cls()
-        return cls._instance
\ No newline at end of file
+        return cls._instance
+
+    @property
+    def request(self):
+        """ This thread's last traced request. """
+        return getattr(self._local, 'request', None)
+
+    @property
+    def response(self):
+        """ This thread's last traced response. """
+        return getattr(self._local, 'response', None)
+
+    def start(self, side, request):
+        """
+        Traces a request, returning the Trace to finish() with the
+        response -- or None, if tracing is off.
+        """
+        if not config.trace:
+            return None
+        self._local.request = request
+        self._local.response = None
+        trace = Trace(side, request)
+        if config.trace_sample >= 1 or random.random() < config.trace_sample:
+            with self._lock:
+                if self._traces.maxlen != config.trace_size:
+                    self._traces = deque(self._traces, config.trace_size)
+                self._traces.append(trace)
+        return trace
+
+    def finish(self, trace, response):
+        """
+        Adds the response to a Trace (a streamed response can finish
+        it several times, the last message being the final response).
+        """
+        if trace is None:
+            return
+        trace.response = response
+        self._local.response = response
+
+    def traces(self):
+        """ Returns the sampled traces, oldest first. """
+        with self._lock:
+            return list(self._traces)
+
+    def clear(self):
+        """ Empties the ring buffer. """
+        with self._lock:
+            self._traces.clear()
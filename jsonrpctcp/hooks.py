@@ -0,0 +1,76 @@
+"""
+Client call hooks, for feeding client-side timings into a metrics
+system (or logging slow calls). A hook is a CallHook subclass, passed
+to connect (hooks=[...]) or added with client._add_hook:
+
+    class SlowCalls(CallHook):
+        def after_call(self, call):
+            if call.total > 1:
+                print(call.method, call.wait, call.error)
+
+    conn = connect('localhost', 8001, hooks=[SlowCalls()])
+
+before_call() gets a CallInfo as the call is started, and after_call()
+the same one once it has finished (or failed), with the sizes and the
+timings filled in. Errors raised by hooks are logged, not raised.
+"""
+import time
+from jsonrpctcp.metrics import timer
+
+class CallHook(object):
+    """ The base class for client call hooks -- both methods are optional. """
+
+    def before_call(self, call):
+        pass
+
+    def after_call(self, call):
+        pass
+
+class CallInfo(object):
+    """
+    The details of one call (or batch, or stream). The sizes are of
+    the encoded (and encrypted) messages, and the timings in seconds:
+
+        encode  -- encoding (and encrypting) the request
+        connect -- opening the connection (0 if one was reused)
+        send    -- sending the request
+        wait    -- waiting for (and reading) the response
+        decode  -- decrypting, decoding and validating the response
+        total   -- all of it, start to finish
+    """
+
+    def __init__(self, methods=(), batch=False, notify=False, stream=False):
+        self.methods = list(methods)
+        # The method name, or None for a batch (see methods).
+        self.method = None
+        if self.methods and not batch:
+            self.method = self.methods[0]
+        self.batch = batch
+        self.notify = notify
+        self.stream = stream
+        self.request_size = 0
+        self.response_size = 0
+        self.encode = 0.0
+        self.connect = 0.0
+        self.send = 0.0
+        self.wait = 0.0
+        self.decode = 0.0
+        self.total = 0.0
+        # The exception the call raised, if it failed.
+        self.error = None
+        self.time = time.time()
+        self._started = timer()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def finish(self, error=None):
+        self.error = error
+        self.total = timer() - self._started
+
+    def __repr__(self):
+        return '<CallInfo> %s %s: %.6fs' % (
+            self.method or self.methods, self.ok and 'ok' or 'error',
+            self.total
+        )
@@ -0,0 +1,194 @@
+"""
+Server instrumentation -- request counts and rates, error counts by
+JSON-RPC error code, the number of open connections, and latency
+histograms for each method, split into the time spent decoding the
+request, running the handler and encoding the response.
+
+Each server keeps its own Metrics (server.json_request.metrics), and
+server.stats() includes them. They can also be served by a built-in
+method, if config.stats_method names one. Recording is a counter
+update and a bucket increment under a lock, so it's cheap enough to
+leave on -- config.metrics = False turns it off.
+"""
+import bisect
+import threading
+import time
+from jsonrpctcp import config
+
+# The most precise clock available (Python 2 only has time.time).
+timer = getattr(time, 'perf_counter', time.time)
+
+# Upper bounds (in seconds) of the latency histogram buckets -- there
+# is one more bucket for anything slower than the last.
+BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# The requests per second are averaged over this many seconds.
+RATE_WINDOW = 10
+
+class Histogram(object):
+    """ Latencies, counted into the BUCKETS. """
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """
+        The (upper bound of the) bucket holding the given fraction of
+        the latencies -- or the slowest one, past the last bucket.
+        """
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.count and self.total / self.count,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': list(self.buckets),
+        }
+
+class MethodMetrics(object):
+    """ The calls, errors and latencies of one method. """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.decode = Histogram()
+        self.handler = Histogram()
+        self.encode = Histogram()
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'decode': self.decode.stats(),
+            'handler': self.handler.stats(),
+            'encode': self.encode.stats(),
+        }
+
+class Metrics(object):
+    """
+    The counters for one server. The decode and encode times are for
+    whole requests, so they're only added to a method's histograms for
+    single calls -- batches just count towards the server totals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = {}
+        self.methods = {}
+        self.decode = Histogram()
+        self.encode = Histogram()
+        self.connections = 0
+        self.total_connections = 0
+        self._rate_seconds = [0] * RATE_WINDOW
+        self._rate_counts = [0] * RATE_WINDOW
+
+    def add_request(self, method=None, decode=0.0, encode=0.0):
+        """ Counts a request, with its decode and encode times. """
+        if not config.metrics:
+            return
+        second = int(time.time())
+        slot = second % RATE_WINDOW
+        with self._lock:
+            self.requests += 1
+            if self._rate_seconds[slot] != second:
+                self._rate_seconds[slot] = second
+                self._rate_counts[slot] = 0
+            self._rate_counts[slot] += 1
+            self.decode.add(decode)
+            self.encode.add(encode)
+            if method in self.methods:
+                self.methods[method].decode.add(decode)
+                self.methods[method].encode.add(encode)
+
+    def add_call(self, method, seconds, error=None):
+        """
+        Counts a call to a (registered) method, with the time its
+        handler took and the error code, if it failed.
+        """
+        if not config.metrics:
+            return
+        with self._lock:
+            method_metrics = self.methods.get(method)
+            if method_metrics is None:
+                method_metrics = self.methods[method] = MethodMetrics()
+            method_metrics.calls += 1
+            method_metrics.handler.add(seconds)
+            if error is not None:
+                method_metrics.errors += 1
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def add_error(self, code):
+        """ Counts an error that didn't come from a handler. """
+        if not config.metrics:
+            return
+        with self._lock:
+            self.errors[code] = self.errors.get(code, 0) + 1
+
+    def opened(self):
+        with self._lock:
+            self.connections += 1
+            self.total_connections += 1
+
+    def closed(self):
+        with self._lock:
+            self.connections -= 1
+
+    def rate(self):
+        """ Requests per second, over the last RATE_WINDOW seconds. """
+        now = time.time()
+        second = int(now)
+        count = 0
+        for started, requests in zip(self._rate_seconds, self._rate_counts):
+            if second - started < RATE_WINDOW:
+                count += requests
+        return count / max(min(now - self.started, RATE_WINDOW), 1.0)
+
+    def stats(self):
+        """
+        Returns the counters, as plain lists and dicts (with string
+        keys), so they can be sent as an RPC result.
+        """
+        with self._lock:
+            return {
+                'uptime': time.time() - self.started,
+                'requests': self.requests,
+                'requests_per_second': self.rate(),
+                'errors': dict([
+                    (str(code), count) for code, count in self.errors.items()
+                ]),
+                'connections': self.connections,
+                'total_connections': self.total_connections,
+                'decode': self.decode.stats(),
+                'encode': self.encode.stats(),
+                'methods': dict([
+                    (name, method_metrics.stats())
+                    for name, method_metrics in self.methods.items()
+                ]),
+                'buckets': list(BUCKETS),
+            }
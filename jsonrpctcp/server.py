@@ -4,23 +4,35 @@ initiating a JSONRPC-TCP Server.
 """
 from __future__ import print_function
 import threading
+import logging
 import socket
 import time
 import sys
-import types
 import traceback
-from jsonrpctcp.handler import Handler
+from jsonrpctcp.handler import Handler, Method
+from jsonrpctcp.workers import WorkerPool, IdleConnections
+from jsonrpctcp.framing import FrameReader, handshake
+from jsonrpctcp.framing import frame_parts, send_parts
+from jsonrpctcp.framing import is_handshake, parse_handshake, negotiate
+from jsonrpctcp.framing import split_tag, split_flag, recv_chunk
+from jsonrpctcp.framing import is_readable
+from jsonrpctcp.framing import MORE, FINAL
 from jsonrpctcp import config
-from jsonrpctcp import logger
+from jsonrpctcp import logger, log_message
 from jsonrpctcp import history
-from jsonrpctcp.errors import ProtocolError
+from jsonrpctcp.errors import ProtocolError, encoded_error
 from jsonrpctcp.errors import JSONRPC_ERRORS, EncryptionMissing
+from jsonrpctcp.codec import get_codec, Encoded
+from jsonrpctcp.metrics import Metrics, timer
+from jsonrpctcp.cache import ResultCache, cache_key
+from jsonrpctcp import session
+from jsonrpctcp.tls import get_context, is_tls
 from inspect import isclass
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+if sys.version_info[0] == 2:
+    STRING_TYPES = (str, unicode)
+else:
+    STRING_TYPES = (str,)
 
 class Server(object):
     """
@@ -32,15 +44,30 @@ class Server(object):
 
     _shutdown = False
 
-    def __init__(self, addr, handler=None, pool=10):
-        if config.secret and not config.crypt:
+    def __init__(self, addr, handler=None, pool=None, pool_queue=None,
+        tls=None):
+        # Without config.crypt, only session encrypted (framed)
+        # connections can be used.
+        if config.secret and not config.crypt and not session.CIPHERS:
             raise EncryptionMissing('No encrpytion library found.')
         self.addr = addr
         self.socket = None
         self.threads = []
-        # Pool not actually implemented yet
-        self.pool = pool
+        # 'pool' is the number of worker threads -- if it is None, a
+        # new thread is started for every connection instead.
+        if pool is None:
+            pool = config.pool_size
+        if pool_queue is None:
+            pool_queue = config.pool_queue
+        self.pool = pool and int(pool)
+        self.pool_queue = int(pool_queue)
+        self.workers = None
         self.json_request = JSONRequest(self)
+        # 'tls' (or config.tls) serves TLS connections -- True for the
+        # configured certificate, or an ssl.SSLContext.
+        self.json_request.tls = get_context(tls, server=True)
+        if config.stats_method:
+            self.json_request.add_handler(self.stats, config.stats_method)
         if handler:
             assert hasattr(handler, '__call__') or \
                 issubclass(handler, Handler)
@@ -56,6 +83,11 @@ class Server(object):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(self.addr)
         self.socket.listen(config.max_queue)
+        if self.pool:
+            self.workers = WorkerPool(None, self.pool, self.pool_queue)
+            self.json_request.idle = IdleConnections(
+                self.workers, config.keepalive_timeout
+            )
         self.wait()
         
     def wait(self):
@@ -63,7 +95,19 @@ class Server(object):
         while True:
             if self._shutdown:
                 break            
-            clientsock, addr = self.socket.accept()
+            try:
+                clientsock, addr = self.socket.accept()
+            except socket.error:
+                if self._shutdown:
+                    break
+                raise
+            if self.workers:
+                # Blocks while the queue is full, so no more
+                # connections are accepted until the workers catch up.
+                self.workers.submit(
+                    self.json_request.process, clientsock, addr
+                )
+                continue
             args = (clientsock, addr)
             target = self.json_request.process
             thread = threading.Thread(target=target, args=args)
@@ -73,6 +117,9 @@ class Server(object):
             self.check_threads()
             
         sys.stdout.write('Shutting down...')
+        if self.workers:
+            self.json_request.idle.shutdown()
+            self.workers.shutdown()
         for thread in self.threads:
             thread.join()
         sys.stdout.write('done.\n')
@@ -85,19 +132,44 @@ class Server(object):
         self._shutdown = True
         self.socket.close()
         
+    def stats(self):
+        """
+        Returns the worker pool usage, queue depth and idle framed
+        connections (or just the number of live connection threads if
+        there is no pool), the
+        bytes and messages sent, and the request metrics.
+        """
+        if self.workers:
+            stats = self.workers.stats()
+            stats['idle_connections'] = self.json_request.idle.count()
+        else:
+            self.check_threads()
+            stats = {'threads': len(self.threads)}
+        stats['bytes_sent'] = self.json_request.bytes_sent
+        stats['messages_sent'] = self.json_request.messages_sent
+        stats.update(self.json_request.metrics.stats())
+        stats['caches'] = self.json_request.cache_stats()
+        if self.json_request.tls:
+            stats['tls'] = self.json_request.tls_stats()
+        return stats
+        
     def check_threads(self):
         """
         Check the thread list for dead threads and finished
         threads.
         """
         for thread in self.threads:
-            if not thread.isAlive():
+            if not thread.is_alive():
                 thread.join()
                 self.threads.remove(thread)
     
-    def add_handler(self, method, name=None):
+    def add_handler(self, method, name=None, cache=None):
         """ Just a wrapper around JSONRequest.add_handler """
-        self.json_request.add_handler(method, name)
+        self.json_request.add_handler(method, name, cache)
+        
+    def invalidate(self, method=None, params=None):
+        """ Just a wrapper around JSONRequest.invalidate """
+        self.json_request.invalidate(method, params)
             
 class JSONRequest(object):
     """
@@ -107,37 +179,143 @@ class JSONRequest(object):
 
     def __init__(self, server):
         self.server = server
+        # The compiled Method entries, by their full (dotted) names
         self.handlers = {}
+        self._batch_pool = None
+        self._batch_pool_lock = threading.Lock()
+        self._multiplex_pool = None
+        self._lock = threading.Lock()
+        self.bytes_sent = 0
+        self.messages_sent = 0
+        self.metrics = Metrics()
+        # The ResultCaches of the cached methods, by name
+        self.caches = {}
+        # The IdleConnections holding idle framed connections, with a
+        # worker pool (so they don't each keep a worker)
+        self.idle = None
+        # The SSLContext of a TLS server, and its handshake counts
+        self.tls = None
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
 
-    def add_handler(self, method, name=None):
+    def add_handler(self, method, name=None, cache=None):
         """
         Attach a handler to the request object. It must be either
-        callable, or a subclass of Handler.
+        callable, or a subclass of Handler. 'cache' caches the results
+        (True for the config defaults, or a ResultCache) -- methods
+        marked with the cached decorator are cached anyway.
         """
         if isclass(method):
             assert issubclass(method, Handler)
             # If it's an actual Handler subclass
             handler_instance = method(self)
-            for hname, method in handler_instance._handlers.iteritems():
+            for hname, method in handler_instance._handlers.items():
                 if name:
                     hname = '%s.%s' % (name, hname)
-                self.handlers[hname] = method
+                self.handlers[hname] = Method(method)
+                self.set_cache(hname, method, cache)
         else:
             if not name:
                 name = method.__name__
             assert hasattr(method, '__call__')
-            self.handlers[name] = method
+            self.handlers[name] = Method(method)
+            self.set_cache(name, method, cache)
+            
+    def set_cache(self, name, method, cache=None):
+        """ Sets up (or removes) the result cache for a method. """
+        if cache is None and hasattr(method, 'result_cache'):
+            cache = ResultCache(*method.result_cache)
+        elif cache is True:
+            cache = ResultCache()
+        if cache is None or cache is False:
+            self.caches.pop(name, None)
+        else:
+            self.caches[name] = cache
+            
+    def invalidate(self, method=None, params=None):
+        """
+        Drops cached results -- all of them, or all of a method's, or
+        just the one for the given params (a list or dict) of a method.
+        """
+        if method is None:
+            caches = list(self.caches.values())
+        else:
+            caches = [self.caches[method]] if method in self.caches else []
+        for cache in caches:
+            if method is None:
+                cache.invalidate()
+            elif params is None:
+                cache.invalidate_method(method)
+            elif isinstance(params, dict):
+                cache.invalidate(cache_key(method, [], params))
+            else:
+                cache.invalidate(cache_key(method, params, {}))
+                
+    def cache_stats(self):
+        """ Returns the hits, misses, etc. of each cached method. """
+        return dict([
+            (name, cache.stats()) for name, cache in self.caches.items()
+        ])
             
     def get_handler(self, name):
-        """ Check for an attached handler and return it. """
-        if self.handlers.has_key(name):
-            return self.handlers[name]
-        return None
+        """ Check for an attached handler and return its Method. """
+        return self.handlers.get(name, None)
+                
+    def batch_pool(self):
+        """
+        Returns the WorkerPool that runs the entries of concurrent
+        batches, starting it the first time it's needed.
+        """
+        with self._batch_pool_lock:
+            if not self._batch_pool:
+                self._batch_pool = WorkerPool(
+                    None, config.batch_workers, config.pool_queue
+                )
+            return self._batch_pool
+            
+    def multiplex_pool(self):
+        """
+        Returns the WorkerPool that runs the requests of all the
+        multiplexed connections, starting it the first time.
+        """
+        with self._batch_pool_lock:
+            if not self._multiplex_pool:
+                self._multiplex_pool = WorkerPool(
+                    None, config.multiplex_workers, config.pool_queue
+                )
+            return self._multiplex_pool
+            
+    def count_sent(self, size):
+        """ Adds a sent response message to the counters. """
+        with self._lock:
+            self.bytes_sent += size
+            self.messages_sent += 1
+            
+    def count_tls(self, sock):
+        """ Adds a TLS handshake to the counters. """
+        with self._lock:
+            self.tls_handshakes += 1
+            if getattr(sock, 'session_reused', False):
+                self.tls_resumed += 1
                 
+    def tls_stats(self):
+        """ The TLS handshakes, and how many resumed a session. """
+        with self._lock:
+            return {
+                'handshakes': self.tls_handshakes,
+                'resumed': self.tls_resumed,
+            }
+            
     def process(self, sock, addr):
         """ Just a wrapper for ProcessRequest. """
         request = ProcessRequest(self)
-        request.process(sock, addr)
+        self.metrics.opened()
+        idle = False
+        try:
+            idle = request.process(sock, addr)
+        finally:
+            if not idle:
+                self.metrics.closed()
         
 class ProcessRequest(object):
     """
@@ -149,8 +327,16 @@ class ProcessRequest(object):
 
     def __init__(self, json_request):
         self.json_request = json_request
+        self.metrics = json_request.metrics
         self.socket = None
         self.client_address = None
+        self.codec = get_codec()
+        # The session.Session of an encrypted framed connection, which
+        # encrypts the frames instead of each message.
+        self.session = None
+        # The FrameReader of a framed connection, and whether it streams
+        self.reader = None
+        self.streams = None
         
     def process(self, sock, addr):
         """
@@ -159,79 +345,432 @@ class ProcessRequest(object):
         self.socket = sock
         self.socket.settimeout(config.timeout)
         self.client_address = addr
-        requestlines = []
-        while True:
-            data = self.get_data()
-            if not data: 
-                break
-            requestlines.append(data)
-            if len(data) < config.buffer: 
-                break
-        request = ''.join(requestlines)
-        response = ''
-        crypt_error = False
-        if config.secret:
-            crypt = config.crypt.new(config.secret)
-            try:
-                request = crypt.decrypt(request)
-            except ValueError:
-                crypt_error = True
-                error = ProtocolError(-32700, 'Could not decrypt request.')
-                response = json.dumps(error.generate_error())
-        history.request = request
-        logger.debug('SERVER | REQUEST: %s' % request)
-        if self.socket_error:
+        if self.json_request.tls and not self.start_tls():
+            return
+        # The request is read straight onto the end of one buffer,
+        # instead of being joined together from chunks.
+        request = bytearray()
+        count = self.get_data(request)
+        if count and is_handshake(request):
+            if self.process_frames(request):
+                # It's waiting for its next request (see serve_frames).
+                return True
             self.socket.close()
+            return
+        while count == config.buffer:
+            count = self.get_data(request)
+        if self.socket_error:
+            history.start('server', request)
+            log_message('SERVER | REQUEST', request)
         else:
-            if not crypt_error:
-                response = self.parse_request(request)
-            history.response = response
-            logger.debug('SERVER | RESPONSE: %s' % response)
-            if config.secret:
-                length = config.crypt_chunk_size
-                pad_length = length - (len(response) % length)
-                response = crypt.encrypt('%s%s' % (response, ' '*pad_length))
-            self.socket.send(response)
+            response = self.handle_message(request)
+            try:
+                self.socket.sendall(response)
+                self.json_request.count_sent(len(response))
+            except socket.error:
+                self.socket_error = True
         self.socket.close()
 
-    def get_data(self):
-        """ Retrieves a data chunk from the socket. """
+    def start_tls(self):
+        """
+        Does the TLS handshake -- here in the connection's thread (or
+        worker), rather than holding up the accept loop.
+        """
+        try:
+            self.socket = self.json_request.tls.wrap_socket(
+                self.socket, server_side=True
+            )
+        except socket.error as error:
+            logger.debug('SERVER | TLS HANDSHAKE FAILED: %s', error)
+            self.socket.close()
+            return False
+        self.json_request.count_tls(self.socket)
+        return True
+        
+    def refuse(self, error):
+        """ Answers a preamble it can't accept (the caller closes). """
+        try:
+            self.socket.sendall(handshake(error=error))
+        except socket.error:
+            self.socket_error = True
+
+    def process_frames(self, data):
+        """
+        Handles a framed (persistent) connection, responding to each
+        request frame until the client closes the connection. Returns
+        True if it was left open (waiting for the next request, or for
+        its multiplexed requests to finish) -- it's closed later on.
+        """
+        reader = FrameReader(self.socket, data=data)
+        try:
+            line = reader.read_line()
+            if line is None:
+                return
+            offer = parse_handshake(line)
+        except socket.error:
+            return
+        except ProtocolError as error:
+            logger.debug('SERVER | BAD PREAMBLE: %s', error.message)
+            self.refuse('invalid')
+            return
+        try:
+            options = negotiate(offer)
+        except ProtocolError as error:
+            logger.debug('SERVER | REFUSED: %s', error.message)
+            self.refuse('unsupported')
+            return
+        if is_tls(self.socket):
+            # A TLS socket can't be read by one thread while another
+            # writes, so multiplexed connections are refused.
+            options.pop('multiplex', None)
+        try:
+            self.socket.sendall(handshake(**options))
+        except socket.error:
+            self.socket_error = True
+            return
+        reader.framing = options['framing']
+        reader.compress = options.get('compress')
+        reader.session = self.session = session.start(
+            config.secret, offer, options, 'server'
+        )
+        if 'codec' in options:
+            self.codec = get_codec(options['codec'])
+        self.socket.settimeout(config.keepalive_timeout)
+        self.reader = reader
+        if options.get('multiplex'):
+            return self.process_multiplexed()
+        self.streams = options.get('stream')
+        return self.serve_frames()
+        
+    def serve_frames(self):
+        """
+        Responds to each request frame until the client closes the
+        connection. With a worker pool, an idle connection is handed to
+        the IdleConnections rather than holding on to its worker, and
+        it returns True -- resume_frames() carries on when the next
+        request arrives.
+        """
+        reader = self.reader
+        idle = self.json_request.idle
+        while True:
+            if idle is not None and not reader.data and \
+                not is_readable(self.socket):
+                idle.add(self.socket, self.resume_frames, self.close_idle)
+                return True
+            try:
+                request = reader.read_frame()
+                if request is None:
+                    break
+                if self.streams:
+                    more, request = split_flag(request)
+                    response = self.handle_message(request, more)
+                    self.send_stream(response, reader)
+                    continue
+                response = self.handle_message(request)
+                self.send_frame([response], reader)
+            except (ProtocolError, socket.error):
+                # Timed out waiting, or the frames are out of sync.
+                break
+        return False
+        
+    def resume_frames(self):
+        """ Carries on with a connection that was idle (on a worker). """
+        idle = False
         try:
-            data = self.socket.recv(config.buffer)
+            idle = self.serve_frames()
+        finally:
+            if not idle:
+                self.close_idle()
+                
+    def close_idle(self):
+        """ Closes a connection that was idle (or has finished). """
+        self.socket.close()
+        self.metrics.closed()
+        
+    def send_stream(self, response, reader):
+        """
+        Sends a response on a streaming connection, where each message
+        is flagged with whether more of the response is coming.
+        """
+        if not is_stream(response):
+            response = [response]
+        previous = None
+        for message in response:
+            if previous is not None:
+                self.send_frame([MORE, previous], reader)
+            previous = message
+        self.send_frame([FINAL, previous], reader)
+        
+    def send_frame(self, pieces, reader):
+        """
+        Frames and sends a response message, given in pieces (the tag
+        or stream flag, and the message) so it isn't copied together.
+        """
+        parts = frame_parts(
+            pieces, reader.framing, reader.compress, reader.session
+        )
+        self.json_request.count_sent(send_parts(self.socket, parts))
+        
+    def process_multiplexed(self):
+        """
+        Handles a multiplexed connection -- the request frames are run
+        concurrently (on the workers shared by all the multiplexed
+        connections), and each response is sent (with its request's
+        tag) as soon as it is ready. The socket is closed once the
+        client has closed it, and the last of the requests is done.
+        """
+        self.send_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.running = 0
+        self.finished = False
+        self.serve_multiplexed()
+        return True
+        
+    def serve_multiplexed(self):
+        """
+        Reads the request frames of a multiplexed connection. Like
+        serve_frames, an idle connection is handed to the
+        IdleConnections (with a worker pool) until it has more.
+        """
+        reader = self.reader
+        idle = self.json_request.idle
+        workers = self.json_request.multiplex_pool()
+        while True:
+            if idle is not None and not reader.data and \
+                not is_readable(self.socket):
+                idle.add(
+                    self.socket, self.serve_multiplexed, self.end_multiplexed
+                )
+                return
+            try:
+                request = reader.read_frame()
+            except (ProtocolError, socket.error):
+                break
+            if request is None:
+                break
+            with self.state_lock:
+                self.running += 1
+            # (Blocks while the queue is full, so it stops reading.)
+            workers.submit(self.respond, *split_tag(request))
+        self.end_multiplexed()
+        
+    def respond(self, tag, request):
+        """ Runs a multiplexed request, and sends its tagged response. """
+        try:
+            response = self.handle_message(request)
+            if response:
+                with self.send_lock:
+                    try:
+                        self.send_frame([tag, response], self.reader)
+                    except socket.error:
+                        pass
+        finally:
+            with self.state_lock:
+                self.running -= 1
+                done = self.finished and not self.running
+            if done:
+                self.close_idle()
+                
+    def end_multiplexed(self):
+        """ Closes a multiplexed connection, once its requests are done. """
+        with self.state_lock:
+            self.finished = True
+            done = not self.running
+        if done:
+            self.close_idle()
+        
+    def get_data(self, buffer):
+        """
+        Receives a data chunk from the socket onto the end of the
+        buffer, and returns its size.
+        """
+        try:
+            return recv_chunk(self.socket, buffer, config.buffer)
         except socket.timeout:
             # It may have finished sending without an error if
             # len(message) % buffer == 0.
-            data = None
+            return 0
         except socket.error:
             self.socket_error = True
-            data = None
-        return data
+            return 0
         
-    def parse_request(self, data):
-        """ Attempts to load the request, validates it, and calls it. """
+    def handle_message(self, request, stream=False):
+        """
+        Decrypts a raw request message, runs it and returns the raw
+        (encrypted, if necessary) response message. If 'stream' is set
+        and the call returns an iterator, it returns an iterator over
+        the response messages instead.
+        """
         try:
-            obj = json.loads(data)
-        except ValueError:
-            return json.dumps(ProtocolError(-32700).generate_error())
-        if not obj:
-            return json.dumps(ProtocolError(-32600).generate_error())
-        batch = True
-        if type(obj) is not list:
-            batch = False
-            obj = [obj,]
+            request = self.decrypt(request)
+        except ProtocolError as error:
+            trace = history.start('server', request)
+            self.metrics.add_error(error.code)
+            self.metrics.add_request()
+            response = error.encode(self.codec)
+        else:
+            trace = history.start('server', request)
+            log_message('SERVER | REQUEST', request)
+            response = self.parse_request(request, stream)
+        if is_stream(response):
+            return self.encrypt_stream(response, trace)
+        history.finish(trace, response)
+        log_message('SERVER | RESPONSE', response)
+        if not response:
+            return b''
+        return self.encrypt(response)
+        
+    def decrypt(self, request):
+        """
+        Decrypts the request, if a secret is set (and the connection
+        isn't session encrypted). It isn't decoded to text first -- the
+        codecs all read bytes (or a bytearray).
+        """
+        if config.secret and not self.session:
+            if not config.crypt:
+                raise ProtocolError(
+                    -32700, 'Only session encryption is supported.'
+                )
+            crypt = config.crypt.new(config.secret)
+            try:
+                request = crypt.decrypt(request)
+            except ValueError:
+                raise ProtocolError(-32700, 'Could not decrypt request.')
+        if sys.version_info[0] == 2:
+            # Python 2's json module only reads strings.
+            request = bytes(request)
+        return request
+        
+    def encrypt_stream(self, responses, trace=None):
+        """ Encrypts the messages of a streamed response as they come. """
+        for response in responses:
+            history.finish(trace, response)
+            log_message('SERVER | RESPONSE', response)
+            yield self.encrypt(response)
+        
+    def encrypt(self, response):
+        """ Encodes and encrypts (if a secret is set) the response. """
+        if not isinstance(response, bytes):
+            response = response.encode('utf-8')
+        if config.secret and not self.session and config.crypt:
+            crypt = config.crypt.new(config.secret)
+            length = config.crypt_chunk_size
+            pad_length = length - (len(response) % length)
+            response = crypt.encrypt(response + b' '*pad_length)
+        return response
+        
+    def parse_request(self, data, stream=False):
+        """
+        Attempts to load the request, validates it, and calls it. If
+        'stream' is set, and it's a single call that returns an
+        iterator, the encoded response is streamed (as an iterator).
+        """
+        started = timer()
+        try:
+            requests, batch = self.load_request(data)
+        except ProtocolError as error:
+            self.metrics.add_error(error.code)
+            self.metrics.add_request(decode=timer() - started)
+            return error.encode(self.codec)
+        decode = timer() - started
+        request_errors = [self.check_request(req) for req in requests]
+        calls = [
+            req for req, error in zip(requests, request_errors) if not error
+        ]
+        stream = stream and not batch and calls and 'id' in calls[0]
+        results = self.parse_calls(calls, stream)
+        if stream and is_stream(results[0]):
+            self.metrics.add_request(calls[0]['method'], decode)
+            return self.stream_responses(results[0], calls[0])
+        return self.build_responses(
+            requests, request_errors, results, batch, decode
+        )
+        
+    def stream_responses(self, results, request):
+        """
+        Encodes an iterator result a chunk (config.stream_chunk items)
+        at a time, and then the normal response, with a null result (or
+        the error, if the iterator raised one).
+        """
+        request_id = request.get('id')
+        chunk = []
+        try:
+            for item in results:
+                chunk.append(item)
+                if len(chunk) >= config.stream_chunk:
+                    yield self.codec.dumps(generate_chunk(chunk, request_id))
+                    chunk = []
+        except Exception:
+            error = self.handler_error(request['method'])
+            self.metrics.add_error(error.code)
+            yield error.encode(self.codec, request_id)
+            return
+        if chunk:
+            yield self.codec.dumps(generate_chunk(chunk, request_id))
+        yield self.codec.dumps(generate_response(None, id=request_id))
+        
+    def parse_calls(self, calls, stream=False):
+        """
+        Runs the calls of a request, and returns their results in
+        order. Batch entries run concurrently (on the shared batch
+        pool) if config.batch_concurrency allows it.
+        """
+        if len(calls) < 2 or config.batch_concurrency <= 1:
+            return [self.parse_call(call, stream) for call in calls]
+        pool = self.json_request.batch_pool()
+        return pool.map(self.parse_call, calls, config.batch_concurrency)
+        
+    def build_responses(self, requests, request_errors, results, batch,
+        decode=0.0):
+        """
+        Puts the errors and call results back together in the order of
+        the requests (skipping the notifications), and encodes them.
+        The request is counted in the metrics, with the time it took
+        to decode ('decode') and encode.
+        """
+        started = timer()
+        results = iter(results)
         responses = []
-        for req in obj:
-            request_error = ProtocolError(-32600)
-            if type(req) is not dict:
-                responses.append(request_error.generate_error())
-            elif 'method' not in req.keys() or \
-                type(req['method']) not in types.StringTypes:
+        for req, request_error in zip(requests, request_errors):
+            if request_error:
                 responses.append(request_error.generate_error())
             else:
-                result = self.parse_call(req)
-                if req.has_key('id'):
+                result = next(results)
+                if 'id' in req:
                     response = generate_response(result, id=req.get('id'))
                     responses.append(response)
+        response = self.dump_responses(responses, batch)
+        method = None
+        if not batch and not request_errors[0]:
+            method = requests[0]['method']
+        self.metrics.add_request(method, decode, timer() - started)
+        return response
+        
+    def load_request(self, data):
+        """
+        Decodes the request text, and returns the list of request
+        objects and whether or not it was a batch.
+        """
+        try:
+            obj = self.codec.loads(data)
+        except ValueError:
+            raise ProtocolError(-32700)
+        if not obj:
+            raise ProtocolError(-32600)
+        if type(obj) is not list:
+            return [obj,], False
+        return obj, True
+        
+    def check_request(self, req):
+        """ Returns a ProtocolError if the request object is invalid. """
+        if type(req) is not dict or 'method' not in req.keys() or \
+            not isinstance(req['method'], STRING_TYPES):
+            self.metrics.add_error(-32600)
+            return ProtocolError(-32600)
+        return None
+        
+    def dump_responses(self, responses, batch):
+        """ Encodes the response object(s) for a request. """
         if not responses:
             # It's either a batch of notifications or a single
             # notification, so return nothing.
@@ -239,12 +778,91 @@ class ProcessRequest(object):
         else:
             if not batch:
                 # Single request
-                responses = responses[0]
-            return json.dumps(responses)
+                return self.dump_response(responses[0])
+            for response in responses:
+                if isinstance(response.get('result'), Encoded):
+                    return self.codec.join([
+                        self.dump_response(response)
+                        for response in responses
+                    ])
+            return self.codec.dumps(responses)
+            
+    def dump_response(self, response):
+        """
+        Encodes a response object -- an Encoded result (or a standard
+        error object) is spliced in as it is, rather than encoded again.
+        """
+        result = response.get('result')
+        if isinstance(result, Encoded):
+            return self.codec.envelope(
+                result.encode(self.codec), response.get('id')
+            )
+        if 'error' in response:
+            error = encoded_error(response['error'])
+            if error is not None:
+                return self.codec.envelope(
+                    error.encode(self.codec), response.get('id'), 'error'
+                )
+        return self.codec.dumps(response)
         
-    def parse_call(self, obj):
+    def parse_call(self, obj, stream=False):
         """
-        Parses a JSON request.
+        Parses a JSON request. An iterator result is collected into a
+        list, unless it's going to be streamed.
+        """
+        try:
+            handler, params, kwargs = self.get_call(obj)
+        except ProtocolError as error:
+            self.metrics.add_error(error.code)
+            return error
+        started = timer()
+        cache, key, found, response = self.get_cached(obj, params, kwargs)
+        if found:
+            self.metrics.add_call(obj['method'], timer() - started)
+            return response
+        try:
+            response = handler(*params, **kwargs)
+            if not stream and is_stream(response):
+                response = list(response)
+        except Exception:
+            error = self.handler_error(obj['method'])
+            self.metrics.add_call(obj['method'], timer() - started, error.code)
+            return error
+        self.metrics.add_call(obj['method'], timer() - started)
+        return self.set_cached(cache, key, response)
+
+    def get_cached(self, obj, params, kwargs):
+        """
+        Looks a call up in its method's result cache, returning the
+        cache and key (None if it isn't cached, or its parameters can't
+        be a key) and (found, result).
+        """
+        cache = self.json_request.caches.get(obj['method'])
+        if cache is None:
+            return None, None, False, None
+        key = cache_key(obj['method'], params, kwargs)
+        if key is None:
+            return None, None, False, None
+        found, response = cache.get(key)
+        return cache, key, found, response
+
+    def set_cached(self, cache, key, response):
+        """
+        Caches a result (unless it's streamed), returning it encoded,
+        so hits don't encode it again.
+        """
+        if cache is None or is_stream(response) or \
+            hasattr(response, '__aiter__'):
+            return response
+        if not isinstance(response, Encoded):
+            response = Encoded(response)
+        cache.set(key, response)
+        return response
+            
+    def get_call(self, obj):
+        """
+        Validates a JSON request and returns the handler and the
+        arguments it should be called with.
         """
             
         # Get ID, Notification if None
@@ -255,12 +873,12 @@ class ProcessRequest(object):
         jsonrpc = obj.get('jsonrpc', None)
         method = obj.get('method', None)
         if not jsonrpc or not method:
-            return ProtocolError(-32600)
+            raise ProtocolError(-32600)
         
         # Validate parameters
         params = obj.get('params', [])
         if type(params) not in (list, dict):
-            return ProtocolError(-32602)
+            raise ProtocolError(-32602)
         
         # Parse Request
         kwargs = {}
@@ -268,19 +886,25 @@ class ProcessRequest(object):
             kwargs = params
             params = []
         handler = self.json_request.get_handler(method)
-        error_code = None
-        message = None
-        if handler:
-            try:
-                response = handler(*params, **kwargs)
-                return response
-            except Exception:
-                logger.error('Error calling handler %s' % method)
-                message = traceback.format_exc().splitlines()[-1]
-                error_code = -32603
-        else:
-            error_code = -32601
-        return ProtocolError(error_code, message=message)
+        if not handler:
+            raise ProtocolError(-32601)
+        # Checked against the signature, rather than raising a TypeError
+        if not handler.accepts(params, kwargs):
+            raise ProtocolError(-32602)
+        return handler.function, params, kwargs
+        
+    def handler_error(self, method):
+        """ Logs a handler exception and returns the ProtocolError. """
+        # Only the last line of the traceback goes in the response, so
+        # the stack is only formatted (into the log) when debugging.
+        logger.error(
+            'Error calling handler %s', method,
+            exc_info=logger.isEnabledFor(logging.DEBUG)
+        )
+        error_type, error = sys.exc_info()[:2]
+        message = traceback.format_exception_only(error_type, error)[-1]
+        message = message.strip()
+        return ProtocolError(-32603, message=message)
             
 def generate_response(result, **kwargs):
     """
@@ -293,6 +917,14 @@ def generate_response(result, **kwargs):
         response.update(kwargs)
         return response
         
+def generate_chunk(items, request_id):
+    """ One part of a streamed result. """
+    return {'jsonrpc': '2.0', 'stream': items, 'id': request_id}
+        
+def is_stream(result):
+    """ Checks whether a result is an iterator (a generator, etc.) """
+    return hasattr(result, '__iter__') and iter(result) is result
+        
 def start_server(host, port, handler):
     """
     Wrapper around Server that pre-threads it.
@@ -322,7 +954,6 @@ def test_server():
         return sum(args)
         
     if '-v' in sys.argv:
-        import logging
         config.verbose = True
         logger.addHandler(logging.StreamHandler())
         logger.setLevel(logging.DEBUG)
@@ -0,0 +1,148 @@
+"""
+Session encryption for framed connections. Instead of encrypting each
+message with config.crypt (a new cipher object every time, padded with
+spaces, and unauthenticated), a framed connection made with a key can
+offer an AEAD cipher -- AES-GCM or ChaCha20-Poly1305, with the
+cryptography package -- and a random nonce in its preamble:
+
+    client: \\x00JRPC cipher=aesgcm,chacha20 framing=length nonce=...\\n
+    server: \\x00JRPC cipher=aesgcm framing=length nonce=...\\n
+
+Both ends derive the session key from the secret and the two nonces
+(HMAC-SHA256), so it's only worked out once per connection, and is
+different for every connection. Each frame is then the 12 byte AEAD
+nonce (a direction prefix and a counter) followed by the encrypted
+message and its tag. The frames going each way are sent in order on
+the one stream, so the receiver expects the counters in order too. A
+frame that was tampered with, encrypted with a different key, or
+replayed (or reordered) fails to decrypt with a -32700 error.
+
+The client's config.session_cipher picks the ciphers offered ('auto'
+for all of the installed ones, None to always encrypt each message
+with config.crypt instead).
+"""
+import binascii
+import hashlib
+import hmac
+import itertools
+import os
+import struct
+from jsonrpctcp import config
+from jsonrpctcp.errors import ProtocolError
+
+try:
+    from cryptography.hazmat.primitives.ciphers import aead
+except ImportError:
+    aead = None
+
+# The nonce prefixes of the frames going each way, so a frame can't be
+# reflected back to the end that sent it.
+CLIENT = b'\x00\x00\x00\x01'
+SERVER = b'\x00\x00\x00\x02'
+COUNTER = struct.Struct('!Q')
+NONCE_SIZE = 12
+TAG_SIZE = 16
+# Random bytes in each end's handshake nonce
+HANDSHAKE_NONCE_SIZE = 16
+
+# The ciphers that can be used here, best first.
+CIPHERS = {}
+AUTO_CIPHERS = []
+if aead is not None:
+    for name, cipher_class in (
+        ('aesgcm', aead.AESGCM), ('chacha20', aead.ChaCha20Poly1305)
+    ):
+        CIPHERS[name] = cipher_class
+        AUTO_CIPHERS.append(name)
+
+def offered():
+    """ The ciphers a client offers (config.session_cipher). """
+    if not config.session_cipher:
+        return []
+    if config.session_cipher == 'auto':
+        return list(AUTO_CIPHERS)
+    return [
+        name for name in config.session_cipher.split(',')
+        if name in CIPHERS
+    ]
+
+def new_nonce():
+    """ A random handshake nonce (as hex, for the preamble). """
+    nonce = os.urandom(HANDSHAKE_NONCE_SIZE)
+    return binascii.hexlify(nonce).decode('ascii')
+
+def session_key(secret, client_nonce, server_nonce):
+    """ Derives a connection's 32 byte key from the secret and nonces. """
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
+    message = ('jsonrpctcp session %s %s' % (client_nonce, server_nonce))
+    return hmac.new(
+        secret, message.encode('ascii'), hashlib.sha256
+    ).digest()
+
+def start(secret, offer, options, side):
+    """
+    Returns the Session for a connection, given the client's offer and
+    the server's answer -- or None if the client didn't offer one. A
+    client raises a ProtocolError if the server didn't accept it.
+    """
+    if 'cipher' not in offer:
+        return None
+    offer_ciphers = offer['cipher']
+    if not isinstance(offer_ciphers, (list, tuple)):
+        offer_ciphers = offer_ciphers.split(',')
+    cipher = options.get('cipher')
+    if cipher not in CIPHERS or cipher not in offer_ciphers or \
+        not options.get('nonce') or not offer.get('nonce'):
+        if side == 'server':
+            return None
+        raise ProtocolError(-32700, 'Server refused session encryption.')
+    key = session_key(secret, offer['nonce'], options['nonce'])
+    return Session(cipher, key, side)
+
+class Session(object):
+    """
+    The cipher state of one end of an encrypted connection. The
+    counter in the nonce never repeats for a key, since every
+    connection has its own key. The frames have to be encrypted in the
+    order they're sent (the senders encrypt and send under one lock).
+    """
+
+    def __init__(self, cipher, key, side):
+        self.cipher = cipher
+        self.aead = CIPHERS[cipher](key)
+        if side == 'client':
+            self.sending, self.receiving = CLIENT, SERVER
+        else:
+            self.sending, self.receiving = SERVER, CLIENT
+        self._counter = itertools.count()
+        # The counter of the next frame expected from the other end
+        self._received = 0
+
+    def encrypt(self, pieces):
+        """
+        Encrypts a message (in pieces), returning the frame body as the
+        nonce and the ciphertext (with the tag on the end).
+        """
+        nonce = self.sending + COUNTER.pack(next(self._counter))
+        return [nonce, self.aead.encrypt(nonce, b''.join(pieces), None)]
+
+    def decrypt(self, message):
+        """
+        Verifies and decrypts a frame body, returning a bytearray (the
+        tag or flag is cut off of the front of it in place).
+        """
+        nonce = bytes(message[:NONCE_SIZE])
+        expected = self.receiving + COUNTER.pack(self._received)
+        if len(message) < NONCE_SIZE + TAG_SIZE or nonce != expected:
+            # Reflected, replayed or out of order
+            raise ProtocolError(-32700, 'Could not decrypt message.')
+        try:
+            message = self.aead.decrypt(
+                nonce, memoryview(message)[NONCE_SIZE:], None
+            )
+        except Exception:
+            # cryptography's InvalidTag
+            raise ProtocolError(-32700, 'Could not decrypt message.')
+        self._received += 1
+        return bytearray(message)
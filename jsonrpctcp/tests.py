@@ -8,20 +8,38 @@ like class translation, etc.
 """
 from jsonrpctcp import connect, config, history
 from jsonrpctcp.server import Server
+from jsonrpctcp.connection import ConnectionPool
+from jsonrpctcp.framing import FrameParser, encode_frame, send_parts
+from jsonrpctcp.codec import get_codec, CODECS, AUTO_CODECS, BINARY_CODECS
+from jsonrpctcp.codec import Encoded
+from jsonrpctcp.compression import COMPRESSIONS, AUTO_COMPRESSIONS
+from jsonrpctcp.compression import compress, decompress, Decoder
+from jsonrpctcp.metrics import Metrics, Histogram
+from jsonrpctcp.hooks import CallHook
+from jsonrpctcp.cache import ResultCache, cached, canonical, cache_key
+from jsonrpctcp.handler import Handler, Method
+from jsonrpctcp import session
+from jsonrpctcp.tls import TLSSessions
 from jsonrpctcp import logger
 from jsonrpctcp.errors import ProtocolError, EncryptionMissing
 import unittest
 import os
+import sys
+import socket
+import ssl
+import subprocess
+import tempfile
 import time
 try:
     import json
 except ImportError:
     import simplejson as json
-from threading import Thread
+from threading import Thread, active_count
 import signal
 import logging
 
 CLIENT = connect('127.0.0.1', 8000)
+POOL_SERVER = None
 
 class TestCompatibility(unittest.TestCase):
     
@@ -206,7 +224,7 @@ class TestCompatibility(unittest.TestCase):
             response = None
             if request.get('method') != 'notify_hello':
                 req_id = request.get('id')
-                if verify_request.has_key('id'):
+                if 'id' in verify_request:
                     verify_request['id'] = req_id
                 verify_response = verify_responses[response_i]
                 verify_response['id'] = req_id
@@ -217,7 +235,7 @@ class TestCompatibility(unittest.TestCase):
             
         for response in responses:
             verify_response = responses_by_id.get(response.get('id'))
-            if verify_response.has_key('error'):
+            if 'error' in verify_response:
                 verify_response['error']['message'] = \
                     response['error']['message']
             self.assertTrue(response == verify_response)
@@ -280,9 +298,1478 @@ class TestEncryption(unittest.TestCase):
         result = client.sum(49, 51)
         self.assertTrue(result == 100)
         
+    def test_session_cipher(self):
+        client_nonce, server_nonce = session.new_nonce(), session.new_nonce()
+        key = session.session_key(config.secret, client_nonce, server_nonce)
+        self.assertTrue(len(key) == 32)
+        self.assertTrue(key == session.session_key(
+            config.secret, client_nonce, server_nonce
+        ))
+        self.assertTrue(key != session.session_key(
+            config.secret, server_nonce, client_nonce
+        ))
+        if not session.CIPHERS:
+            return
+        for cipher in session.CIPHERS:
+            client = session.Session(cipher, key, 'client')
+            server = session.Session(cipher, key, 'server')
+            nonce, body = client.encrypt([b'\x00\x00\x00\x01', b'hello'])
+            frame = bytearray(nonce + body)
+            self.assertTrue(server.decrypt(frame) == b'\x00\x00\x00\x01hello')
+            # Reflected back to the client
+            self.assertRaises(ProtocolError, client.decrypt, frame)
+            # A new nonce for every frame
+            frame = bytearray(b''.join(client.encrypt([b'hello'])))
+            self.assertTrue(bytes(frame[:session.NONCE_SIZE]) != nonce)
+            frame[-1] ^= 1
+            self.assertRaises(ProtocolError, server.decrypt, frame)
+            
+    @unittest.skipIf(not session.CIPHERS, 'needs the cryptography package')
+    def test_session_replay(self):
+        key = session.session_key(config.secret, 'a', 'b')
+        client = session.Session('aesgcm', key, 'client')
+        server = session.Session('aesgcm', key, 'server')
+        first = bytearray(b''.join(client.encrypt([b'first'])))
+        second = bytearray(b''.join(client.encrypt([b'second'])))
+        third = bytearray(b''.join(client.encrypt([b'third'])))
+        # Out of order
+        self.assertRaises(ProtocolError, server.decrypt, second)
+        self.assertTrue(server.decrypt(first) == b'first')
+        # Replayed
+        self.assertRaises(ProtocolError, server.decrypt, first)
+        self.assertTrue(server.decrypt(second) == b'second')
+        self.assertTrue(server.decrypt(third) == b'third')
+        
+    @unittest.skipIf(not session.CIPHERS, 'needs the cryptography package')
+    def test_session(self):
+        for kwargs in [{'persistent': True}, {'multiplex': True},
+            {'persistent': True, 'codec': 'msgpack'}]:
+            if kwargs.get('codec') and kwargs['codec'] not in BINARY_CODECS:
+                continue
+            client = connect('localhost', 8001, config.secret, **kwargs)
+            self.assertTrue(client.sum(49, 51) == 100)
+            self.assertTrue(client.sum(1, 2) == 3)
+            connection = client._connection
+            self.assertTrue(connection.reader.session.cipher == 'aesgcm')
+            connection.close()
+        client = connect('localhost', 8001, config.secret, pool=True)
+        self.assertTrue(client.sum(49, 51) == 100)
+        # With the wrong key, the server can't decrypt the frames.
+        client = connect('localhost', 8001, 'wrong key', persistent=True)
+        self.assertRaises((socket.error, ProtocolError), client.sum, 1, 2)
+        # A server without a secret doesn't accept session encryption.
+        config.secret = None
+        client = connect('localhost', 8001, 'key', persistent=True)
+        self.assertRaises(ProtocolError, client.sum, 1, 2)
+        
+    @unittest.skipIf(sys.version_info < (3, 7) or not session.CIPHERS,
+        'needs Python 3.7+ and the cryptography package')
+    def test_async_session(self):
+        import asyncio
+        from jsonrpctcp.asyncclient import connect as async_connect
+        loop = asyncio.new_event_loop()
+        try:
+            client = async_connect('127.0.0.1', 8003, config.secret)
+            result = loop.run_until_complete(client.sum(49, 51))
+            self.assertTrue(result == 100)
+            self.assertTrue(client._connection.session.cipher == 'aesgcm')
+            loop.run_until_complete(client._close())
+        finally:
+            loop.close()
+        
+    def tearDown(self):
+        config.secret = None
+        
+class TestPool(unittest.TestCase):
+    
+    def test_pool(self):
+        threads = []
+        results = []
+        def call(i):
+            client = connect('127.0.0.1', 8002)
+            results.append(client.sum(i, 1))
+        for i in range(10):
+            thread = Thread(target=call, args=(i,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.assertTrue(sorted(results) == list(range(1, 11)))
+        stats = POOL_SERVER.stats()
+        self.assertTrue(stats['workers'] == 2)
+        self.assertTrue(stats['queue_size'] == 2)
+        self.assertTrue(stats['submitted'] >= 10)
+        self.assertTrue(stats['max_queued'] <= 2)
+        
+    def test_idle_multiplexed(self):
+        # Open multiplexed clients don't hold on to the two workers
+        # either, or start threads of their own.
+        client = connect('127.0.0.1', 8002, multiplex=True)
+        client.sum(1, 1)
+        client._close()
+        threads = active_count()
+        clients = [
+            connect('127.0.0.1', 8002, multiplex=True) for i in range(4)
+        ]
+        for client in clients:
+            self.assertTrue(client.sum(1, 2) == 3)
+        start = time.time()
+        self.assertTrue(connect('127.0.0.1', 8002).sum(2, 2) == 4)
+        self.assertTrue(time.time() - start < 1)
+        # (Each client has a thread reading its responses.)
+        self.assertTrue(active_count() <= threads + 4)
+        for client in clients:
+            self.assertTrue(client.sum(3, 4) == 7)
+            client._close()
+        
+    def test_idle_connections(self):
+        # Idle persistent clients don't hold on to the two workers.
+        clients = [
+            connect('127.0.0.1', 8002, persistent=True) for i in range(4)
+        ]
+        for client in clients:
+            self.assertTrue(client.sum(1, 2) == 3)
+        start = time.time()
+        self.assertTrue(connect('127.0.0.1', 8002).sum(2, 2) == 4)
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(POOL_SERVER.stats()['idle_connections'] >= 4)
+        for client in clients:
+            self.assertTrue(client.sum(3, 4) == 7)
+            client._close()
+        
+class TestHistory(unittest.TestCase):
+    
+    def tearDown(self):
+        config.trace = True
+        config.trace_sample = 1.0
+        config.trace_size = 100
+        
+    def test_threads(self):
+        CLIENT.sum(1, 2)
+        request = history.request
+        def call():
+            connect('127.0.0.1', 8000).subtract(5, 2)
+        thread = Thread(target=call)
+        thread.start()
+        thread.join()
+        # The other thread (and the server's) don't touch this one's.
+        self.assertTrue(history.request is request)
+        self.assertTrue(json.loads(history.response)['result'] == 3)
+        
+    def test_ring_buffer(self):
+        history.clear()
+        config.trace_size = 3
+        for i in range(5):
+            CLIENT.sum(i)
+        traces = history.traces()
+        client_traces = [t for t in traces if t.side == 'client']
+        self.assertTrue(len(traces) <= 3)
+        self.assertTrue(json.loads(client_traces[-1].request)['params'] == [4])
+        self.assertTrue(json.loads(client_traces[-1].response)['result'] == 4)
+        
+    def test_sampling(self):
+        history.clear()
+        config.trace_sample = 0
+        CLIENT.sum(1, 2)
+        self.assertTrue(history.traces() == [])
+        self.assertTrue(json.loads(history.response)['result'] == 3)
+        request = history.request
+        config.trace = False
+        CLIENT.sum(3, 4)
+        self.assertTrue(history.request is request)
+        
+class ListHandler(logging.Handler):
+    
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        
+    def emit(self, record):
+        self.records.append(record)
+        
+class TestLogging(unittest.TestCase):
+    
+    def setUp(self):
+        self.handler = ListHandler()
+        self.level = logger.level
+        logger.addHandler(self.handler)
+        
+    def tearDown(self):
+        logger.removeHandler(self.handler)
+        logger.setLevel(self.level)
+        config.log_messages = True
+        config.log_truncate = 1000
+        
+    def messages(self):
+        return [
+            record.getMessage() for record in self.handler.records
+            if record.getMessage().startswith('CLIENT')
+        ]
+        
+    def test_truncate(self):
+        logger.setLevel(logging.DEBUG)
+        config.log_truncate = 20
+        CLIENT.update('x' * 100)
+        request, response = self.messages()
+        self.assertTrue(request.startswith('CLIENT | REQUEST: '))
+        self.assertTrue(len(request) < 70 and request.endswith('total)'))
+        config.log_truncate = None
+        CLIENT.update('x' * 100)
+        self.assertTrue('x' * 100 in self.messages()[-1])
+        
+    def test_disabled(self):
+        logger.setLevel(logging.INFO)
+        CLIENT.sum(1, 2)
+        logger.setLevel(logging.DEBUG)
+        config.log_messages = False
+        CLIENT.sum(1, 2)
+        self.assertTrue(self.messages() == [])
+        
+class TestCache(unittest.TestCase):
+    
+    def setUp(self):
+        POOL_SERVER.invalidate()
+        del LOOKUPS[:]
+        
+    def test_cached(self):
+        client = connect('127.0.0.1', 8002)
+        self.assertTrue(client.lookup(1) == 2)
+        self.assertTrue(client.lookup(1) == 2)
+        self.assertTrue(client.lookup(key=1) == 2)
+        self.assertTrue(LOOKUPS == [1, 1])
+        stats = POOL_SERVER.stats()['caches']['lookup']
+        self.assertTrue(stats['hits'] == 1 and stats['misses'] == 2)
+        self.assertTrue(stats['hit_rate'] > 0.3)
+        # Errors aren't cached.
+        self.assertRaises(ProtocolError, client.lookup, 'x')
+        self.assertRaises(ProtocolError, client.lookup, 'x')
+        self.assertTrue(LOOKUPS == [1, 1, 'x', 'x'])
+        
+    def test_invalidate(self):
+        client = connect('127.0.0.1', 8002)
+        client.lookup(1)
+        client.lookup(2)
+        POOL_SERVER.invalidate('lookup', [1])
+        client.lookup(1)
+        client.lookup(2)
+        self.assertTrue(LOOKUPS == [1, 2, 1])
+        POOL_SERVER.invalidate('lookup')
+        client.lookup(2)
+        self.assertTrue(LOOKUPS == [1, 2, 1, 2])
+        
+    def test_lru(self):
+        client = connect('127.0.0.1', 8002)
+        for key in (1, 2, 1, 3, 1, 2):
+            client.lookup(key)
+        # It only holds two, so 2 was dropped for 3, and 3 for 2.
+        self.assertTrue(LOOKUPS == [1, 2, 3, 2])
+        self.assertTrue(POOL_SERVER.stats()['caches']['lookup']['evicted'])
+        
+    def test_expiry(self):
+        cache = ResultCache(ttl=-1, size=10)
+        cache.set('key', 'result')
+        self.assertTrue(cache.get('key') == (False, None))
+        self.assertTrue(cache.stats()['expired'] == 1)
+        cache = ResultCache()
+        cache.set('key', 'result')
+        self.assertTrue(cache.get('key') == (True, 'result'))
+        
+    def test_canonical(self):
+        self.assertTrue(
+            canonical({'a': [1, {'b': 2, 'c': 3}]}) ==
+            canonical({'a': [1, {'c': 3, 'b': 2}]})
+        )
+        self.assertTrue(canonical([1]) != canonical([1.0]))
+        self.assertTrue(canonical([1]) != canonical([True]))
+        self.assertTrue(canonical([1]) != canonical({'0': 1}))
+        
+    def test_cache_key(self):
+        self.assertTrue(cache_key('a', [1], {}) != cache_key('b', [1], {}))
+        # Maps with keys of mixed types (msgpack, CBOR) still sort.
+        self.assertTrue(
+            cache_key('a', [], {1: 'x', 'y': 2}) ==
+            cache_key('a', [], {'y': 2, 1: 'x'})
+        )
+        self.assertTrue(cache_key('a', [{(1, 2): [3]}], {}) is not None)
+        
+    def test_shared(self):
+        # One cache for all of a Handler's methods
+        class Users(Handler):
+            def name(self, uid):
+                return 'name-%s' % uid
+            def email(self, uid):
+                return 'email-%s' % uid
+        POOL_SERVER.add_handler(Users, 'users', cache=ResultCache(60, 100))
+        client = connect('127.0.0.1', 8002)
+        self.assertTrue(client.users.name(1) == 'name-1')
+        self.assertTrue(client.users.email(1) == 'email-1')
+        self.assertTrue(client.users.email(1) == 'email-1')
+        POOL_SERVER.invalidate('users.name')
+        cache = POOL_SERVER.json_request.caches['users.email']
+        self.assertTrue(cache.stats()['size'] == 1)
+        
+class TestDispatch(unittest.TestCase):
+    
+    def test_accepts(self):
+        def method(a, b=1, *args):
+            pass
+        def named(a, b=1, **kwargs):
+            pass
+        subtract = Method(lambda minuend, subtrahend: None)
+        self.assertTrue(subtract.accepts([1, 2], {}))
+        self.assertFalse(subtract.accepts([1], {}))
+        self.assertFalse(subtract.accepts([1, 2, 3], {}))
+        self.assertTrue(subtract.accepts([], {'minuend': 1, 'subtrahend': 2}))
+        self.assertFalse(subtract.accepts([], {'minuend': 1}))
+        self.assertFalse(subtract.accepts([], {'minuend': 1, 'foo': 2}))
+        self.assertTrue(Method(method).accepts([1, 2, 3, 4], {}))
+        self.assertFalse(Method(method).accepts([], {}))
+        self.assertTrue(Method(named).accepts([], {'a': 1, 'foo': 2}))
+        self.assertFalse(Method(named).accepts([1, 2, 3], {}))
+        # Builtins without a signature aren't checked
+        self.assertTrue(Method(max).checked is False or \
+            Method(max).accepts([1, 2], {}))
+        
+    def test_calls(self):
+        """ Bad parameters get -32602, without calling the handler. """
+        for params in [(1,), (1, 2, 3)]:
+            try:
+                CLIENT.subtract(*params)
+            except ProtocolError as error:
+                self.assertTrue(error.code == -32602)
+            else:
+                self.fail('No error raised')
+        try:
+            CLIENT.subtract(minuend=1, foo=2)
+        except ProtocolError as error:
+            self.assertTrue(error.code == -32602)
+        else:
+            self.fail('No error raised')
+        self.assertTrue(CLIENT.subtract(subtrahend=1, minuend=3) == 2)
+        self.assertTrue(CLIENT.namespace.sum(1, 2, 3) == 6)
+        
+class TestErrors(unittest.TestCase):
+    
     def tearDown(self):
         config.secret = None
         
+    def test_generate_error(self):
+        response = ProtocolError(-32601).generate_error(id=5)
+        self.assertTrue(response == {
+            'jsonrpc': '2.0', 'id': 5,
+            'error': {'code': -32601, 'message': 'Method not found.'}
+        })
+        error = ProtocolError(-32603, message='ValueError: bad')
+        self.assertTrue(error.generate_error()['error'] == {
+            'code': -32603, 'message': 'ValueError: bad'
+        })
+        
+    def test_encode(self):
+        for name in ['json'] + BINARY_CODECS:
+            codec = get_codec(name)
+            for error in (ProtocolError(-32601), ProtocolError(-32601, 'x')):
+                message = error.encode(codec, 5)
+                self.assertTrue(
+                    codec.loads(message) == error.generate_error(id=5)
+                )
+        # The responses don't share the standard error objects.
+        response = ProtocolError(-32601).generate_error()
+        response['error']['message'] = 'Changed.'
+        self.assertTrue(ProtocolError(-32601).generate_error()['error'] == {
+            'code': -32601, 'message': 'Method not found.'
+        })
+        
+    def test_padding(self):
+        config.secret = '12345abcdef67890'
+        first = ProtocolError(-32601).generate_error()['error']['message']
+        second = ProtocolError(-32601).generate_error()['error']['message']
+        self.assertTrue(first.startswith('Method not found. (random: '))
+        self.assertTrue(len(first) == len('Method not found. (random: )') + 12)
+        self.assertTrue(first != second)
+        
+    def test_handler_error(self):
+        try:
+            CLIENT.sum('a', 1)
+        except ProtocolError as error:
+            self.assertTrue(error.code == -32603)
+            self.assertTrue(error.message.startswith('TypeError: '))
+        else:
+            self.fail('No error raised')
+        
+class TestClientCache(unittest.TestCase):
+    
+    def setUp(self):
+        del SLOW_LOOKUPS[:]
+        
+    def test_cache(self):
+        client = connect('127.0.0.1', 8000)
+        client._cache('slow_lookup', ttl=60)
+        client._cache('namespace')
+        self.assertTrue(client.slow_lookup('a') == 'a')
+        self.assertTrue(client.slow_lookup('a') == 'a')
+        self.assertTrue(client.slow_lookup('b') == 'b')
+        self.assertTrue(SLOW_LOOKUPS == ['a', 'b'])
+        self.assertTrue(client.namespace.sum(1, 2) == 3)
+        self.assertTrue(client.namespace.sum(1, 2) == 3)
+        stats = client._cache_stats()
+        self.assertTrue(stats['slow_lookup']['hits'] == 1)
+        self.assertTrue(stats['namespace']['hits'] == 1)
+        client._invalidate('slow_lookup')
+        client.slow_lookup('a')
+        self.assertTrue(SLOW_LOOKUPS == ['a', 'b', 'a'])
+        # Notifications and errors aren't cached.
+        client._notification.slow_lookup('a')
+        client._cache('foobar')
+        self.assertRaises(ProtocolError, client.foobar)
+        self.assertRaises(ProtocolError, client.foobar)
+        self.assertTrue(client._cache_stats()['foobar']['misses'] == 2)
+        
+    def test_single_flight(self):
+        client = connect('127.0.0.1', 8000)
+        client._cache('slow_lookup')
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(client.slow_lookup('x')))
+            for i in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(results == ['x'] * 5)
+        self.assertTrue(SLOW_LOOKUPS == ['x'])
+        
+    def test_copies(self):
+        client = connect('127.0.0.1', 8000)
+        client._cache('slow_lookup')
+        results = []
+        threads = [
+            Thread(target=lambda: results.append(client.slow_lookup(['x'])))
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Changing one caller's result doesn't change the others'.
+        results[0].append('y')
+        self.assertTrue(results[1:] == [['x'], ['x']])
+        client.slow_lookup(['x']).append('z')
+        self.assertTrue(client.slow_lookup(['x']) == ['x'])
+        self.assertTrue(SLOW_LOOKUPS == [['x']])
+        
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs Python 3.7+')
+    def test_async(self):
+        import asyncio
+        from jsonrpctcp.asyncclient import connect as async_connect
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            client = async_connect('127.0.0.1', 8000)
+            client._cache('slow_lookup')
+            calls = [client.slow_lookup('y') for i in range(5)]
+            results = loop.run_until_complete(asyncio.gather(*calls))
+            self.assertTrue(results == ['y'] * 5)
+            result = loop.run_until_complete(client.slow_lookup('y'))
+            self.assertTrue(result == 'y' and SLOW_LOOKUPS == ['y'])
+            # Cancelling the call that sent the request doesn't cancel
+            # the others waiting for it.
+            first = asyncio.ensure_future(client.slow_lookup('z'))
+            second = asyncio.ensure_future(client.slow_lookup('z'))
+            loop.run_until_complete(asyncio.sleep(0.02))
+            first.cancel()
+            result = loop.run_until_complete(second)
+            self.assertTrue(result == 'z' and SLOW_LOOKUPS == ['y', 'z'])
+            loop.run_until_complete(client._close())
+        finally:
+            loop.close()
+        
+class TestEncoded(unittest.TestCase):
+    
+    def test_envelope(self):
+        result = {"a": [1, 2.5, None], "b": u"\u00e9"}
+        for name in list(CODECS):
+            codec = get_codec(name)
+            message = codec.envelope(Encoded(result).encode(codec), 'x')
+            self.assertTrue(codec.loads(message) == {
+                "jsonrpc": "2.0", "result": result, "id": "x"
+            })
+            # Enough messages for the longer CBOR array header
+            messages = [codec.dumps(i) for i in range(30)]
+            self.assertTrue(codec.loads(codec.join(messages)) == 
+                list(range(30)))
+        
+    def test_calls(self):
+        codecs = [{}] + [{'codec': name} for name in BINARY_CODECS]
+        for kwargs in codecs:
+            client = connect('127.0.0.1', 8000, **kwargs)
+            self.assertTrue(client.get_config() == CONFIG.obj)
+            self.assertTrue(client.get_raw() == {'raw': [1, 2]})
+            batch = client._batch()
+            batch.get_config()
+            batch.sum(1, 2)
+            batch.get_raw()
+            self.assertTrue(
+                list(batch()) == [CONFIG.obj, 3, {'raw': [1, 2]}]
+            )
+        self.assertTrue(
+            sorted(CONFIG._encoded) == sorted(['json'] + BINARY_CODECS)
+        )
+        
+    def test_cache(self):
+        # Cached results are kept encoded.
+        POOL_SERVER.invalidate()
+        client = connect('127.0.0.1', 8002)
+        self.assertTrue(client.lookup(5) == 10)
+        self.assertTrue(client.lookup(5) == 10)
+        cache = POOL_SERVER.json_request.caches['lookup']
+        found, result = cache.get(cache_key('lookup', [5], {}))
+        self.assertTrue(found and isinstance(result, Encoded))
+        
+class TestMetrics(unittest.TestCase):
+    
+    def test_stats(self):
+        client = connect('127.0.0.1', 8002)
+        client.sum(1, 2)
+        client.update('a', 'b')
+        self.assertRaises(ProtocolError, client.foobar)
+        batch = client._batch()
+        batch.sum(1)
+        batch.sum(2)
+        batch()
+        stats = client.system.stats()
+        self.assertTrue(stats['methods']['sum']['calls'] >= 3)
+        self.assertTrue(stats['methods']['update']['errors'] == 0)
+        self.assertTrue(stats['errors']['-32601'] >= 1)
+        self.assertTrue(stats['requests'] >= 4)
+        self.assertTrue(stats['requests_per_second'] > 0)
+        self.assertTrue(stats['connections'] >= 1)
+        handler = stats['methods']['sum']['handler']
+        self.assertTrue(handler['count'] == sum(handler['buckets']))
+        self.assertTrue(handler['p50'] <= handler['max'])
+        self.assertTrue(stats['methods']['update']['decode']['count'] >= 1)
+        self.assertTrue('threads' not in stats and stats['workers'] == 2)
+        
+    def test_stats_method(self):
+        # It's only there if config.stats_method was set.
+        client = connect('127.0.0.1', 8000)
+        self.assertRaises(ProtocolError, client.system.stats)
+        
+    def test_histogram(self):
+        histogram = Histogram()
+        for i in range(99):
+            histogram.add(0.0002)
+        histogram.add(20)
+        stats = histogram.stats()
+        self.assertTrue(stats['count'] == 100)
+        self.assertTrue(stats['p50'] == 0.00025)
+        self.assertTrue(stats['p99'] == 0.00025)
+        self.assertTrue(histogram.percentile(1) == 20)
+        self.assertTrue(stats['buckets'][1] == 99)
+        self.assertTrue(stats['buckets'][-1] == 1)
+        
+    def test_disabled(self):
+        config.metrics = False
+        try:
+            metrics = Metrics()
+            metrics.add_request('sum')
+            metrics.add_call('sum', 0.1)
+            metrics.add_error(-32700)
+            stats = metrics.stats()
+        finally:
+            config.metrics = True
+        self.assertTrue(stats['requests'] == 0)
+        self.assertTrue(stats['methods'] == {} and stats['errors'] == {})
+        
+class RecordingHook(CallHook):
+    
+    def __init__(self):
+        self.before = []
+        self.after = []
+        
+    def before_call(self, call):
+        self.before.append(call)
+        
+    def after_call(self, call):
+        self.after.append(call)
+        
+class BrokenHook(CallHook):
+    
+    def after_call(self, call):
+        raise ValueError('Broken!')
+        
+class TestHooks(unittest.TestCase):
+    
+    def test_hooks(self):
+        hook = RecordingHook()
+        client = connect('127.0.0.1', 8000, hooks=[BrokenHook(), hook])
+        self.assertTrue(client.sum(1, 2) == 3)
+        self.assertRaises(ProtocolError, client.foobar)
+        call, failed = hook.after
+        self.assertTrue(hook.before == hook.after)
+        self.assertTrue(call.method == 'sum' and call.ok)
+        self.assertTrue(call.request_size > 0 and call.response_size > 0)
+        self.assertTrue(call.connect > 0 and call.wait > 0)
+        self.assertTrue(
+            call.total >= call.connect + call.send + call.wait
+        )
+        self.assertTrue(failed.method == 'foobar' and not failed.ok)
+        self.assertTrue(failed.error.code == -32601)
+        
+    def test_batch(self):
+        hook = RecordingHook()
+        client = connect('127.0.0.1', 8000)
+        client._add_hook(hook)
+        batch = client._batch()
+        batch.sum(1)
+        batch._notification.notify_hello(7)
+        batch()
+        call, = hook.after
+        self.assertTrue(call.batch and call.method is None)
+        self.assertTrue(call.methods == ['sum', 'notify_hello'])
+        
+    def test_persistent(self):
+        hook = RecordingHook()
+        client = connect('127.0.0.1', 8000, persistent=True, hooks=[hook])
+        client.sum(1, 2)
+        client.sum(3, 4)
+        self.assertTrue(list(client._stream.count(5)) == list(range(5)))
+        first, second, stream = hook.after
+        self.assertTrue(first.connect > 0 and second.connect == 0)
+        self.assertTrue(second.wait > 0)
+        self.assertTrue(stream.stream and stream.ok)
+        self.assertTrue(stream.method == 'count')
+        self.assertTrue(stream.response_size > 0)
+        client._close()
+        
+class TestPersistent(unittest.TestCase):
+    
+    def test_persistent(self):
+        client = connect('127.0.0.1', 8000, persistent=True)
+        self.assertTrue(client.sum(1, 2) == 3)
+        sock = client._connection.socket
+        self.assertTrue(client.subtract(minuend=42, subtrahend=23) == 19)
+        self.assertTrue(client._notification.update(1, 2) == None)
+        self.assertTrue(client.namespace.sum(1, 2, 4) == 7)
+        self.assertRaises(ProtocolError, client.foobar)
+        batch = client._batch()
+        batch.sum(1, 2)
+        batch._notification.update(3)
+        batch.subtract(42, 23)
+        self.assertTrue(list(batch()) == [3, 19])
+        self.assertTrue(client._connection.socket is sock)
+        self.assertTrue(client._connection.requests == 6)
+        client._close()
+        
+    def test_newline(self):
+        framing = config.framing
+        config.framing = 'newline'
+        try:
+            client = connect('127.0.0.1', 8000, persistent=True)
+        finally:
+            config.framing = framing
+        self.assertTrue(client._connection.framing == 'newline')
+        self.assertTrue(client.sum(1, 2) == 3)
+        self.assertTrue(client.get_data() == ['hello', 5])
+        self.assertTrue(client._connection.requests == 2)
+        client._close()
+        
+    def test_reconnect(self):
+        client = connect('127.0.0.1', 8000, persistent=True)
+        self.assertTrue(client.sum(1, 2) == 3)
+        # Pretend the server dropped the idle connection.
+        client._connection.socket.shutdown(socket.SHUT_RDWR)
+        self.assertTrue(client.sum(2, 3) == 5)
+        client._close()
+        
+    def test_no_resend(self):
+        # A server that answers the first request on a connection, then
+        # drops it after reading the second one.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        accepted = []
+        def read(sock, reader, method):
+            message = method()
+            while message is None:
+                reader.feed(sock.recv(4096))
+                message = method()
+            return message
+        def serve():
+            while True:
+                try:
+                    sock = listener.accept()[0]
+                except socket.error:
+                    return
+                accepted.append(sock)
+                reader = FrameParser('length')
+                read(sock, reader, reader.next_line)
+                sock.sendall(b'\x00JRPC framing=length stream=1\n')
+                request = read(sock, reader, reader.next_frame)
+                request = json.loads(bytes(request[1:]).decode('utf-8'))
+                response = json.dumps(
+                    {'jsonrpc': '2.0', 'result': 3, 'id': request['id']}
+                )
+                sock.sendall(encode_frame(
+                    b'\x00' + response.encode('utf-8'), 'length'
+                ))
+                read(sock, reader, reader.next_frame)
+                sock.close()
+        thread = Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        client = connect(*listener.getsockname(), persistent=True)
+        self.assertTrue(client.sum(1, 2) == 3)
+        # The server may have run it, so it isn't sent again.
+        self.assertRaises(socket.error, client.sum, 1, 2)
+        self.assertTrue(len(accepted) == 1)
+        listener.close()
+        
+class TestFraming(unittest.TestCase):
+    
+    def setUp(self):
+        self.framing = config.framing
+        
+    def test_netstring(self):
+        config.framing = 'netstring'
+        client = connect('127.0.0.1', 8000, persistent=True)
+        self.assertTrue(client.sum(1, 2) == 3)
+        data = ['x' * config.buffer] * 5
+        self.assertTrue(client.update(*data) == data)
+        self.assertTrue(client._connection.requests == 2)
+        client._close()
+        
+    def test_one_shot(self):
+        config.framing = 'length'
+        client = connect('127.0.0.1', 8000)
+        # Fill the buffer exactly, which the plain protocol can only
+        # detect by timing out.
+        padding = config.buffer - len(get_codec().dumps(
+            {"jsonrpc": "2.0", "result": [''], "id": 'x' * 36}
+        ))
+        start = time.time()
+        result = client.update('x' * padding)
+        self.assertTrue(result == ['x' * padding])
+        self.assertTrue(len(history.response) == config.buffer)
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(client._notification.update(1) == None)
+        
+    def test_large_buffer(self):
+        # Reads bigger than 64K aren't cut short.
+        buffer = config.buffer
+        config.buffer = 131072
+        try:
+            client = connect('127.0.0.1', 8000)
+            data = 'x' * 300000
+            self.assertTrue(client.update(data) == [data])
+        finally:
+            config.buffer = buffer
+        
+    def test_parser(self):
+        for framing in ('length', 'netstring', 'newline'):
+            parser = FrameParser(framing)
+            data = encode_frame(b'{"id": 1}', framing) * 3
+            messages = []
+            # Fed a byte at a time, like a (very) slow connection.
+            for i in range(len(data)):
+                parser.feed(data[i:i+1])
+                message = parser.next_frame()
+                if message is not None:
+                    messages.append(message)
+            self.assertTrue(messages == [b'{"id": 1}'] * 3)
+            self.assertTrue(len(parser.data) == 0)
+        
+    @unittest.skipIf(not hasattr(socket, 'socketpair'), 'needs socketpair')
+    def test_send_parts(self):
+        # Much more than the socket buffers hold, so sendmsg only
+        # writes part of it at a time.
+        parts = [b'header', b'x' * 3000000, b'', b'y' * 1000000, b',']
+        expected = b''.join(parts)
+        for sock_class in (None, SendallSocket):
+            sender, receiver = socket.socketpair()
+            received = bytearray()
+            def receive():
+                while len(received) < len(expected):
+                    received.extend(receiver.recv(65536))
+            thread = Thread(target=receive)
+            thread.start()
+            if sock_class:
+                sender = sock_class(sender)
+            self.assertTrue(send_parts(sender, parts) == len(expected))
+            thread.join()
+            self.assertTrue(received == expected)
+            sender.close()
+            receiver.close()
+        
+    def test_sent(self):
+        data = ['x' * 100000] * 20
+        client = connect('127.0.0.1', 8002, persistent=True)
+        self.assertTrue(client.update(*data) == data)
+        self.assertTrue(client._connection.bytes_sent > 2000000)
+        # The server counts the response once it has finished sending it.
+        for attempt in range(50):
+            if POOL_SERVER.stats()['bytes_sent'] >= 2000000:
+                break
+            time.sleep(0.01)
+        self.assertTrue(POOL_SERVER.stats()['bytes_sent'] >= 2000000)
+        client._close()
+        
+    def test_refused(self):
+        sock = socket.create_connection(('127.0.0.1', 8000))
+        sock.sendall(b'\x00JRPC framing=bogus\n')
+        response = sock.recv(config.buffer)
+        sock.close()
+        self.assertTrue(response == b'\x00JRPC error=unsupported\n')
+
+    def test_bad_preamble(self):
+        ports = [8000]
+        if sys.version_info >= (3, 7):
+            ports.append(8003)
+        for port in ports:
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.settimeout(5)
+            sock.sendall(b'\x00JRPC framing=\xff\xfe\n')
+            response = b''
+            data = sock.recv(config.buffer)
+            while data:
+                response += data
+                data = sock.recv(config.buffer)
+            sock.close()
+            self.assertTrue(response == b'\x00JRPC error=invalid\n')
+
+    def tearDown(self):
+        config.framing = self.framing
+        
+class TestStream(unittest.TestCase):
+    
+    def test_stream(self):
+        client = connect('127.0.0.1', 8000, persistent=True)
+        results = client._stream.count(250)
+        self.assertTrue(next(results) == 0)
+        self.assertTrue(list(results) == list(range(1, 250)))
+        # Normal calls get the whole list.
+        self.assertTrue(client.count(5) == [0, 1, 2, 3, 4])
+        self.assertTrue(list(client._stream.get_data()) == ['hello', 5])
+        # The streams had connections of their own.
+        self.assertTrue(client._connection.requests == 1)
+        client._close()
+        
+    def test_calls_while_streaming(self):
+        client = connect('127.0.0.1', 8000, persistent=True)
+        sums = [client.sum(i, 1) for i in client._stream.count(150)]
+        self.assertTrue(sums == list(range(1, 151)))
+        client._close()
+        
+    def test_transports(self):
+        framing = config.framing
+        pool = ConnectionPool()
+        try:
+            for kwargs in ({}, {'multiplex': True}, {'pool': pool}):
+                client = connect('127.0.0.1', 8000, **kwargs)
+                results = client._stream.count(150)
+                self.assertTrue(list(results) == list(range(150)))
+                client._close()
+            config.framing = 'length'
+            client = connect('127.0.0.1', 8000)
+            results = client._stream.count(150)
+            self.assertTrue(list(results) == list(range(150)))
+        finally:
+            config.framing = framing
+            pool.clear()
+        
+    def test_errors(self):
+        client = connect('127.0.0.1', 8000, persistent=True)
+        results = client._stream.count(150, True)
+        self.assertTrue(len([next(results) for i in range(100)]) == 100)
+        self.assertRaises(ProtocolError, list, results)
+        self.assertRaises(ProtocolError, client.count, 5, True)
+        # An abandoned stream closes the connection.
+        results = client._stream.count(1000)
+        next(results)
+        results.close()
+        self.assertTrue(client.sum(1, 2) == 3)
+        client._close()
+        
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs Python 3.7+')
+    def test_async_server(self):
+        client = connect('127.0.0.1', 8003, persistent=True)
+        for method in ('count', 'async_count'):
+            results = getattr(client._stream, method)(250)
+            self.assertTrue(list(results) == list(range(250)))
+            self.assertTrue(getattr(client, method)(3) == [0, 1, 2])
+        self.assertRaises(ProtocolError, list, client._stream.count(5, True))
+        client._close()
+        
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs Python 3.7+')
+    def test_async_client(self):
+        import asyncio
+        from jsonrpctcp.asyncclient import connect as async_connect
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            client = async_connect('127.0.0.1', 8003)
+            results = loop.run_until_complete(client._stream.count(150))
+            self.assertTrue(list(results) == list(range(150)))
+            loop.run_until_complete(client._close())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        
+class TestCodec(unittest.TestCase):
+    
+    def test_codecs(self):
+        obj = {
+            "jsonrpc": "2.0", "method": "sum", "id": "1",
+            "params": {"text": u"\u00e9\n", "number": 1.5, "list": [None]}
+        }
+        for name in AUTO_CODECS:
+            codec = get_codec(name)
+            encoded = codec.dumps(obj)
+            self.assertTrue(json.loads(encoded) == obj)
+            self.assertTrue(codec.loads(json.dumps(obj)) == obj)
+            self.assertTrue(codec.loads(encoded) == obj)
+            if not isinstance(encoded, bytes):
+                encoded = encoded.encode('utf-8')
+            self.assertTrue(b'\n' not in encoded)
+            # Falls back to the standard library for what it can't do.
+            self.assertTrue(json.loads(codec.dumps({1: 2 ** 70})) == {
+                '1': 2 ** 70
+            })
+            self.assertRaises(ValueError, codec.loads, '{"foo": ')
+        self.assertRaises(ValueError, get_codec, 'bogus')
+        
+    def test_calls(self):
+        codec = config.codec
+        try:
+            for name in AUTO_CODECS:
+                config.codec = name
+                client = connect('127.0.0.1', 8000)
+                self.assertTrue(client.update(u'\u00e9', 1) == [u'\u00e9', 1])
+                self.assertRaises(ProtocolError, client.foobar)
+        finally:
+            config.codec = codec
+        
+class TestCompression(unittest.TestCase):
+    
+    def setUp(self):
+        self.compression = config.compression
+        config.compression = 'auto'
+        
+    def test_compress(self):
+        message = b'{"result": "' + b'x' * 100000 + b'"}'
+        for name in COMPRESSIONS:
+            compressed = compress(message, name)
+            self.assertTrue(len(compressed) < len(message) / 10)
+            decoder = Decoder(name)
+            for start in range(0, len(compressed), 100):
+                decoder.feed(compressed[start:start+100])
+            self.assertTrue(decoder.finish() == message)
+            # Small messages aren't worth compressing.
+            self.assertTrue(compress(b'{}', name) == b'\x00{}')
+            self.assertTrue(decompress(b'\x00{}', name) == b'{}')
+            if sys.version_info[0] > 2:
+                # (Python 2's zlib can't tell if the stream is complete.)
+                self.assertRaises(
+                    ProtocolError, decompress, compressed[:-10], name
+                )
+        
+    def test_max_frame(self):
+        max_frame = config.max_frame
+        config.max_frame = 1000
+        try:
+            compressed = compress(b'x' * 1000000, 'zlib')
+            decoder = Decoder('zlib')
+            self.assertRaises(ProtocolError, decoder.feed, compressed)
+            # It stopped decompressing just past the limit.
+            self.assertTrue(len(decoder.message) == 1001)
+            if 'zstd' in COMPRESSIONS:
+                compressed = compress(b'x' * 1000000, 'zstd')
+                decoder = Decoder('zstd')
+                self.assertRaises(ProtocolError, decoder.feed, compressed)
+                self.assertTrue(len(decoder.message) <= 1001)
+        finally:
+            config.max_frame = max_frame
+        
+    def test_parser(self):
+        # A compressed frame is decoded as its pieces are fed in.
+        message = b'{"result": "' + b'x' * 100000 + b'"}'
+        frame = encode_frame(message, 'length', 'zlib')
+        parser = FrameParser('length')
+        parser.compress = 'zlib'
+        end = len(frame) - len(frame) % 100 - 100
+        for start in range(0, end, 100):
+            parser.feed(frame[start:start+100])
+            self.assertTrue(parser.next_frame() is None)
+            self.assertTrue(len(parser.data) == 0)
+        parser.feed(frame[end:] + frame)
+        self.assertTrue(parser.next_frame() == message)
+        self.assertTrue(parser.next_frame() == message)
+        self.assertTrue(parser.next_frame() is None)
+        
+    def test_calls(self):
+        text = u'\u00e9' * 100000
+        for kwargs in ({}, {'persistent': True}, {'multiplex': True}):
+            client = connect('127.0.0.1', 8000, **kwargs)
+            self.assertTrue(client.update(text) == [text])
+            # Doesn't compress as well, so it's read in pieces.
+            numbers = list(range(100000))
+            self.assertTrue(client.update(*numbers) == numbers)
+            self.assertTrue(client.update(1) == [1])
+            if kwargs:
+                self.assertTrue(
+                    client._connection.reader.compress == AUTO_COMPRESSIONS[0]
+                )
+            client._close()
+        
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs Python 3.7+')
+    def test_async(self):
+        import asyncio
+        from jsonrpctcp.asyncclient import connect as async_connect
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            client = async_connect('127.0.0.1', 8003)
+            result = loop.run_until_complete(client.async_echo('x' * 100000))
+            self.assertTrue(result == 'x' * 100000)
+            self.assertTrue(client._connection.compress == AUTO_COMPRESSIONS[0])
+            loop.run_until_complete(client._close())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        
+    def test_not_offered(self):
+        config.compression = None
+        client = connect('127.0.0.1', 8000, persistent=True)
+        self.assertTrue(client.update('x' * 10000) == ['x' * 10000])
+        self.assertTrue(client._connection.reader.compress == None)
+        client._close()
+        
+    def tearDown(self):
+        config.compression = self.compression
+        
+@unittest.skipIf(not BINARY_CODECS, 'needs msgpack or cbor2')
+class TestBinaryCodec(unittest.TestCase):
+    
+    def test_codecs(self):
+        obj = {"jsonrpc": "2.0", "id": "1", "result": [u"\u00e9", 1.5, None]}
+        for name in BINARY_CODECS:
+            codec = get_codec(name)
+            self.assertTrue(codec.binary)
+            self.assertTrue(codec.loads(codec.dumps(obj)) == obj)
+            self.assertRaises(ValueError, codec.loads, b'\xc1')
+        
+    def test_calls(self):
+        for name in BINARY_CODECS:
+            for kwargs in ({}, {'persistent': True}, {'multiplex': True}):
+                client = connect('127.0.0.1', 8000, codec=name, **kwargs)
+                result = client.update(u'\u00e9', b'\x00\xff', 1.5)
+                self.assertTrue(result == [u'\u00e9', b'\x00\xff', 1.5])
+                self.assertTrue(client._notification.update(1) == None)
+                self.assertRaises(ProtocolError, client.foobar)
+                batch = client._batch()
+                batch.sum(1, 2)
+                batch.subtract(minuend=42, subtrahend=23)
+                self.assertTrue(list(batch()) == [3, 19])
+                client._close()
+        
+    def test_pool(self):
+        pool = ConnectionPool()
+        client = connect('127.0.0.1', 8000, pool=pool, codec=BINARY_CODECS[0])
+        self.assertTrue(client.sum(1, 2) == 3)
+        # A plain JSON client doesn't get the binary connection.
+        client = connect('127.0.0.1', 8000, pool=pool)
+        self.assertTrue(client.sum(1, 2) == 3)
+        self.assertTrue(pool.stats()['misses'] == 2)
+        pool.clear()
+        
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs Python 3.7+')
+    def test_async(self):
+        import asyncio
+        from jsonrpctcp.asyncclient import connect as async_connect
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            for port in (8000, 8003):
+                client = async_connect(
+                    '127.0.0.1', port, codec=BINARY_CODECS[0]
+                )
+                result = loop.run_until_complete(client.sum(1, 2))
+                self.assertTrue(result == 3)
+                loop.run_until_complete(client._close())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+        
+    def test_refused(self):
+        sock = socket.create_connection(('127.0.0.1', 8000))
+        sock.sendall(b'\x00JRPC codec=bogus framing=length\n')
+        response = sock.recv(config.buffer)
+        sock.close()
+        self.assertTrue(response == b'\x00JRPC error=unsupported\n')
+        self.assertRaises(ValueError, connect, '127.0.0.1', 8000, 
+            codec='bogus')
+        
+class TestConnectionPool(unittest.TestCase):
+    
+    def test_reuse(self):
+        pool = ConnectionPool()
+        client = connect('127.0.0.1', 8000, pool=pool)
+        other = connect('127.0.0.1', 8000, pool=pool)
+        self.assertTrue(client.sum(1, 2) == 3)
+        self.assertTrue(other.sum(3, 4) == 7)
+        batch = client._batch()
+        batch.sum(1, 2)
+        self.assertTrue(list(batch()) == [3])
+        stats = pool.stats()
+        self.assertTrue(stats['created'] == 1)
+        self.assertTrue(stats['misses'] == 1)
+        self.assertTrue(stats['hits'] == 2)
+        self.assertTrue(stats['idle'] == 1)
+        pool.clear()
+        self.assertTrue(pool.stats()['idle'] == 0)
+        
+    def test_threads(self):
+        pool = ConnectionPool(max_size=2)
+        results = []
+        def call(i):
+            client = connect('127.0.0.1', 8000, pool=pool)
+            for j in range(5):
+                results.append(client.sum(i, j))
+        threads = [Thread(target=call, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(results) == 20)
+        stats = pool.stats()
+        self.assertTrue(stats['created'] <= 4)
+        self.assertTrue(stats['hits'] + stats['misses'] == 20)
+        self.assertTrue(stats['idle'] <= 2)
+        pool.clear()
+        
+    def test_eviction(self):
+        pool = ConnectionPool(idle_timeout=0)
+        client = connect('127.0.0.1', 8000, pool=pool)
+        client.sum(1, 2)
+        time.sleep(0.01)
+        client.sum(1, 2)
+        self.assertTrue(pool.stats()['evicted'] == 1)
+        pool.idle_timeout = 30
+        client.sum(1, 2)
+        connection = pool.checkout(('127.0.0.1', 8000))
+        # Pretend the server closed the idle connection.
+        connection.socket.shutdown(socket.SHUT_RDWR)
+        pool.checkin(connection)
+        client.sum(1, 2)
+        stats = pool.stats()
+        self.assertTrue(stats['evicted'] == 2)
+        self.assertTrue(stats['created'] == 3)
+        pool.clear()
+        
+class TestMultiplex(unittest.TestCase):
+    
+    def test_out_of_order(self):
+        client = connect('127.0.0.1', 8000, multiplex=True)
+        finished = []
+        def call(seconds, value):
+            self.assertTrue(client.sleep(seconds, value) == value)
+            finished.append(value)
+        slow = Thread(target=call, args=(0.5, 'slow'))
+        slow.start()
+        time.sleep(0.1)
+        fast = Thread(target=call, args=(0, 'fast'))
+        fast.start()
+        fast.join()
+        slow.join()
+        self.assertTrue(finished == ['fast', 'slow'])
+        self.assertTrue(client._connection.requests == 2)
+        client._close()
+        
+    def test_threads(self):
+        client = connect('127.0.0.1', 8000, multiplex=True)
+        results = []
+        def call(i):
+            for j in range(10):
+                results.append((i + j, client.sum(i, j)))
+        threads = [Thread(target=call, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(len(results) == 80)
+        for expected, result in results:
+            self.assertTrue(expected == result)
+        self.assertTrue(client._notification.update(1) == None)
+        self.assertRaises(ProtocolError, client.foobar)
+        batch = client._batch()
+        batch.sum(1, 2)
+        batch._notification.update(3)
+        batch.subtract(42, 23)
+        self.assertTrue(list(batch()) == [3, 19])
+        self.assertTrue(client._connection.requests == 83)
+        client._close()
+        
+class TestConcurrentBatch(unittest.TestCase):
+    
+    def setUp(self):
+        config.batch_concurrency = 4
+        
+    def run_batch(self, port):
+        batch = connect('127.0.0.1', port)._batch()
+        for i in range(8):
+            batch.sleep(0.2, i)
+            batch._notification.sleep(0, 'skip')
+        batch.foobar()
+        start = time.time()
+        results = batch()
+        elapsed = time.time() - start
+        for i in range(8):
+            self.assertTrue(results.get(results.ids[i]) == i)
+        self.assertRaises(ProtocolError, results.get, results.ids[8])
+        # Two rounds of four at a time, rather than eight in a row.
+        self.assertTrue(elapsed >= 0.4)
+        self.assertTrue(elapsed < 1.2)
+        
+    def test_threaded(self):
+        self.run_batch(8000)
+        
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs Python 3.7+')
+    def test_async(self):
+        self.run_batch(8003)
+        
+    def tearDown(self):
+        config.batch_concurrency = 1
+        
+def self_signed_certificate():
+    """
+    Makes a self-signed certificate for localhost (with the openssl
+    command), returning the certificate and key paths, or None.
+    """
+    directory = tempfile.mkdtemp()
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    command = [
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-days', '1', '-subj', '/CN=localhost',
+        '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+        '-keyout', keyfile, '-out', certfile
+    ]
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(command, stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return certfile, keyfile
+    
+TLS_SERVER = None
+
+class TestTLS(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        global TLS_SERVER
+        if TLS_SERVER is not None:
+            return
+        files = self_signed_certificate()
+        if files is None:
+            raise unittest.SkipTest('needs the openssl command')
+        config.tls_certfile, config.tls_keyfile = files
+        config.tls_cafile = config.tls_certfile
+        TLSSessions.instance().clear()
+        TLS_SERVER = Server(('', 8004), tls=True)
+        TLS_SERVER.add_handler(summation, 'sum')
+        thread = Thread(target=TLS_SERVER.serve)
+        thread.daemon = True
+        thread.start()
+        if sys.version_info >= (3, 7):
+            thread = Thread(target=async_server, args=(8005, True))
+            thread.daemon = True
+            thread.start()
+        time.sleep(0.5)
+        
+    def test_tls(self):
+        client = connect('localhost', 8004, persistent=True, tls=True)
+        self.assertTrue(client.sum(1, 2) == 3)
+        self.assertTrue(client.sum(3, 4) == 7)
+        self.assertTrue(isinstance(client._connection.socket, ssl.SSLSocket))
+        client._close()
+        self.assertTrue(TLS_SERVER.stats()['tls']['handshakes'] >= 1)
+        
+    @unittest.skipIf(sys.version_info < (3, 6), 'needs Python 3.6+')
+    def test_resumption(self):
+        sessions = TLSSessions.instance()
+        client = connect('localhost', 8004, tls=True)
+        self.assertTrue(client.sum(1, 2) == 3)
+        resumed = sessions.resumed
+        self.assertTrue(client.sum(3, 4) == 7)
+        self.assertTrue(sessions.resumed == resumed + 1)
+        self.assertTrue(TLS_SERVER.stats()['tls']['resumed'] >= 1)
+        
+    def test_errors(self):
+        # The self-signed certificate isn't trusted by default.
+        client = connect(
+            'localhost', 8004, tls=ssl.create_default_context()
+        )
+        self.assertRaises(ssl.SSLError, client.sum, 1, 2)
+        # A plain connection to a TLS server is dropped (or, if it
+        # reads the server's alert, gets an invalid preamble).
+        client = connect('localhost', 8004, persistent=True)
+        self.assertRaises((socket.error, ProtocolError), client.sum, 1, 2)
+        self.assertRaises(
+            ValueError, connect, 'localhost', 8004, multiplex=True, tls=True
+        )
+        
+    @unittest.skipIf(sys.version_info < (3, 7), 'needs Python 3.7+')
+    def test_async(self):
+        import asyncio
+        from jsonrpctcp.asyncclient import connect as async_connect
+        loop = asyncio.new_event_loop()
+        try:
+            client = async_connect('localhost', 8005, tls=True)
+            result = loop.run_until_complete(client.sum(1, 2))
+            self.assertTrue(result == 3)
+            loop.run_until_complete(client._close())
+        finally:
+            loop.close()
+        
+@unittest.skipIf(sys.version_info < (3, 7), 'asyncio server needs Python 3.7+')
+class TestAsyncServer(unittest.TestCase):
+    
+    def test_sync_handler(self):
+        client = connect('127.0.0.1', 8003)
+        result = client.sum(1, 2, 4)
+        self.assertTrue(result == 7)
+        
+    def test_coroutine_handler(self):
+        client = connect('127.0.0.1', 8003)
+        result = client.async_echo(message='Echo!')
+        self.assertTrue(result == 'Echo!')
+        
+    def test_stats(self):
+        client = connect('127.0.0.1', 8003)
+        client.async_echo('Echo!')
+        self.assertRaises(ProtocolError, client.async_echo)
+        self.assertRaises(ProtocolError, client.sum, 'a', 1)
+        self.assertTrue(client.get_config() == CONFIG.obj)
+        stats = client.system.stats()
+        self.assertTrue(stats['methods']['async_echo']['calls'] >= 1)
+        self.assertTrue(stats['methods']['sum']['errors'] >= 1)
+        self.assertTrue(stats['errors']['-32602'] >= 1)
+        self.assertTrue(stats['errors']['-32603'] >= 1)
+        self.assertTrue(stats['connections'] >= 1)
+        
+    def test_errors(self):
+        client = connect('127.0.0.1', 8003)
+        self.assertRaises(ProtocolError, client.foobar)
+        self.assertRaises(ProtocolError, client.async_echo)
+        
+    def test_persistent(self):
+        client = connect('127.0.0.1', 8003, persistent=True)
+        self.assertTrue(client.sum(1, 2) == 3)
+        self.assertTrue(client._notification.async_echo('Skip!') == None)
+        self.assertTrue(client.async_echo('Echo!') == 'Echo!')
+        self.assertTrue(client._connection.requests == 3)
+        client._close()
+        
+    def test_netstring(self):
+        framing = config.framing
+        config.framing = 'netstring'
+        try:
+            client = connect('127.0.0.1', 8003)
+            self.assertTrue(client.async_echo('Echo!') == 'Echo!')
+        finally:
+            config.framing = framing
+        
+    def test_multiplex(self):
+        client = connect('127.0.0.1', 8003, multiplex=True)
+        results = []
+        def call(i):
+            results.append(client.sum(i, 1))
+        threads = [Thread(target=call, args=(i,)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(sorted(results) == list(range(1, 21)))
+        self.assertTrue(client._notification.async_echo('Skip!') == None)
+        self.assertTrue(client.async_echo('Echo!') == 'Echo!')
+        client._close()
+        
+    def test_batch(self):
+        batch = connect('127.0.0.1', 8003)._batch()
+        batch.sum(1, 2)
+        batch._notification.async_echo('Skip!')
+        batch.async_echo('Last!')
+        self.assertTrue(list(batch()) == [3, 'Last!'])
+        
+@unittest.skipIf(sys.version_info < (3, 7), 'asyncio client needs Python 3.7+')
+class TestAsyncClient(unittest.TestCase):
+    
+    def setUp(self):
+        import asyncio
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+        
+    def test_calls(self):
+        from jsonrpctcp.asyncclient import connect as async_connect
+        for port in (8000, 8003):
+            client = async_connect('127.0.0.1', port)
+            self.assertTrue(self.run_async(client.sum(1, 2)) == 3)
+            self.assertTrue(
+                self.run_async(client._notification.sum(1)) == None
+            )
+            self.assertRaises(
+                ProtocolError, self.run_async, client.foobar()
+            )
+            self.run_async(client._close())
+        
+    def test_fan_out(self):
+        from jsonrpctcp.asyncclient import connect as async_connect
+        client = async_connect('127.0.0.1', 8003)
+        calls = [client.sum(i, 1) for i in range(200)]
+        results = self.run_async(self.asyncio.gather(*calls))
+        self.assertTrue(results == list(range(1, 201)))
+        self.assertTrue(client._connection.requests == 200)
+        self.run_async(client._close())
+        
+    def test_hooks(self):
+        from jsonrpctcp.asyncclient import connect as async_connect
+        hook = RecordingHook()
+        client = async_connect('127.0.0.1', 8003, hooks=[hook])
+        self.run_async(client.sum(1, 2))
+        self.run_async(client.sum(3, 4))
+        first, second = hook.after
+        self.assertTrue(first.connect > 0 and second.connect == 0)
+        self.assertTrue(second.method == 'sum' and second.wait > 0)
+        self.run_async(client._close())
+        
+    def test_batch(self):
+        from jsonrpctcp.asyncclient import connect as async_connect
+        client = async_connect('127.0.0.1', 8000)
+        batch = client._batch()
+        batch.sum(1, 2)
+        batch._notification.update(3)
+        batch.subtract(minuend=42, subtrahend=23)
+        results = self.run_async(batch())
+        self.assertTrue(list(results) == [3, 19])
+        self.assertTrue(self.run_async(client.namespace.sum(1, 2, 4)) == 7)
+        self.run_async(client._close())
+        
+    def tearDown(self):
+        self.asyncio.set_event_loop(None)
+        self.loop.close()
+        
+class SendallSocket(object):
+    """ A socket without sendmsg (like on Python 2, or Windows). """
+    
+    def __init__(self, sock):
+        self.sendall = sock.sendall
+        self.close = sock.close
+        
 """ Test Methods """
 def subtract(minuend, subtrahend):
     """ Using the keywords from the JSON-RPC v2 doc """
@@ -291,6 +1778,27 @@ def subtract(minuend, subtrahend):
 def update(*args):
     return args
     
+LOOKUPS = []
+SLOW_LOOKUPS = []
+
+def slow_lookup(key):
+    SLOW_LOOKUPS.append(key)
+    time.sleep(0.1)
+    return key
+
+CONFIG = Encoded({'name': u'\u00e9', 'values': list(range(100))})
+    
+def get_config():
+    return CONFIG
+    
+def get_raw():
+    return Encoded(json=b'{"raw": [1, 2]}')
+    
+@cached(ttl=60, size=2)
+def lookup(key):
+    LOOKUPS.append(key)
+    return int(key) * 2
+    
 def summation(*args):
     return sum(args)
     
@@ -299,11 +1807,44 @@ def notify_hello(*args):
     
 def get_data():
     return ['hello', 5]
+    
+def sleep(seconds, value):
+    time.sleep(seconds)
+    return value
+    
+def count(number, fail=False):
+    for i in range(number):
+        yield i
+    if fail:
+        raise ValueError('Failed.')
+        
+def async_server(port=8003, tls=None):
+    import asyncio
+    from jsonrpctcp.asyncserver import AsyncServer
+    namespace = {}
+    exec('async def async_echo(message):\n    return message', namespace)
+    exec(
+        'async def async_count(number):\n'
+        '    for i in range(number):\n'
+        '        yield i', namespace
+    )
+    server = AsyncServer(('', port), tls=tls)
+    server.add_handler(server.stats, 'system.stats')
+    server.add_handler(summation, 'sum')
+    server.add_handler(namespace['async_echo'])
+    server.add_handler(namespace['async_count'])
+    server.add_handler(sleep)
+    server.add_handler(count)
+    server.add_handler(get_config)
+    asyncio.run(server.serve())
         
 def test_set_up():
     # Because 'setUp' on unittests are called multiple times
     # and starting a server each time is inefficient / a headache
     
+    # The tests check the requests and responses through the history.
+    config.trace = True
+    
     # Starting normal server
     server = Server(('', 8000))
     server.add_handler(summation, 'sum')
@@ -312,7 +1853,12 @@ def test_set_up():
     server.add_handler(subtract)
     server.add_handler(update)
     server.add_handler(get_data)
+    server.add_handler(sleep)
+    server.add_handler(count)
     server.add_handler(summation, 'namespace.sum')
+    server.add_handler(get_config)
+    server.add_handler(get_raw)
+    server.add_handler(slow_lookup)
     server_proc = Thread(target=server.serve)
     server_proc.daemon = True
     server_proc.start()
@@ -324,6 +1870,22 @@ def test_set_up():
     server_proc2.daemon = True
     server_proc2.start()
     
+    #Starting pooled server
+    global POOL_SERVER
+    config.stats_method = 'system.stats'
+    POOL_SERVER = Server(('', 8002), pool=2, pool_queue=2)
+    config.stats_method = None
+    POOL_SERVER.add_handler(summation, 'sum')
+    POOL_SERVER.add_handler(update)
+    POOL_SERVER.add_handler(lookup)
+    server_proc3 = Thread(target=POOL_SERVER.serve)
+    server_proc3.daemon = True
+    server_proc3.start()
+    
+    #Starting asyncio server
+    if sys.version_info >= (3, 7):
+        Thread(target=async_server, daemon=True).start()
+    
     time.sleep(1) # give it time to start up
     #logger.setLevel(logging.DEBUG)
     #logger.addHandler(logging.StreamHandler())
@@ -0,0 +1,136 @@
+"""
+TLS for servers and clients (config.tls, or tls=True when they're
+made). Servers need a certificate chain and its key (config.tls_certfile
+and config.tls_keyfile), and clients check the server's certificate
+against config.tls_cafile (or the system's CAs, if it's None).
+
+Clients keep the TLS session of each server they have connected to,
+and resume it when they connect again -- with the session ticket the
+server sent -- which skips the certificate exchange and key agreement
+of a full handshake. A server issues tickets that any of its
+connections can resume, since it uses one SSLContext for all of them.
+
+A self-signed certificate is enough for local use:
+
+    openssl req -x509 -newkey rsa:2048 -nodes -days 365 \\
+        -subj /CN=localhost -addext subjectAltName=DNS:localhost \\
+        -keyout key.pem -out cert.pem
+
+    config.tls_certfile = 'cert.pem'
+    config.tls_keyfile = 'key.pem'
+    config.tls_cafile = 'cert.pem' # on the client
+"""
+import ssl
+import threading
+from jsonrpctcp import config
+
+# Session resumption needs Python 3.6+.
+SESSIONS = hasattr(ssl.SSLSocket, 'session')
+
+def server_context():
+    """ A server SSLContext with the configured certificate. """
+    protocol = getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23)
+    context = ssl.SSLContext(protocol)
+    context.load_cert_chain(config.tls_certfile, config.tls_keyfile)
+    return context
+
+def client_context():
+    """ A client SSLContext that verifies servers (see config.tls_*). """
+    context = ssl.create_default_context(cafile=config.tls_cafile)
+    context.check_hostname = config.tls_check_hostname
+    return context
+
+def get_context(tls, server=False):
+    """
+    Returns the SSLContext for a 'tls' option -- True for one made from
+    the config, or an SSLContext as it is (or None, for no TLS).
+    """
+    if tls is None:
+        tls = config.tls
+    if not tls:
+        return None
+    if isinstance(tls, ssl.SSLContext):
+        return tls
+    if server:
+        return server_context()
+    return TLSSessions.instance().context()
+
+def is_tls(sock):
+    """ Checks whether a socket is a TLS one. """
+    return isinstance(sock, ssl.SSLSocket)
+
+class TLSSessions(object):
+    """
+    The client side TLS state: the shared SSLContext, and the last
+    session of each server (by address), for resuming.
+    """
+    _instance = None
+
+    def __init__(self):
+        self._context = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.handshakes = 0
+        self.resumed = 0
+
+    @classmethod
+    def instance(cls):
+        if not cls._instance:
+            cls._instance = cls()
+        return cls._instance
+
+    def context(self):
+        """ The SSLContext made from the config, the first time. """
+        with self._lock:
+            if self._context is None:
+                self._context = client_context()
+            return self._context
+
+    def wrap(self, sock, addr, context=None):
+        """
+        Starts TLS on a connected socket, resuming the last session
+        with the server if there is one.
+        """
+        if context is None:
+            context = self.context()
+        kwargs = {'server_hostname': addr[0]}
+        with self._lock:
+            session = self._sessions.get((context, addr))
+        if session is not None:
+            kwargs['session'] = session
+        sock = context.wrap_socket(sock, **kwargs)
+        with self._lock:
+            self.handshakes += 1
+            if getattr(sock, 'session_reused', False):
+                self.resumed += 1
+        return sock
+
+    def save(self, sock, addr, context=None):
+        """
+        Keeps the socket's session for the next connection to the
+        server. (With TLS 1.3, the ticket arrives after the handshake,
+        so this should be called once a response has been read.)
+        """
+        if not SESSIONS:
+            return
+        if context is None:
+            context = self.context()
+        session = sock.session
+        if session is None or not getattr(session, 'has_ticket', True):
+            return
+        with self._lock:
+            self._sessions[(context, addr)] = session
+
+    def clear(self):
+        """ Forgets the sessions (and the context, for config changes). """
+        with self._lock:
+            self._context = None
+            self._sessions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'handshakes': self.handshakes,
+                'resumed': self.resumed,
+                'sessions': len(self._sessions),
+            }
@@ -0,0 +1,236 @@
+"""
+A simple, fixed-size pool of worker threads fed from a bounded queue.
+The Server uses this (when a pool size is given) instead of starting
+a new thread for every accepted connection. Framed connections waiting
+for their next request are held by IdleConnections meanwhile, instead
+of each keeping a worker.
+"""
+import select
+import socket
+import threading
+import time
+import sys
+if sys.version_info[0] == 2:
+    import Queue as queue
+else:
+    import queue
+from jsonrpctcp import logger
+
+class WorkerPool(object):
+    """
+    Runs 'target(*args)' on one of a fixed number of worker threads.
+    Jobs wait in a bounded queue -- when it is full, submit() blocks
+    until a worker frees up a slot, which pushes the backpressure back
+    onto the caller (and, for the Server, onto the listen backlog).
+    If the target is None, each job's first argument is the function
+    to call with the rest.
+    """
+
+    def __init__(self, target, size, queue_size):
+        assert size > 0
+        self.target = target
+        self.size = size
+        self.queue = queue.Queue(queue_size)
+        self.threads = []
+        self._lock = threading.Lock()
+        self.busy = 0
+        self.submitted = 0
+        self.completed = 0
+        self.errors = 0
+        self.blocked = 0
+        self.max_queued = 0
+        for i in range(size):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, *args):
+        """
+        Queues a job for the workers, blocking while the queue is full.
+        """
+        try:
+            self.queue.put_nowait(args)
+        except queue.Full:
+            with self._lock:
+                self.blocked += 1
+            self.queue.put(args)
+        with self._lock:
+            self.submitted += 1
+            self.max_queued = max(self.max_queued, self.queue.qsize())
+
+    def _work(self):
+        """ The worker loop -- a None job tells the worker to exit. """
+        while True:
+            args = self.queue.get()
+            if args is None:
+                break
+            with self._lock:
+                self.busy += 1
+            try:
+                if self.target:
+                    self.target(*args)
+                else:
+                    args[0](*args[1:])
+            except Exception:
+                logger.exception('Unhandled error in worker thread.')
+                with self._lock:
+                    self.errors += 1
+            with self._lock:
+                self.busy -= 1
+                self.completed += 1
+
+    def map(self, function, items, limit=None):
+        """
+        Runs 'function(item)' for each of the items on the workers, with
+        at most 'limit' of them running at once, and returns the results
+        in the same order. (The pool's target must be None.)
+        """
+        results = [None] * len(items)
+        slots = threading.Semaphore(limit or len(items))
+        finished = threading.Event()
+        remaining = [len(items)]
+        lock = threading.Lock()
+        def run(index, item):
+            try:
+                results[index] = function(item)
+            finally:
+                slots.release()
+                with lock:
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        finished.set()
+        for index, item in enumerate(items):
+            slots.acquire()
+            self.submit(run, index, item)
+        if items:
+            finished.wait()
+        return results
+
+    def shutdown(self):
+        """ Lets the workers finish the queued jobs, then stops them. """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stats(self):
+        """ Returns a snapshot of the queue depth and worker usage. """
+        with self._lock:
+            return {
+                'workers': self.size,
+                'busy': self.busy,
+                'idle': self.size - self.busy,
+                'queued': self.queue.qsize(),
+                'queue_size': self.queue.maxsize,
+                'max_queued': self.max_queued,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'errors': self.errors,
+                'blocked': self.blocked,
+            }
+
+class IdleConnections(object):
+    """
+    Keep-alive connections waiting for their next request. One thread
+    waits on all of them, and submits a connection's 'resume' callback
+    to the WorkerPool when the next request arrives -- or calls its
+    'close' callback after 'timeout' seconds with nothing.
+    """
+
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        # (deadline, resume, close) by socket
+        self._sockets = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        # Wakes the thread up when a connection is added.
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self.thread = threading.Thread(target=self._wait)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, sock, resume, close):
+        """ Holds an idle connection until its next request. """
+        deadline = time.time() + self.timeout
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._sockets[sock] = (deadline, resume, close)
+        if closed:
+            close()
+            return
+        self._wake()
+
+    def count(self):
+        with self._lock:
+            return len(self._sockets)
+
+    def shutdown(self):
+        """ Stops the thread, and closes the idle connections. """
+        with self._lock:
+            self._closed = True
+            waiting = list(self._sockets.values())
+            self._sockets.clear()
+        self._wake()
+        self.thread.join()
+        for deadline, resume, close in waiting:
+            close()
+        self._wake_reader.close()
+        self._wake_writer.close()
+
+    def _wake(self):
+        try:
+            self._wake_writer.send(b'.')
+        except socket.error:
+            pass
+
+    def _wait(self):
+        """ The thread loop, handing back the readable connections. """
+        while True:
+            with self._lock:
+                if self._closed:
+                    break
+                sockets = list(self._sockets)
+                deadlines = [entry[0] for entry in self._sockets.values()]
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - time.time())
+            try:
+                readable = select.select(
+                    sockets + [self._wake_reader], [], [], timeout
+                )[0]
+            except (select.error, socket.error, ValueError):
+                # One of them was closed -- they're checked below.
+                readable = [sock for sock in sockets if is_closed(sock)]
+            if self._wake_reader in readable:
+                self._wake_reader.recv(4096)
+            now = time.time()
+            ready = []
+            expired = []
+            with self._lock:
+                for sock in sockets:
+                    entry = self._sockets.get(sock)
+                    if entry is None:
+                        continue
+                    if sock in readable:
+                        ready.append(entry[1])
+                    elif entry[0] <= now:
+                        expired.append(entry[2])
+                    else:
+                        continue
+                    del self._sockets[sock]
+            for close in expired:
+                close()
+            for resume in ready:
+                # (Blocks while the queue is full, like accepting.)
+                self.workers.submit(resume)
+
+def is_closed(sock):
+    """ Checks whether a socket has been closed (on this end). """
+    try:
+        return sock.fileno() < 0
+    except socket.error:
+        return True